@@ -1,4 +1,25 @@
-from . import aggregate_profiles as aggregate_profiles
-from . import hitcalls as hitcalls
-from . import classify as classify
-from . import regression as regression
+"""Aggregated profiles, classifiers, regressions and hit calls."""
+
+import importlib
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from . import aggregate_profiles as aggregate_profiles
+    from . import hitcalls as hitcalls
+    from . import classify as classify
+    from . import metrics as metrics
+    from . import regression as regression
+
+submodules = ["aggregate_profiles", "hitcalls", "classify", "metrics", "regression"]
+
+
+# submodules are imported on first access (PEP 562), so that parsing the
+# rules does not import their dependencies
+def __getattr__(name: str):
+    if name in submodules:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> list:
+    return sorted([*globals(), *submodules])
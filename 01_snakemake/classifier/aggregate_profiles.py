@@ -1,113 +1,97 @@
 import logging  # noqa: CPY001, D100
 
 import polars as pl
-import pycytominer
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-def aggregate_compound(method: str, dat: pl.DataFrame) -> pl.DataFrame:
-    """Aggregate subset of profiles for each compound."""
-    feat_cols = [i for i in dat.columns if "Metadata" not in i]
+def selection_masks(dat: pl.LazyFrame) -> pl.LazyFrame:
+    """Profiles of each compound used by every aggregation method.
 
-    if method == "all":
-        agg_df = pl.from_pandas(
-            pycytominer.aggregate(
-                dat.to_pandas(),
-                strata=["Metadata_OASIS_ID"],
-                features=feat_cols,
-            ),
-        )
+    Evaluates the POD, ccPOD and MinConc masks once as columns and adds the
+    fallback tier of each profile per method (null if unused), so that the
+    fallback chains are resolved in a single pass over the table.
+    """
+    oasis = pl.col("Metadata_OASIS_ID")
+    log_conc = pl.col("Metadata_Log10Conc")
 
-    elif method == "allpod":
-        agg_df = pl.from_pandas(
-            pycytominer.aggregate(
-                dat.filter(
-                    pl.col("Metadata_Log10Conc") > pl.col("Metadata_POD"),
-                ).to_pandas(),
-                strata=["Metadata_OASIS_ID"],
-                features=feat_cols,
-            ),
-        )
+    def fallback(mask: pl.Expr) -> pl.Expr:
+        # compounds without a selected profile fall back to the next mask
+        return ~mask.any().over(oasis) & oasis.is_not_null()
 
-        # if no pod, then use all profiles
-        dat_filt = dat.filter(
-            ~pl.col("Metadata_OASIS_ID").is_in(
-                agg_df.select(pl.col("Metadata_OASIS_ID")).to_series().to_list()
+    return (
+        dat.with_columns(
+            (log_conc > pl.col("Metadata_POD")).fill_null(False).alias("_pod"),
+            (
+                (log_conc > pl.col("Metadata_POD"))
+                & (log_conc < pl.col("Metadata_ccPOD"))
             )
+            .fill_null(False)
+            .alias("_podcc"),
+            (pl.col("Metadata_Concentration") == pl.col("Metadata_MinConc"))
+            .fill_null(False)
+            .alias("_minconc"),
         )
-        agg_df = pl.concat(
-            [
-                agg_df,
-                pl.from_pandas(
-                    pycytominer.aggregate(
-                        dat_filt.to_pandas(),
-                        strata=["Metadata_OASIS_ID"],
-                        features=feat_cols,
-                    ),
-                ),
-            ],
-            how="vertical",
+        .with_columns(
+            fallback(pl.col("_pod")).alias("_no_pod"),
+            fallback(pl.col("_podcc")).alias("_no_podcc"),
         )
-
-    elif method == "allpodcc":
-        agg_df = pl.from_pandas(
-            pycytominer.aggregate(
-                dat.filter(
-                    (pl.col("Metadata_Log10Conc") > pl.col("Metadata_POD"))
-                    & (pl.col("Metadata_Log10Conc") < pl.col("Metadata_ccPOD")),
-                ).to_pandas(),
-                strata=["Metadata_OASIS_ID"],
-                features=feat_cols,
-            ),
+        .with_columns(
+            # if no pod, then use all profiles
+            pl.when(pl.col("_pod"))
+            .then(0)
+            .when(pl.col("_no_pod"))
+            .then(1)
+            .alias("_tier_allpod"),
+            # if no allpodcc, then use first profile after pod, else all
+            pl.when(pl.col("_podcc"))
+            .then(0)
+            .when(pl.col("_no_podcc") & pl.col("_minconc"))
+            .then(1)
+            .when(pl.col("_no_podcc") & fallback(pl.col("_podcc") | pl.col("_minconc")))
+            .then(2)
+            .alias("_tier_allpodcc"),
+            pl.lit(0).alias("_tier_all"),
         )
+    )
 
-        # if no allpodcc, then use first profile after pod
-        dat_filt = dat.filter(
-            ~pl.col("Metadata_OASIS_ID").is_in(
-                agg_df.select(pl.col("Metadata_OASIS_ID")).to_series().to_list()
-            )
-        )
-        agg_df = pl.concat(
-            [
-                agg_df,
-                pl.from_pandas(
-                    pycytominer.aggregate(
-                        dat_filt.filter(
-                            pl.col("Metadata_Concentration")
-                            == pl.col("Metadata_MinConc"),
-                        ).to_pandas(),
-                        strata=["Metadata_OASIS_ID"],
-                        features=feat_cols,
-                    ),
-                ),
-            ],
-            how="vertical",
-        )
 
-        # if still no pod, then use all
-        dat_filt = dat.filter(
-            ~pl.col("Metadata_OASIS_ID").is_in(
-                agg_df.select(pl.col("Metadata_OASIS_ID")).to_series().to_list()
+def aggregate_compound(methods: list, dat: pl.DataFrame) -> pl.DataFrame:
+    """Median profile of each compound for every aggregation method.
+
+    The selected profiles of all methods are stacked lazily and reduced by a
+    single (method, tier, compound) group_by, which polars runs in parallel
+    across groups and feature columns.
+    """
+    feat_cols = [i for i in dat.columns if "Metadata" not in i]
+    dat = selection_masks(dat.lazy())
+
+    stacked = pl.concat(
+        [
+            dat.filter(pl.col(f"_tier_{method}").is_not_null()).select(
+                pl.lit(i).alias("_method"),
+                pl.col(f"_tier_{method}").alias("_tier"),
+                "Metadata_OASIS_ID",
+                pl.col(feat_cols).cast(pl.Float64).fill_nan(None),
             )
-        )
-        agg_df = pl.concat(
-            [
-                agg_df,
-                pl.from_pandas(
-                    pycytominer.aggregate(
-                        dat_filt.to_pandas(),
-                        strata=["Metadata_OASIS_ID"],
-                        features=feat_cols,
-                    ),
-                ),
-            ],
-            how="vertical",
-        )
+            for i, method in enumerate(methods)
+        ]
+    )
 
-    # Annotate with aggregation and feature type
-    agg_df = agg_df.with_columns(pl.lit(method).alias("Metadata_AggType"))
+    agg_df = (
+        stacked.group_by(["_method", "_tier", "Metadata_OASIS_ID"])
+        .agg(pl.col(feat_cols).median())
+        .with_columns(
+            pl.col("_method")
+            .replace_strict(dict(enumerate(methods)))
+            .alias("Metadata_AggType")
+        )
+        # methods in order, then each fallback tier by compound
+        .sort(["_method", "_tier", "Metadata_OASIS_ID"], nulls_last=True)
+        .select(["Metadata_OASIS_ID", *feat_cols, "Metadata_AggType"])
+        .collect()
+    )
 
     return agg_df
 
@@ -164,12 +148,7 @@ def aggregate_profiles(
 
     # 3. Aggregate profiles
     methods = ["all", "allpod", "allpodcc"]
-    agg_df = []
-
-    for method in methods:
-        agg_df.append(aggregate_compound(method, profiles))
-
-    agg_df = pl.concat(agg_df)
+    agg_df = aggregate_compound(methods, profiles)
 
     # 4. Write out results
     agg_df.write_parquet(agg_path)
@@ -1,33 +1,195 @@
-import traceback  # noqa: CPY001, D100
-
+import hashlib  # noqa: CPY001, D100
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import traceback
+import zlib
+
+import numpy as np
 import pandas as pd
 import polars as pl
+import xgboost as xgb
+from sklearn.metrics import roc_auc_score
 from sklearn.model_selection import StratifiedKFold
-from xgboost import XGBClassifier
-import cupy as cp
-from sklearn.preprocessing import LabelEncoder
-from tqdm.contrib.concurrent import thread_map
+from joblib import Parallel, delayed
+from tqdm import tqdm
+
+xgb_params = {
+    "objective": "binary:logistic",
+    "tree_method": "hist",
+    "learning_rate": 0.05,
+}
+n_estimators = 150
+
+# permutations run by one worker call
+perm_chunk = 25
+
+# model_type -> (shuffle labels, cell count only)
+model_types = {
+    "Actual": (False, False),
+    "Random_baseline": (True, False),
+    "Cellcount_baseline": (False, True),
+}
+
+# Reference quantized matrices loaded by each worker, by (matrix_dir, name)
+_matrix_cache = {}
+
+
+def available_gpus() -> int:
+    """Number of CUDA devices usable by XGBoost, 0 on CPU-only nodes."""
+    if not xgb.build_info().get("USE_CUDA") or shutil.which("nvidia-smi") is None:
+        return 0
+    try:
+        out = subprocess.run(
+            ["nvidia-smi", "-L"], capture_output=True, text=True, check=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return 0
+    return sum(line.startswith("GPU") for line in out.splitlines())
+
+
+def task_devices(n_tasks: int, n_jobs: int, threads_per_model: int) -> tuple:
+    """Device of each task and the number of concurrent workers.
+
+    With GPUs, tasks are spread over the devices with one worker per device.
+    Otherwise they run on the CPU with n_jobs // threads_per_model workers.
+    """
+    num_gpus = available_gpus()
+    if num_gpus > 0:
+        return [f"cuda:{i % num_gpus}" for i in range(n_tasks)], num_gpus
+    return ["cpu"] * n_tasks, max(n_jobs // threads_per_model, 1)
+
+
+def feature_columns(dat: pl.DataFrame, labels: list) -> list:
+    return [
+        i
+        for i in dat.columns
+        if "Metadata_" not in i and i not in labels and i != "Cell_Count"
+    ]
+
+
+def build_matrices(dat: pl.DataFrame, labels: list, matrix_dir: str) -> dict:
+    """Write one float32 feature matrix per agg_type, and its cell counts.
+
+    Returns agg_type -> (OASIS IDs, label matrix) with one row per profile
+    of the agg_type and NaN for missing labels.
+    """
+    feat_cols = feature_columns(dat, labels)
+
+    agg_data = {}
+    for agg_type in (
+        dat.select("Metadata_AggType").to_series().unique().sort().to_list()
+    ):
+        prof = dat.filter(pl.col("Metadata_AggType") == agg_type)
+        for name, cols in [("feats", feat_cols), ("cc", ["Cell_Count"])]:
+            np.save(
+                os.path.join(matrix_dir, f"{agg_type}_{name}.npy"),
+                prof.select(cols).to_numpy().astype(np.float32),
+            )
+        agg_data[agg_type] = (
+            prof.get_column("Metadata_OASIS_ID").to_numpy(),
+            prof.select(labels).to_numpy().astype(np.float32),
+        )
+
+    return agg_data
+
+
+def load_profiles(input_path: str, label_path: str) -> tuple:
+    """Profiles joined to their binary labels, and the label columns."""
+    dat = pl.read_parquet(input_path)
+    meta = pl.read_parquet(label_path).rename({"OASIS_ID": "Metadata_OASIS_ID"})
+    labels = [i for i in meta.columns if "Metadata_" not in i]
+
+    return dat.join(meta, on="Metadata_OASIS_ID", how="left"), labels
+
+
+def load_matrix(matrix_dir: str, name: str) -> tuple:
+    """Memory-mapped feature matrix and its reference QuantileDMatrix.
+
+    The quantile sketch is computed once per worker and matrix; the fold
+    matrices reuse its histogram cuts.
+    """
+    key = (matrix_dir, name)
+    if key not in _matrix_cache:
+        # drop matrices of previous runs
+        for old_key in [i for i in _matrix_cache if i[0] != matrix_dir]:
+            del _matrix_cache[old_key]
+        x = np.load(os.path.join(matrix_dir, f"{name}.npy"), mmap_mode="r")
+        _matrix_cache[key] = (x, xgb.QuantileDMatrix(x))
+    return _matrix_cache[key]
+
+
+def cv_predict(
+    x: np.ndarray,
+    ref: xgb.QuantileDMatrix,
+    y: np.ndarray,
+    n_splits: int,
+    device: str,
+    n_threads: int,
+) -> tuple:
+    """Out-of-fold probabilities of a stratified cross-validation.
+
+    Returns the validation rows, their probabilities and fold numbers, in
+    fold order.
+    """
+    kf = StratifiedKFold(n_splits=n_splits)
+    params = {**xgb_params, "device": device, "nthread": n_threads}
+
+    rows, probs, folds = [], [], []
+    for fold, (train_index, val_index) in enumerate(kf.split(x, y), start=1):
+        y_fold_train = y[train_index]
+        dtrain = xgb.QuantileDMatrix(x[train_index], label=y_fold_train, ref=ref)
+
+        # Train the model on the fold training set
+        model = xgb.train(
+            {
+                **params,
+                "scale_pos_weight": (y_fold_train == 0).sum()
+                / (y_fold_train == 1).sum(),
+            },
+            dtrain,
+            num_boost_round=n_estimators,
+        )
+
+        # Validate the model on the fold validation set
+        rows.append(val_index)
+        probs.append(model.inplace_predict(x[val_index]))
+        folds.append(np.full(len(val_index), fold, dtype=np.int32))
+
+    return np.concatenate(rows), np.concatenate(probs), np.concatenate(folds)
 
 
 def binary_classifier(
-    dat: pd.DataFrame,
-    meta: pd.DataFrame,
+    x: np.ndarray,
+    ref: xgb.QuantileDMatrix,
+    y: np.ndarray,
+    oasis_ids: np.ndarray,
     n_splits: int,
-    gpu_id: int,
+    device: str,
+    n_threads: int,
     *,
     shuffle: bool = False,
-    cc: bool = False,
 ) -> pl.DataFrame:
     """Perform a binary XGBoost classification.
 
     Parameters
     ----------
-    dat : pd.DataFrame
-        The input dataframe containing features and labels.
-    meta : pd.DataFrame
-        Metadata associated with the input data.
+    x : np.ndarray
+        Feature matrix of the labelled samples.
+    ref : xgb.QuantileDMatrix
+        Quantized matrix of all samples whose histogram cuts are reused.
+    y : np.ndarray
+        Binary labels of the samples in x.
+    oasis_ids : np.ndarray
+        OASIS IDs of the samples in x.
     n_splits : int
         Number of folds for cross-validation.
+    device : str
+        XGBoost device, "cpu" or "cuda:<id>".
+    n_threads : int
+        Number of threads of each model.
     shuffle : bool, optional
         Whether to shuffle the data before splitting (default is False).
 
@@ -38,105 +200,55 @@ def binary_classifier(
         for each sample in the validation sets across all folds.
 
     """
-    dat["Label"] = dat["Label"].astype(int)
-    x = dat.drop(columns=["Label"])
-    y = dat["Label"]
-
-    if cc:
-        x = x[["Cell_Count"]]
-    else:
-        x = x.drop(columns=["Cell_Count"])
-
+    y = y.astype(int)
     if shuffle:
-        y = y.sample(frac=1, random_state=42).reset_index(drop=True)
-
-    kf = StratifiedKFold(n_splits=n_splits)
-
-    pred_df = []
-    fold = 1
-    with cp.cuda.Device(gpu_id):
-        for train_index, val_index in kf.split(x, y):
-            x_fold_train, x_fold_val = (
-                cp.array(x.iloc[train_index].to_numpy()),
-                cp.array(x.iloc[val_index].to_numpy()),
-            )
-            y_fold_train, y_fold_val = y.iloc[train_index], y.iloc[val_index]
-
-            le = LabelEncoder()
-            y_fold_train = cp.array(le.fit_transform(y_fold_train))
-            y_fold_val = cp.array(le.fit_transform(y_fold_val))
-
-            meta_fold_val = meta.iloc[val_index]
-
-            # Initialize the model
-            model = XGBClassifier(
-                objective="binary:logistic",
-                n_estimators=150,
-                tree_method="hist",
-                device=f"cuda:{gpu_id}",
-                learning_rate=0.05,
-                scale_pos_weight=(y_fold_train == 0).sum() / (y_fold_train == 1).sum(),
-            )
-
-            # Train the model on the fold training set
-            model.fit(x_fold_train, y_fold_train)
-
-            # Validate the model on the fold validation set
-            y_fold_prob = model.predict_proba(x_fold_val)[:, 1]
-            y_fold_pred = model.predict(x_fold_val)
-
-            pred_df.append(
-                pl.DataFrame(
-                    {
-                        "Metadata_OASIS_ID": list(meta_fold_val["Metadata_OASIS_ID"]),
-                        "y_prob": list(y_fold_prob),
-                        "y_pred": list(y_fold_pred),
-                        "y_actual": list(y_fold_val),
-                        "k_fold": fold,
-                    }
-                ),
-            )
-            fold += 1
-
-    return pl.concat(pred_df, how="vertical")
+        y = pd.Series(y).sample(frac=1, random_state=42).to_numpy()
+
+    rows, y_prob, folds = cv_predict(x, ref, y, n_splits, device, n_threads)
+
+    return pl.DataFrame(
+        {
+            "Metadata_OASIS_ID": oasis_ids[rows],
+            "y_prob": y_prob,
+            "y_pred": (y_prob > 0.5).astype(int),
+            "y_actual": y[rows],
+            "k_fold": folds,
+        }
+    )
 
 
 def process_label_and_agg(
-    dat,
+    matrix_dir,
+    oasis_ids,
+    y,
     label_column,
     agg_type,
     n_splits,
-    labels,
-    gpu_id,
+    device,
+    n_threads,
     *,
     shuffle: bool = False,
     cc: bool = False,
 ):
     """Process a single label_column and agg_type combination."""
     try:
-        prof = dat.filter(
-            (pl.col("Metadata_AggType") == agg_type)
-            & (pl.col(label_column).is_not_null())
-        ).rename({label_column: "Label"})
-
-        num_0 = prof.filter(pl.col("Label") == 0).height
-        num_1 = prof.filter(pl.col("Label") == 1).height
+        rows = np.flatnonzero(~np.isnan(y))
+        num_0 = int((y[rows] == 0).sum())
+        num_1 = int((y[rows] == 1).sum())
 
         if (num_0 >= n_splits) & (num_1 >= n_splits):
-            meta_cols = [i for i in prof.columns if "Metadata_" in i]
-            all_meta_cols = [i for i in prof.columns if i in labels] + meta_cols
-
-            prof_meta = prof.select(meta_cols)
-            prof = prof.drop(all_meta_cols)
+            x, ref = load_matrix(matrix_dir, f"{agg_type}_{'cc' if cc else 'feats'}")
 
             # Call your classifier
             class_res = binary_classifier(
-                prof.to_pandas(),
-                prof_meta.to_pandas(),
+                x[rows],
+                ref,
+                y[rows],
+                oasis_ids[rows],
                 n_splits=n_splits,
-                gpu_id=gpu_id,
+                device=device,
+                n_threads=n_threads,
                 shuffle=shuffle,
-                cc=cc,
             )
 
             # Add the metadata columns
@@ -157,13 +269,65 @@ def process_label_and_agg(
         return None
 
 
+def run_job(job: dict, part_path: str, *args) -> bool:
+    """Run one job and write its predictions to part_path.
+
+    The part is written to a temporary file first so that a crash never
+    leaves a truncated part behind.
+    """
+    shuffle, cc = model_types[job["model_type"]]
+    res = process_label_and_agg(*args, shuffle=shuffle, cc=cc)
+    if res is None:
+        return False
+
+    res.with_columns(pl.lit(job["model_type"]).alias("Model_type")).write_parquet(
+        f"{part_path}.tmp"
+    )
+    os.replace(f"{part_path}.tmp", part_path)
+    return True
+
+
+def job_key(job: dict) -> str:
+    return hashlib.sha1(
+        f"{job['label']}|{job['agg_type']}|{job['model_type']}".encode()
+    ).hexdigest()
+
+
+def open_parts_dir(parts_dir: str, inputs: list, n_splits: int) -> None:
+    """Create parts_dir, clearing parts left by a run on other inputs."""
+    manifest = {
+        "inputs": [[i, os.path.getsize(i), os.path.getmtime(i)] for i in inputs],
+        "n_splits": n_splits,
+        "params": xgb_params,
+        "n_estimators": n_estimators,
+    }
+    manifest_path = os.path.join(parts_dir, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            if json.load(f) == manifest:
+                return
+        print("Inputs changed since the partial run, starting over")
+    shutil.rmtree(parts_dir, ignore_errors=True)
+
+    os.makedirs(parts_dir)
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+
+
 def predict_binary(
     input_path: str,
     label_path: str,
     output_path: str,
+    parts_dir: str,
+    n_jobs: int | None = None,
+    threads_per_model: int = 4,
 ) -> None:
     """Build classifier for each of Srijit's outcomes.
 
+    Every (label, agg_type, model_type) job is scheduled on one pool, most
+    expensive first. Finished predictions are written to parts_dir as they
+    come in, and a rerun after a crash only runs the jobs without a part.
+
     Parameters
     ----------
     input_path : str
@@ -172,68 +336,237 @@ def predict_binary(
         Filepath for input binary labels.
     output_path : str
         Filepath for model classification results.
+    parts_dir : str
+        Directory for the predictions of finished jobs.
+    n_jobs : int, optional
+        Number of cores to use (default is all cores).
+    threads_per_model : int, optional
+        Number of threads of each CPU model (default is 4).
 
     """
     n_splits = 5
-    num_gpus = 8
+    n_jobs = n_jobs or os.cpu_count()
+    open_parts_dir(parts_dir, [input_path, label_path], n_splits)
+
+    dat, labels = load_profiles(input_path, label_path)
+    n_feats = len(feature_columns(dat, labels))
+
+    with tempfile.TemporaryDirectory() as matrix_dir:
+        # Feature matrices are built once and shared by all labels
+        agg_data = build_matrices(dat, labels, matrix_dir)
+        del dat
+
+        jobs = [
+            {
+                "label": label_column,
+                "agg_type": agg_type,
+                "model_type": model_type,
+                "col": i,
+                # training cost grows with the labelled rows times features
+                "cost": int((~np.isnan(agg_data[agg_type][1][:, i])).sum())
+                * (1 if model_types[model_type][1] else n_feats),
+            }
+            for model_type in model_types
+            for i, label_column in enumerate(labels)
+            for agg_type in agg_data
+        ]
+        for job in jobs:
+            job["part"] = os.path.join(parts_dir, f"{job_key(job)}.parquet")
+
+        todo = sorted(
+            [job for job in jobs if not os.path.exists(job["part"])],
+            key=lambda job: job["cost"],
+            reverse=True,
+        )
+        print(f"{len(jobs) - len(todo)} of {len(jobs)} jobs already done")
+
+        devices, max_workers = task_devices(len(todo), n_jobs, threads_per_model)
+        on_gpu = len(devices) > 0 and devices[0] != "cpu"
+        n_threads = n_jobs // max_workers if on_gpu else threads_per_model
+        results = Parallel(n_jobs=max_workers, return_as="generator_unordered")(
+            delayed(run_job)(
+                job,
+                job["part"],
+                matrix_dir,
+                agg_data[job["agg_type"]][0],
+                agg_data[job["agg_type"]][1][:, job["col"]],
+                job["label"],
+                job["agg_type"],
+                n_splits,
+                device,
+                n_threads,
+            )
+            for job, device in zip(todo, devices, strict=True)
+        )
+        for _ in tqdm(results, total=len(todo), desc="Processing classifier jobs"):
+            pass
+
+    # write out results in a fixed order
+    parts = [job["part"] for job in jobs if os.path.exists(job["part"])]
+    if not parts:
+        raise ValueError("No label has enough samples of both classes to classify")
+    pl.concat([pl.read_parquet(i) for i in parts], how="vertical").write_parquet(
+        output_path
+    )
+    shutil.rmtree(parts_dir)
 
-    dat = pl.read_parquet(input_path)
-    meta = pl.read_parquet(label_path).rename({"OASIS_ID": "Metadata_OASIS_ID"})
-    labels = [i for i in meta.columns if "Metadata_" not in i]
 
-    dat = dat.join(meta, on="Metadata_OASIS_ID", how="left")
-
-    agg_types = dat.select("Metadata_AggType").to_series().unique().to_list()
-    tasks = [
-        (dat, label_column, agg_type, n_splits, labels, i % num_gpus)
-        for i, (label_column, agg_type) in enumerate(
-            [
-                (label_column, agg_type)
-                for label_column in labels
-                for agg_type in agg_types
-            ]
-        )
-    ]
+def permutation_aurocs(
+    matrix_dir: str,
+    agg_type: str,
+    y: np.ndarray,
+    seeds: list,
+    n_splits: int,
+    device: str,
+    n_threads: int,
+) -> np.ndarray:
+    """Cross-validated AUROC of a label under each seeded permutation.
 
-    # Train actual models
-    pred_results = thread_map(
-        lambda args: process_label_and_agg(*args, shuffle=False),
-        tasks,
-        max_workers=num_gpus,
-        desc="Processing labels and agg_types",
-    )
+    A seed of None keeps the labels as they are, i.e. the observed AUROC.
+    """
+    x, ref = load_matrix(matrix_dir, f"{agg_type}_feats")
+    rows = np.flatnonzero(~np.isnan(y))
+    # labelled rows are read once for all permutations of the chunk
+    x, y = np.asarray(x[rows]), y[rows].astype(int)
 
-    pred_results = [res for res in pred_results if res is not None]
-    if pred_results:
-        pred_df = pl.concat(pred_results, how="vertical")
-        pred_df = pred_df.with_columns(pl.lit("Actual").alias("Model_type"))
-
-    # Random baseline
-    null_results = thread_map(
-        lambda args: process_label_and_agg(*args, shuffle=True),
-        tasks,
-        max_workers=num_gpus,
-        desc="Processing labels and agg_types",
-    )
+    aurocs = np.empty(len(seeds), dtype=np.float32)
+    for i, seed in enumerate(seeds):
+        y_perm = y if seed is None else np.random.default_rng(seed).permutation(y)
+        val_rows, y_prob, _ = cv_predict(x, ref, y_perm, n_splits, device, n_threads)
+        aurocs[i] = roc_auc_score(y_perm[val_rows], y_prob)
+
+    return aurocs
 
-    null_results = [res for res in null_results if res is not None]
-    if null_results:
-        null_df = pl.concat(null_results, how="vertical")
-        null_df = null_df.with_columns(pl.lit("Random_baseline").alias("Model_type"))
-
-    # Cell count baseline
-    cc_results = thread_map(
-        lambda args: process_label_and_agg(*args, cc=True),
-        tasks,
-        max_workers=num_gpus,
-        desc="Processing labels and agg_types",
-    )
 
-    cc_results = [res for res in cc_results if res is not None]
-    if cc_results:
-        cc_df = pl.concat(cc_results, how="vertical")
-        cc_df = cc_df.with_columns(pl.lit("Cellcount_baseline").alias("Model_type"))
+def predict_binary_null(
+    input_path: str,
+    label_path: str,
+    output_path: str,
+    n_perms: int = 200,
+    seed: int = 0,
+    n_jobs: int | None = None,
+    threads_per_model: int = 4,
+) -> None:
+    """Permutation null of the cross-validated AUROC of each outcome.
+
+    Every (label, agg_type) is classified with its labels permuted n_perms
+    times. Permutations are run in chunks spread over one pool; each has its
+    own random stream spawned from seed and the task, so results do not
+    depend on the chunking or the number of workers.
+
+    Parameters
+    ----------
+    input_path : str
+        Filepath for input profiles.
+    label_path : str
+        Filepath for input binary labels.
+    output_path : str
+        Filepath for the per-task null distribution summaries.
+    n_perms : int, optional
+        Number of label permutations per task (default is 200).
+    seed : int, optional
+        Root seed of the permutations (default is 0).
+    n_jobs : int, optional
+        Number of cores to use (default is all cores).
+    threads_per_model : int, optional
+        Number of threads of each CPU model (default is 4).
+
+    """
+    n_splits = 5
+    n_jobs = n_jobs or os.cpu_count()
+
+    dat, labels = load_profiles(input_path, label_path)
+    n_feats = len(feature_columns(dat, labels))
+
+    with tempfile.TemporaryDirectory() as matrix_dir:
+        agg_data = build_matrices(dat, labels, matrix_dir)
+        del dat
+
+        tasks = []
+        for i, label_column in enumerate(labels):
+            for agg_type, (_, y) in agg_data.items():
+                num_0, num_1 = int((y[:, i] == 0).sum()), int((y[:, i] == 1).sum())
+                if (num_0 < n_splits) | (num_1 < n_splits):
+                    continue
+                root = np.random.SeedSequence(
+                    seed, spawn_key=(zlib.crc32(f"{label_column}|{agg_type}".encode()),)
+                )
+                tasks.append(
+                    {
+                        "label": label_column,
+                        "agg_type": agg_type,
+                        "col": i,
+                        "num_0": num_0,
+                        "num_1": num_1,
+                        "seeds": root.spawn(n_perms),
+                    }
+                )
+
+        # the observed AUROC and chunks of permutations, most expensive first
+        jobs = [
+            (t, [None] if start < 0 else t["seeds"][start : start + perm_chunk])
+            for t in tasks
+            for start in [-1, *range(0, n_perms, perm_chunk)]
+        ]
+        jobs.sort(
+            key=lambda job: len(job[1]) * (job[0]["num_0"] + job[0]["num_1"]) * n_feats,
+            reverse=True,
+        )
+
+        devices, max_workers = task_devices(len(jobs), n_jobs, threads_per_model)
+        on_gpu = len(devices) > 0 and devices[0] != "cpu"
+        n_threads = n_jobs // max_workers if on_gpu else threads_per_model
+        results = Parallel(n_jobs=max_workers)(
+            delayed(permutation_aurocs)(
+                matrix_dir,
+                task["agg_type"],
+                agg_data[task["agg_type"]][1][:, task["col"]],
+                seeds,
+                n_splits,
+                device,
+                n_threads,
+            )
+            for (task, seeds), device in tqdm(
+                zip(jobs, devices, strict=True),
+                total=len(jobs),
+                desc="Processing permutations",
+            )
+        )
+
+    observed, nulls = {}, {}
+    for (task, seeds), aurocs in zip(jobs, results, strict=True):
+        key = (task["label"], task["agg_type"])
+        if seeds == [None]:
+            observed[key] = aurocs[0]
+        else:
+            # chunks are put back in seed order
+            nulls.setdefault(key, []).append((seeds[0].spawn_key[-1], aurocs))
+
+    summary = []
+    for task in tasks:
+        key = (task["label"], task["agg_type"])
+        null = np.concatenate(
+            [aurocs for _, aurocs in sorted(nulls[key], key=lambda i: i[0])]
+        )
+        q05, q50, q95 = np.quantile(null, [0.05, 0.5, 0.95])
+        summary.append(
+            {
+                "Metadata_Label": task["label"],
+                "Metadata_AggType": task["agg_type"],
+                "Metadata_Count_0": task["num_0"],
+                "Metadata_Count_1": task["num_1"],
+                "AUROC": float(observed[key]),
+                "null_mean": float(null.mean()),
+                "null_sd": float(null.std(ddof=1)),
+                "null_q05": float(q05),
+                "null_q50": float(q50),
+                "null_q95": float(q95),
+                "p_value": (1 + int((null >= observed[key]).sum())) / (1 + len(null)),
+                "n_perms": len(null),
+                "null_auroc": null.tolist(),
+            }
+        )
 
-    # write out results
-    if not pred_df.is_empty() and not null_df.is_empty() and not cc_df.is_empty():
-        pl.concat([pred_df, null_df, cc_df], how="vertical").write_parquet(output_path)
+    pl.DataFrame(
+        summary, schema_overrides={"null_auroc": pl.List(pl.Float32)}
+    ).write_parquet(output_path)
@@ -0,0 +1,227 @@
+import numpy as np  # noqa: CPY001, D100
+import polars as pl
+from scipy.special import ndtr, ndtri
+
+# scales the MAD to the SD of a normal distribution
+mad_scale = 1.4826
+
+# lower bound of the MAD as a fraction of the DMSO median, so that plates
+# with tied DMSO distances still give finite z-scores
+mad_floor = 0.01
+
+cond_cols = [
+    "Metadata_Compound",
+    "Metadata_OASIS_ID",
+    "Metadata_Concentration",
+    "Metadata_Log10Conc",
+]
+ref_cols = ["Metadata_Plate", "Metadata_Reference", "Metadata_Distance"]
+
+
+def reference_label(dat: pl.DataFrame) -> pl.Expr:
+    """DMSO set each well is compared to.
+
+    Compounds with their own DMSO wells (DMSO_{compound}) use those, all
+    others the DMSO wells of the plate.
+    """
+    own_ctrl = pl.concat_str([pl.lit("DMSO_"), pl.col("Metadata_Compound")])
+    ctrl_names = (
+        dat.filter(pl.col("Metadata_well_type") == "DMSO")
+        .get_column("Metadata_Compound")
+        .unique()
+    )
+
+    return (
+        pl.when(pl.col("Metadata_well_type") == "DMSO")
+        .then(pl.col("Metadata_Compound"))
+        .when(own_ctrl.is_in(ctrl_names.to_list()))
+        .then(own_ctrl)
+        .otherwise(pl.lit("DMSO"))
+        .alias("Metadata_Reference")
+    )
+
+
+def well_scores(dist: pl.DataFrame, method: str) -> pl.DataFrame:
+    """z-score of every treated well and distance against its plate DMSO.
+
+    Parameters
+    ----------
+    dist : pl.DataFrame
+        Wide table of distances to DMSO, one column per distance type.
+    method : str
+        "robust_z" for (x - median) / (1.4826 * MAD) of the DMSO wells, with
+        the MAD floored at 1% of the median, or "empirical" for the
+        upper-tail DMSO quantile of x as a z-score.
+
+    Returns
+    -------
+    pl.DataFrame
+        Long table with one row per treated well and distance type.
+
+    """
+    dist_cols = [i for i in dist.columns if "Metadata" not in i]
+    long = (
+        dist.with_columns(reference_label(dist))
+        .unpivot(
+            index=cond_cols
+            + ["Metadata_Plate", "Metadata_well_type", "Metadata_Reference"],
+            on=dist_cols,
+            variable_name="Metadata_Distance",
+            value_name="Distance",
+        )
+        .drop_nulls("Distance")
+    )
+    is_ctrl = pl.col("Metadata_well_type") == "DMSO"
+    ctrl = long.filter(is_ctrl).select(ref_cols + ["Distance"])
+    trt = long.filter(~is_ctrl)
+
+    if method == "robust_z":
+        ctrl_stats = ctrl.group_by(ref_cols).agg(
+            pl.col("Distance").median().alias("_median"),
+            (pl.col("Distance") - pl.col("Distance").median())
+            .abs()
+            .median()
+            .alias("_mad"),
+        )
+        ctrl_stats = ctrl_stats.with_columns(
+            pl.max_horizontal(
+                "_mad",
+                mad_floor * pl.col("_median").abs(),
+                pl.lit(np.finfo(np.float64).eps),
+            )
+        )
+        scores = trt.join(ctrl_stats, on=ref_cols).with_columns(
+            ((pl.col("Distance") - pl.col("_median")) / (mad_scale * pl.col("_mad")))
+            .fill_nan(None)
+            .alias("z")
+        )
+
+    elif method == "empirical":
+        # number of DMSO wells at least as distant as each DMSO value
+        ctrl = ctrl.with_columns(
+            pl.len().over(ref_cols).alias("_n_ctrl"),
+            (
+                pl.len().over(ref_cols)
+                - pl.col("Distance").rank("min").over(ref_cols)
+                + 1
+            ).alias("_n_ge"),
+        ).sort("Distance")
+
+        # the closest DMSO value above each treated value, per plate
+        scores = (
+            trt.sort("Distance")
+            .join_asof(
+                ctrl,
+                on="Distance",
+                by=ref_cols,
+                strategy="forward",
+                check_sortedness=False,
+            )
+            .join(
+                ctrl.group_by(ref_cols).agg(pl.col("_n_ctrl").first()),
+                on=ref_cols,
+                suffix="_plate",
+            )
+            .with_columns(
+                # mid-rank, so that z stays finite beyond the DMSO range
+                (
+                    (0.5 + pl.col("_n_ge").fill_null(0)) / (1 + pl.col("_n_ctrl_plate"))
+                ).alias("_p")
+            )
+        )
+        scores = scores.with_columns(
+            pl.Series("z", ndtri(1 - scores.get_column("_p").to_numpy()))
+        )
+
+    else:
+        raise ValueError(f"Unknown hit calling method: {method}")
+
+    return scores.select(
+        cond_cols + ["Metadata_Plate", "Metadata_Distance", "Distance", "z"]
+    )
+
+
+def benjamini_hochberg(stats: pl.DataFrame, by: str) -> pl.DataFrame:
+    """BH-adjusted p-values (q_value) of the tests within each group."""
+    n = pl.len().over(by)
+    return (
+        stats.sort([by, "p_value"], descending=[False, True])
+        .with_columns(
+            (pl.col("p_value") * n / (n - pl.int_range(pl.len()).over(by))).alias(
+                "q_value"
+            )
+        )
+        .with_columns(pl.col("q_value").cum_min().over(by).clip(upper_bound=1))
+    )
+
+
+def call_hits(
+    dist_path: str,
+    hits_path: str,
+    stats_path: str,
+    method: str = "robust_z",
+    alpha: float = 0.05,
+    correction: str | None = "fdr_bh",
+) -> None:
+    """Call active conditions of every compound and distance type.
+
+    Well z-scores against the DMSO wells of their plate are combined over
+    the replicate wells of a (compound, concentration) with Stouffer's
+    method and tested one-sided.
+
+    Parameters
+    ----------
+    dist_path : str
+        Filepath for compiled distances.
+    hits_path : str
+        Filepath for the hit matrix, one boolean Metadata_Hit_{distance}
+        column per distance type and one row per condition.
+    stats_path : str
+        Filepath for the long table of condition statistics.
+    method : str, optional
+        "robust_z" or "empirical" (default is "robust_z").
+    alpha : float, optional
+        Significance level of a hit (default is 0.05).
+    correction : str or None, optional
+        "fdr_bh" for Benjamini-Hochberg within each distance type, or None
+        for raw p-values (default is "fdr_bh").
+
+    """
+    scores = well_scores(pl.read_parquet(dist_path), method)
+
+    stats = (
+        scores.drop_nulls("z")
+        .group_by(cond_cols + ["Metadata_Distance"])
+        .agg(
+            pl.len().alias("n_wells"),
+            pl.col("Distance").median(),
+            (pl.col("z").sum() / pl.len().sqrt()).alias("z"),
+        )
+        .filter(pl.col("z").is_finite())
+    )
+    stats = stats.with_columns(
+        pl.Series("p_value", ndtr(-stats.get_column("z").to_numpy()))
+    )
+
+    if correction == "fdr_bh":
+        stats = benjamini_hochberg(stats, "Metadata_Distance")
+    elif correction is None:
+        stats = stats.with_columns(pl.col("p_value").alias("q_value"))
+    else:
+        raise ValueError(f"Unknown multiple testing correction: {correction}")
+
+    stats = stats.with_columns((pl.col("q_value") < alpha).alias("hit")).sort(
+        cond_cols + ["Metadata_Distance"]
+    )
+    stats.write_parquet(stats_path)
+
+    hits = (
+        stats.pivot(on="Metadata_Distance", index=cond_cols, values="hit")
+        .with_columns(pl.exclude(cond_cols).fill_null(False))
+        .rename(lambda i: i if i in cond_cols else f"Metadata_Hit_{i}")
+    )
+    hit_cols = [i for i in hits.columns if i.startswith("Metadata_Hit_")]
+    hits = hits.with_columns(
+        pl.sum_horizontal(hit_cols).cast(pl.UInt16).alias("Metadata_NumHits")
+    ).sort(cond_cols)
+    hits.write_parquet(hits_path)
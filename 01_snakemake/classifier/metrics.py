@@ -0,0 +1,265 @@
+"""
+Classification metrics of the binary prediction tables.
+
+All (label, agg_type, model_type) groups are sorted once by predicted
+probability. ROC-AUC, PR-AUC (average precision), balanced accuracy, the
+Brier score and the expected calibration error are then computed for every
+group at once from segment sums over that order. A stratified bootstrap
+replicate is a matrix of row multiplicities, so the point estimates and all
+replicates are the same weighted computation.
+"""
+
+import warnings
+
+import numpy as np
+import polars as pl
+from joblib import Parallel, delayed
+from scipy import sparse
+
+group_cols = ["Metadata_Label", "Metadata_AggType", "Model_type"]
+n_bins = 10
+# bootstrap weights held in memory at once (replicates x rows)
+max_cells = 10_000_000
+
+
+def segment_starts(ids: np.ndarray) -> np.ndarray:
+    """First position of each run of equal ids."""
+    return np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+
+
+def bootstrap_weights(
+    strata: np.ndarray, n_boot: int, rng: np.random.Generator
+) -> np.ndarray:
+    """Row multiplicities (rows x replicates) of a stratified bootstrap.
+
+    Every row draws one row of its own stratum in each replicate, so the
+    stratum sizes are kept.
+    """
+    n = len(strata)
+    order = np.argsort(strata, kind="stable")
+    sizes = np.bincount(strata)
+    starts = np.cumsum(sizes) - sizes
+
+    pos = starts[strata, None] + (rng.random((n, n_boot)) * sizes[strata, None]).astype(
+        np.int64
+    )
+    drawn = order[pos] * n_boot + np.arange(n_boot)
+    return np.bincount(drawn.ravel(), minlength=n * n_boot).reshape(n, n_boot)
+
+
+def segment_sums(w: np.ndarray, segments: list) -> list:
+    """Weighted sums of row values over segments of rows.
+
+    segments holds (segment id of each row, values) pairs; all sums are one
+    sparse product so that the weights are only read once.
+    """
+    n = w.shape[0]
+    offsets = np.cumsum([0] + [seg[-1] + 1 for seg, _ in segments])
+    summer = sparse.csr_matrix(
+        (
+            np.concatenate([values for _, values in segments]),
+            (
+                np.concatenate(
+                    [
+                        seg + offset
+                        for (seg, _), offset in zip(segments, offsets[:-1], strict=True)
+                    ]
+                ),
+                np.tile(np.arange(n), len(segments)),
+            ),
+        ),
+        shape=(offsets[-1], n),
+    )
+    sums = summer @ w.astype(float)
+    return [
+        sums[start:end] for start, end in zip(offsets[:-1], offsets[1:], strict=True)
+    ]
+
+
+def weighted_metrics(
+    w: np.ndarray,
+    y: np.ndarray,
+    prob: np.ndarray,
+    pred: np.ndarray,
+    group: np.ndarray,
+    block: np.ndarray,
+    prob_bin: np.ndarray,
+) -> dict:
+    """Metrics of each group under each column of multiplicities w.
+
+    Rows are sorted by group and ascending probability; block marks runs of
+    tied probabilities and prob_bin the calibration bins within a group.
+    Returns metric -> (groups, replicates) array.
+    """
+    # segments numbered from 0 within the rows
+    group, block, prob_bin = (
+        np.cumsum(np.r_[False, ids[1:] != ids[:-1]]) for ids in [group, block, prob_bin]
+    )
+    block_group = group[segment_starts(block)]
+    bin_group = group[segment_starts(prob_bin)]
+
+    pos_block, neg_block, tp, tn, sq_err, bin_prob, bin_pos = segment_sums(
+        w,
+        [
+            (block, y),
+            (block, 1 - y),
+            (group, y * pred),
+            (group, (1 - y) * (1 - pred)),
+            (group, (prob - y) ** 2),
+            (prob_bin, prob),
+            (prob_bin, y),
+        ],
+    )
+
+    # weights of the lower-scored blocks of the group
+    group_blocks = segment_starts(block_group)
+    n_1 = np.add.reduceat(pos_block, group_blocks)
+    n_0 = np.add.reduceat(neg_block, group_blocks)
+    n = n_1 + n_0
+    pos_below = np.cumsum(pos_block, axis=0) - pos_block
+    neg_below = np.cumsum(neg_block, axis=0) - neg_block
+    pos_below -= pos_below[group_blocks][block_group]
+    neg_below -= neg_below[group_blocks][block_group]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Mann-Whitney statistic, ties count half
+        roc_auc = np.add.reduceat(
+            pos_block * (neg_below + 0.5 * neg_block), group_blocks
+        ) / (n_1 * n_0)
+
+        # precision at each threshold, weighted by the recall it adds
+        block_tp = n_1[block_group] - pos_below
+        block_fp = n_0[block_group] - neg_below
+        precision = np.where(pos_block > 0, block_tp / (block_tp + block_fp), 0)
+        pr_auc = np.add.reduceat(pos_block * precision, group_blocks) / n_1
+
+        balanced_accuracy = (tp / n_1 + tn / n_0) / 2
+        brier = sq_err / n
+        ece = np.add.reduceat(np.abs(bin_prob - bin_pos), segment_starts(bin_group)) / n
+
+    return {
+        "ROC_AUC": roc_auc,
+        "PR_AUC": pr_auc,
+        "Balanced_Accuracy": balanced_accuracy,
+        "Brier": brier,
+        "ECE": ece,
+    }
+
+
+def chunk_metrics(
+    y: np.ndarray,
+    prob: np.ndarray,
+    pred: np.ndarray,
+    group: np.ndarray,
+    block: np.ndarray,
+    prob_bin: np.ndarray,
+    n_boot: int,
+    alpha: float,
+    rng: np.random.Generator,
+) -> dict:
+    """Point estimates and bootstrap interval of the groups in the rows."""
+    args = (y, prob, pred, group, block, prob_bin)
+    point = weighted_metrics(np.ones((len(y), 1)), *args)
+
+    strata = (group - group[0]) * 2 + y.astype(np.int64)
+    boot = weighted_metrics(bootstrap_weights(strata, n_boot, rng), *args)
+
+    with warnings.catch_warnings():
+        # undefined for groups with a single class
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return {
+            metric: (
+                point[metric][:, 0],
+                *np.nanquantile(boot[metric], [alpha, 1 - alpha], axis=1),
+            )
+            for metric in point
+        }
+
+
+def group_metrics(
+    preds: pl.DataFrame,
+    n_boot: int = 1000,
+    ci: float = 0.95,
+    seed: int = 0,
+    n_jobs: int = -1,
+) -> pl.DataFrame:
+    """Tidy metrics with bootstrap confidence intervals of every group."""
+    preds = (
+        preds.select(
+            *group_cols, pl.col("y_prob").cast(pl.Float64), "y_pred", "y_actual"
+        )
+        .sort([*group_cols, "y_prob"])
+        .with_columns(
+            pl.struct(group_cols).rle_id().alias("_group"),
+            pl.struct([*group_cols, "y_prob"]).rle_id().alias("_block"),
+            pl.struct(
+                *group_cols,
+                (pl.col("y_prob") * n_bins).floor().clip(0, n_bins - 1),
+            )
+            .rle_id()
+            .alias("_bin"),
+        )
+    )
+    groups = preds.group_by("_group", maintain_order=True).agg(
+        pl.col(group_cols).first(),
+        (pl.col("y_actual") == 0).sum().alias("Metadata_Count_0"),
+        (pl.col("y_actual") == 1).sum().alias("Metadata_Count_1"),
+    )
+
+    group = preds.get_column("_group").to_numpy()
+    block = preds.get_column("_block").to_numpy()
+    prob_bin = preds.get_column("_bin").to_numpy()
+    y = preds.get_column("y_actual").to_numpy().astype(float)
+    prob = preds.get_column("y_prob").to_numpy()
+    pred = preds.get_column("y_pred").to_numpy().astype(float)
+
+    # chunks of whole groups whose replicates fit in memory
+    group_starts = segment_starts(group)
+    group_ends = np.r_[group_starts[1:], len(group)]
+    chunks, start = [], 0
+    for group_start, group_end in zip(group_starts, group_ends, strict=True):
+        if group_start > start and n_boot * (group_end - start) > max_cells:
+            chunks.append((start, group_start))
+            start = group_start
+    chunks.append((start, len(group)))
+
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    alpha = (1 - ci) / 2
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(chunk_metrics)(
+            *(i[start:end] for i in [y, prob, pred, group, block, prob_bin]),
+            n_boot,
+            alpha,
+            np.random.default_rng(chunk_seed),
+        )
+        for (start, end), chunk_seed in zip(chunks, seeds, strict=True)
+    )
+    estimates = {
+        metric: [np.concatenate([res[metric][i] for res in results]) for i in range(3)]
+        for metric in results[0]
+    }
+
+    return pl.concat(
+        [
+            groups.drop("_group").with_columns(
+                pl.lit(metric).alias("Metric"),
+                pl.Series("Value", estimates[metric][0]),
+                pl.Series("CI_low", estimates[metric][1]),
+                pl.Series("CI_high", estimates[metric][2]),
+            )
+            for metric in estimates
+        ]
+    ).sort([*group_cols, "Metric"])
+
+
+def compute_metrics(
+    pred_path: str,
+    metrics_path: str,
+    n_boot: int = 1000,
+    ci: float = 0.95,
+    seed: int = 0,
+    n_jobs: int = -1,
+) -> None:
+    """Summarise a prediction table into tidy per-group metrics."""
+    metrics = group_metrics(pl.read_parquet(pred_path), n_boot, ci, seed, n_jobs)
+    metrics.with_columns(pl.lit(n_boot).alias("n_boot")).write_parquet(metrics_path)
@@ -1,86 +1,164 @@
+import os
+import tempfile
+
 import numpy as np
 import pandas as pd
 import polars as pl
 import xgboost as xgb
+from joblib import Parallel, delayed
 from sklearn.metrics import r2_score, mean_squared_error, mean_absolute_error
 from sklearn.model_selection import GroupShuffleSplit
 from tqdm import tqdm
 
-
-def xgboost_regression(
-    dat: pd.DataFrame,
-    target: str,
-    feat_cols: list,
+n_splits = 10
+
+# (target, feature set, model type); a feature set of None predicts the
+# training mean
+axiom_models = [
+    ("Metadata_ldh_ridge_norm", "features", "Morphology"),
+    ("Metadata_ldh_ridge_norm", "baseline", "Baseline"),
+    ("Metadata_ldh_ridge_norm", None, "Mean_predictor"),
+    ("Metadata_mtt_ridge_norm", "features", "Morphology"),
+    ("Metadata_mtt_ridge_norm", "baseline", "Baseline"),
+    ("Metadata_mtt_ridge_norm", None, "Mean_predictor"),
+]
+
+pred_meta_cols = [
+    "Metadata_Plate",
+    "Metadata_Well",
+    "Metadata_Compound",
+    "Metadata_OASIS_ID",
+    "Metadata_Log10Conc",
+]
+
+
+def group_splits(groups: pd.Series) -> list:
+    """Train and test rows of each split, holding out whole groups."""
+    gss = GroupShuffleSplit(n_splits=n_splits, test_size=0.2, random_state=42)
+    return list(gss.split(np.zeros(len(groups)), groups=groups))
+
+
+def regression_split(
+    matrix_path: str,
+    cols: np.ndarray | None,
+    y: np.ndarray,
+    train_idx: np.ndarray,
+    test_idx: np.ndarray,
+    n_threads: int,
+) -> np.ndarray:
+    """Predictions for the labelled test rows of one split.
+
+    Without feature columns the training mean is predicted.
+    """
+    train_idx = train_idx[~np.isnan(y[train_idx])]
+    test_idx = test_idx[~np.isnan(y[test_idx])]
+
+    if cols is None:
+        return np.full(len(test_idx), np.mean(y[train_idx]))
+
+    x = np.load(matrix_path, mmap_mode="r")
+    model = xgb.XGBRegressor(objective="reg:squarederror", n_jobs=n_threads)
+    model.fit(x[np.ix_(train_idx, cols)], y[train_idx])
+    return model.predict(x[np.ix_(test_idx, cols)])
+
+
+def run_regressions(
+    profiles: pd.DataFrame,
+    feature_sets: dict,
+    models: list,
     split_group: str,
-    *,
-    mean_pred: bool = False,
-) -> pl.DataFrame:
-    """Predict continuous metadata from profiling data with XGBoost."""
-
-    groups = dat[split_group]
-    gss = GroupShuffleSplit(n_splits=10, test_size=0.2, random_state=42)
-    i = 1
+    n_jobs: int | None = None,
+    threads_per_model: int = 4,
+) -> tuple:
+    """Predict continuous metadata from profiling data with XGBoost.
+
+    The group splits are computed once and the feature columns of all sets
+    are stored as one float32 matrix that the workers memory-map. Every
+    model x split is a separate job of one process pool.
+    """
+    n_jobs = n_jobs or os.cpu_count()
+    splits = group_splits(profiles[split_group])
+
+    matrix_cols = list(dict.fromkeys(c for cols in feature_sets.values() for c in cols))
+    col_idx = {c: i for i, c in enumerate(matrix_cols)}
+    set_idx = {
+        name: np.array([col_idx[c] for c in cols])
+        for name, cols in feature_sets.items()
+    }
+    targets = {target: profiles[target].to_numpy(dtype=float) for target, *_ in models}
+
+    with tempfile.TemporaryDirectory() as matrix_dir:
+        matrix_path = os.path.join(matrix_dir, "features.npy")
+        np.save(matrix_path, profiles[matrix_cols].to_numpy(dtype=np.float32))
+
+        # widest feature sets first, mean predictors are instant
+        jobs = sorted(
+            [(m, s) for m in range(len(models)) for s in range(len(splits))],
+            key=lambda job: -len(set_idx.get(models[job[0]][1], [])),
+        )
+        preds = Parallel(n_jobs=max(n_jobs // threads_per_model, 1))(
+            delayed(regression_split)(
+                matrix_path,
+                set_idx[models[m][1]] if models[m][1] is not None else None,
+                targets[models[m][0]],
+                *splits[s],
+                threads_per_model,
+            )
+            for m, s in tqdm(jobs)
+        )
+        preds = dict(zip(jobs, preds, strict=True))
+
+    meta = {col: profiles[col].to_numpy() for col in pred_meta_cols}
     results = []
     pred_obs = []
-
-    for split_idx, (train_idx, test_idx) in tqdm(
-        enumerate(gss.split(dat, groups=groups))
-    ):
-        # Splitting the dataset
-        train_data = dat.iloc[train_idx]
-        test_data = dat.iloc[test_idx]
-
-        train_data = train_data.dropna(subset=[target]).reset_index(drop=True)
-        test_data = test_data.dropna(subset=[target]).reset_index(drop=True)
-
-        X_train = train_data[feat_cols]
-        y_train = train_data[target]
-        X_test = test_data[feat_cols]
-        y_test = test_data[target]
-
-        # Train model
-        if mean_pred:
-            mean_value = np.mean(y_train)
-            predictions = np.full(len(y_test), mean_value)
-        else:
-            model = xgb.XGBRegressor(objective="reg:squarederror")
-            model.fit(X_train, y_train)
-            predictions = model.predict(X_test)
-
-        # Calculate performance
-        mse = mean_squared_error(y_test, predictions)
-        r2 = r2_score(y_test, predictions)
-        rmse = np.sqrt(mse)
-        mae = mean_absolute_error(y_test, predictions)
-
-        results.append((target, split_idx, r2, rmse, mae))
-        pred_obs.append(
-            pl.DataFrame(
-                {
-                    "Predicted": predictions,
-                    "Observed": y_test.values,
-                    "Metadata_Plate": test_data["Metadata_Plate"].values,
-                    "Metadata_Well": test_data["Metadata_Well"].values,
-                    "Metadata_Compound": test_data["Metadata_Compound"].values,
-                    "Metadata_OASIS_ID": test_data["Metadata_OASIS_ID"].values,
-                    "Metadata_Log10Conc": test_data["Metadata_Log10Conc"].values,
-                    "Variable": target,
-                    "Split": i,
-                }
+    for m, (target, _, model_type) in enumerate(models):
+        y = targets[target]
+        model_res = []
+        model_pred = []
+        for s, (_, test_idx) in enumerate(splits):
+            test_idx = test_idx[~np.isnan(y[test_idx])]
+            y_test = y[test_idx]
+            predictions = preds[(m, s)]
+
+            # Calculate performance
+            mse = mean_squared_error(y_test, predictions)
+            r2 = r2_score(y_test, predictions)
+            rmse = np.sqrt(mse)
+            mae = mean_absolute_error(y_test, predictions)
+
+            model_res.append((target, s, r2, rmse, mae))
+            model_pred.append(
+                pl.DataFrame(
+                    {
+                        "Predicted": predictions,
+                        "Observed": y_test,
+                        **{col: meta[col][test_idx] for col in pred_meta_cols},
+                        "Variable": target,
+                        "Split": 1,
+                    }
+                )
             )
-        )
 
-    # Convert results to DataFrame for analysis
-    results_df = pd.DataFrame(
-        results, columns=["Variable", "Split", "R²", "RMSE", "MAE"]
-    )
-    pred_obs_df = pl.concat(pred_obs, how="vertical_relaxed").to_pandas()
+        model_res = pd.DataFrame(
+            model_res, columns=["Variable", "Split", "R²", "RMSE", "MAE"]
+        )
+        model_pred = pl.concat(model_pred, how="vertical_relaxed").to_pandas()
+        for df in [model_res, model_pred]:
+            df["Variable_Name"] = target
+            df["Model_type"] = model_type
+        results.append(model_res)
+        pred_obs.append(model_pred)
 
-    return results_df, pred_obs_df
+    return pd.concat(results, ignore_index=True), pd.concat(pred_obs, ignore_index=True)
 
 
 def predict_axiom_assays(
-    prof_path: str, prediction_path: str, results_path: str
+    prof_path: str,
+    prediction_path: str,
+    results_path: str,
+    models: list = axiom_models,
+    n_jobs: int | None = None,
+    threads_per_model: int = 4,
 ) -> None:
     """Train XGBoost regression model to predict Axiom assays."""
     profiles = pd.read_parquet(prof_path)
@@ -104,74 +182,27 @@ def predict_axiom_assays(
         profiles["Metadata_Compound"].astype("category").cat.codes
     )
 
-    feat_cols = [i for i in profiles.columns if "Metadata" not in i]
-    baseline_cols = [
-        "Metadata_Plate_cat",
-        "Metadata_Well_cat",
-        "Metadata_source_cat",
-        "Metadata_Count_Cells",
-    ]
-
-    # LDH
-    ldh_bl_res, ldh_bl_pred = xgboost_regression(
-        profiles, "Metadata_ldh_ridge_norm", baseline_cols, "Metadata_Compound"
+    feature_sets = {
+        "features": [i for i in profiles.columns if "Metadata" not in i],
+        "baseline": [
+            "Metadata_Plate_cat",
+            "Metadata_Well_cat",
+            "Metadata_source_cat",
+            "Metadata_Count_Cells",
+        ],
+    }
+
+    res_df, prediction_df = run_regressions(
+        profiles,
+        feature_sets,
+        models,
+        "Metadata_Compound",
+        n_jobs=n_jobs,
+        threads_per_model=threads_per_model,
     )
-    ldh_bl_pred["Variable_Name"] = "Metadata_ldh_ridge_norm"
-    ldh_bl_pred["Model_type"] = "Baseline"
-    ldh_bl_res["Variable_Name"] = "Metadata_ldh_ridge_norm"
-    ldh_bl_res["Model_type"] = "Baseline"
-
-    ldh_res, ldh_pred = xgboost_regression(
-        profiles, "Metadata_ldh_ridge_norm", feat_cols, "Metadata_Compound"
-    )
-    ldh_pred["Variable_Name"] = "Metadata_ldh_ridge_norm"
-    ldh_pred["Model_type"] = "Morphology"
-    ldh_res["Variable_Name"] = "Metadata_ldh_ridge_norm"
-    ldh_res["Model_type"] = "Morphology"
-
-    ldh_mean_res, ldh_mean_pred = xgboost_regression(
-        profiles, "Metadata_ldh_ridge_norm", [], "Metadata_Compound", mean_pred=True
-    )
-    ldh_mean_pred["Variable_Name"] = "Metadata_ldh_ridge_norm"
-    ldh_mean_pred["Model_type"] = "Mean_predictor"
-    ldh_mean_res["Variable_Name"] = "Metadata_ldh_ridge_norm"
-    ldh_mean_res["Model_type"] = "Mean_predictor"
-
-    # MTT
-    mtt_res, mtt_pred = xgboost_regression(
-        profiles, "Metadata_mtt_ridge_norm", feat_cols, "Metadata_Compound"
-    )
-    mtt_pred["Variable_Name"] = "Metadata_mtt_ridge_norm"
-    mtt_pred["Model_type"] = "Morphology"
-    mtt_res["Variable_Name"] = "Metadata_mtt_ridge_norm"
-    mtt_res["Model_type"] = "Morphology"
-
-    mtt_bl_res, mtt_bl_pred = xgboost_regression(
-        profiles, "Metadata_mtt_ridge_norm", baseline_cols, "Metadata_Compound"
-    )
-    mtt_bl_pred["Variable_Name"] = "Metadata_mtt_ridge_norm"
-    mtt_bl_pred["Model_type"] = "Baseline"
-    mtt_bl_res["Variable_Name"] = "Metadata_mtt_ridge_norm"
-    mtt_bl_res["Model_type"] = "Baseline"
-
-    mtt_mean_res, mtt_mean_pred = xgboost_regression(
-        profiles, "Metadata_mtt_ridge_norm", [], "Metadata_Compound", mean_pred=True
-    )
-    mtt_mean_pred["Variable_Name"] = "Metadata_mtt_ridge_norm"
-    mtt_mean_pred["Model_type"] = "Mean_predictor"
-    mtt_mean_res["Variable_Name"] = "Metadata_mtt_ridge_norm"
-    mtt_mean_res["Model_type"] = "Mean_predictor"
 
     # Write out predictions
-    prediction_df = pd.concat(
-        [ldh_pred, ldh_bl_pred, ldh_mean_pred, mtt_pred, mtt_bl_pred, mtt_mean_pred],
-        ignore_index=True,
-    )
     prediction_df.to_parquet(prediction_path)
 
     # Write out results
-    res_df = pd.concat(
-        [ldh_res, ldh_bl_res, ldh_mean_res, mtt_res, mtt_bl_res, mtt_mean_res],
-        ignore_index=True,
-    )
     res_df.to_parquet(results_path)
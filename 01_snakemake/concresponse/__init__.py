@@ -1,2 +1,35 @@
-from . import ap as ap
-from . import compile_dist as compile_dist
+"""Distances, concentration-response curves and PODs."""
+
+import importlib
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from . import ap as ap
+    from . import bmd as bmd
+    from . import compile_dist as compile_dist
+    from . import plot_curves as plot_curves
+    from . import select_pod as select_pod
+    from . import shards as shards
+    from . import sweep as sweep
+
+submodules = [
+    "ap",
+    "bmd",
+    "compile_dist",
+    "plot_curves",
+    "select_pod",
+    "shards",
+    "sweep",
+]
+
+
+# submodules are imported on first access (PEP 562), so that parsing the
+# rules does not import their dependencies
+def __getattr__(name: str):
+    if name in submodules:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> list:
+    return sorted([*globals(), *submodules])
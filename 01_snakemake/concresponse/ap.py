@@ -1,140 +1,292 @@
+import hashlib
+import os
+import tempfile
+
 import polars as pl
-from copairs import map
-from copairs.matching import assign_reference_index
 from tqdm import tqdm
 import pandas as pd
 import numpy as np
 from joblib import Parallel, delayed
 
-n_cpus = 10
-
-
-def phenotypic_consistency_dmso(cmpd: str, prof_path: str):
-    profiles = pl.read_parquet(prof_path)
-    dmso_profiles = profiles.filter(pl.col("Metadata_Compound") == "DMSO")
-
-    cmpd_profs = profiles.filter(pl.col("Metadata_Compound") == cmpd)
-    cmpd_plates = (
-        cmpd_profs.select(pl.col("Metadata_Plate")).to_series().unique().to_list()
-    )
-    cmpd_dmso = (
-        dmso_profiles.filter(pl.col("Metadata_Plate").is_in(cmpd_plates))
-        .with_row_index()
-        .with_columns(pl.lit(cmpd).alias("Metadata_Compound_DMSO"))
-    )
-
-    # Choose 720 samples to have even multiple of 16
-    indices = np.random.choice(np.arange(cmpd_dmso.shape[0]), size=720, replace=False)
-    cmpd_dmso = cmpd_dmso.filter(pl.col("index").is_in(indices))
-
-    # create random DMSO groups
-    categories = np.random.permutation(np.repeat(np.arange(1, 46), 16))
-    cmpd_dmso = cmpd_dmso.with_columns(
-        pl.Series("Metadata_DMSO_Category", categories)
-    ).to_pandas()
-
-    # Calculate phenotypic consistency
-    pos_sameby = ["Metadata_DMSO_Category"]
-    pos_diffby = []
-    neg_sameby = []
-    neg_diffby = ["Metadata_DMSO_Category"]
-
-    metadata = cmpd_dmso.filter(regex="^Metadata")
-    cmpd_feats = cmpd_dmso.filter(regex="^(?!Metadata)").values
-
-    activity_ap = map.average_precision(
-        metadata, cmpd_feats, pos_sameby, pos_diffby, neg_sameby, neg_diffby
-    )
-
-    return activity_ap
-
-
-def phenotypic_activity_compound(cmpd: str, prof_path: str):
-    """Function to process each compound in parallel"""
-
-    # get data
-    profiles = pl.scan_parquet(prof_path)
-    dmso_profiles = profiles.filter(pl.col("Metadata_Compound") == "DMSO")
-
-    # select only data for cmpd
-    cmpd_profs = profiles.filter(pl.col("Metadata_Compound") == cmpd).collect()
-    cmpd_plates = (
-        cmpd_profs.select(pl.col("Metadata_Plate")).to_series().unique().to_list()
-    )
-    cmpd_dmso = (
-        dmso_profiles.filter(pl.col("Metadata_Plate").is_in(cmpd_plates))
-        .collect()
-        .with_row_index()
-    )
+block_size = 4096
 
-    # Choose 720 samples to have even multiple of 16
-    indices = np.random.choice(np.arange(cmpd_dmso.shape[0]), size=720, replace=False)
-    cmpd_dmso = cmpd_dmso.filter(pl.col("index").is_in(indices)).drop("index")
 
-    cmpd_df = pl.concat([cmpd_profs, cmpd_dmso]).to_pandas()
+def load_profiles(prof_path: str, mmap_path: str):
+    """Load profiles once and memory-map the feature matrix for the workers.
 
-    # calculate phenotypic activity
-    reference_col = "Metadata_reference_index"
-
-    df_activity = assign_reference_index(
-        cmpd_df,
-        "Metadata_Compound == 'DMSO'",
-        reference_col=reference_col,
-        default_value=-1,
-    )
-
-    pos_sameby = ["Metadata_Compound", reference_col]
-    pos_diffby = []
-    neg_sameby = []
-    neg_diffby = ["Metadata_Compound", reference_col]
-
-    metadata = df_activity.filter(regex="^Metadata")
-    cmpd_feats = df_activity.filter(regex="^(?!Metadata)").values
-
-    activity_ap = map.average_precision(
-        metadata, cmpd_feats, pos_sameby, pos_diffby, neg_sameby, neg_diffby
+    Returns the metadata, a read-only float32 memmap of the features and
+    plate -> DMSO rows and compound -> rows indexes.
+    """
+    profiles = pl.read_parquet(prof_path)
+    meta_cols = [i for i in profiles.columns if i.startswith("Metadata")]
+    feat_cols = [i for i in profiles.columns if not i.startswith("Metadata")]
+
+    np.save(mmap_path, profiles.select(feat_cols).to_numpy().astype(np.float32))
+    feats = np.load(mmap_path, mmap_mode="r")
+    meta = profiles.select(meta_cols).with_row_index("Metadata_WellKey").to_pandas()
+    del profiles
+
+    dmso_mask = (meta["Metadata_Compound"] == "DMSO").to_numpy()
+    plate_index = meta.groupby("Metadata_Plate").indices
+    dmso_index = {plate: idx[dmso_mask[idx]] for plate, idx in plate_index.items()}
+    cmpd_index = meta.groupby("Metadata_Compound").indices
+
+    return meta, feats, dmso_index, cmpd_index
+
+
+def l2_normalize(feats: np.ndarray) -> np.ndarray:
+    """L2-normalize rows so that a matrix product gives cosine similarities."""
+    feats = np.asarray(feats, dtype=np.float32)
+    return feats / np.linalg.norm(feats, axis=1, keepdims=True)
+
+
+def cosine_block(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Cosine similarity block between L2-normalized x and y, in row blocks."""
+    sims = np.empty((x.shape[0], y.shape[0]), dtype=np.float32)
+    for start in range(0, x.shape[0], block_size):
+        sims[start : start + block_size] = x[start : start + block_size] @ y.T
+    return sims
+
+
+def average_precision(sims: np.ndarray, pos: np.ndarray) -> np.ndarray:
+    """Average precision of each row of a similarity block.
+
+    Candidates are ranked by decreasing similarity and pos flags the relevant
+    ones. Excluded candidates (e.g. self pairs) should have -inf similarity.
+    Rows without positives get NaN.
+    """
+    order = np.argsort(-sims, axis=1, kind="stable")
+    rel = np.take_along_axis(pos, order, axis=1)
+    tp = np.cumsum(rel, axis=1)
+    ranks = np.arange(1, sims.shape[1] + 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (tp / ranks * rel).sum(axis=1) / rel.sum(axis=1)
+
+
+def sample_dmso(n_rows: int, n_samples: int, group_size: int, seed: int):
+    """Seeded choice of DMSO wells and their random pseudo-replicate groups."""
+    rng = np.random.default_rng(seed)
+    indices = np.sort(rng.choice(n_rows, size=n_samples, replace=False))
+    n_groups = n_samples // group_size
+    groups = rng.permutation(np.repeat(np.arange(1, n_groups + 1), group_size))
+    return indices, groups
+
+
+def null_key(
+    plates: tuple,
+    dmso_meta: pd.DataFrame,
+    dmso_feats: np.ndarray,
+    n_samples: int,
+    group_size: int,
+    seed: int,
+) -> str:
+    """Cache key of a DMSO null: the sorted plate set, the content of its DMSO
+    wells and the sampling parameters."""
+    h = hashlib.sha1("|".join(plates).encode())
+    h.update("|".join(dmso_meta["Metadata_Well"]).encode())
+    h.update(np.ascontiguousarray(dmso_feats).tobytes())
+    h.update(f"{n_samples}|{group_size}|{seed}".encode())
+    return h.hexdigest()
+
+
+def phenotypic_consistency_dmso(
+    dmso_meta: pd.DataFrame,
+    feats: np.ndarray,
+    dmso_rows: np.ndarray,
+    n_samples: int = 720,
+    group_size: int = 16,
+    seed: int = 0,
+):
+    """AP of random DMSO pseudo-replicate groups from the DMSO x DMSO block."""
+    indices, groups = sample_dmso(len(dmso_rows), n_samples, group_size, seed)
+    cmpd_dmso = dmso_meta.iloc[indices].reset_index(drop=True)
+    cmpd_dmso["Metadata_DMSO_Category"] = groups
+
+    dmso_feats = l2_normalize(feats[dmso_rows[indices]])
+    sims = cosine_block(dmso_feats, dmso_feats)
+    np.fill_diagonal(sims, -np.inf)
+    pos = groups[:, None] == groups[None, :]
+    np.fill_diagonal(pos, False)
+
+    cmpd_dmso["average_precision"] = average_precision(sims, pos)
+
+    return cmpd_dmso
+
+
+def dmso_nulls(
+    meta: pd.DataFrame,
+    feats: np.ndarray,
+    dmso_rows: dict,
+    cache_dir: str,
+    n_jobs: int,
+    n_samples: int = 720,
+    group_size: int = 16,
+    seed: int = 0,
+) -> dict:
+    """Compute each distinct DMSO null once, reusing nulls cached in cache_dir."""
+    os.makedirs(cache_dir, exist_ok=True)
+
+    todo = {}
+    nulls = {}
+    for plates, rows in dmso_rows.items():
+        key = null_key(
+            plates, meta.iloc[rows], feats[rows], n_samples, group_size, seed
+        )
+        null_path = os.path.join(cache_dir, f"{key}.parquet")
+        if os.path.exists(null_path):
+            # row keys shift when plates are added, so re-derive them
+            indices, _ = sample_dmso(len(rows), n_samples, group_size, seed)
+            nulls[plates] = pd.read_parquet(null_path).assign(
+                Metadata_WellKey=rows[indices]
+            )
+        else:
+            todo[plates] = null_path
+
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(phenotypic_consistency_dmso)(
+            meta.iloc[dmso_rows[plates]],
+            feats,
+            dmso_rows[plates],
+            n_samples=n_samples,
+            group_size=group_size,
+            seed=seed,
+        )
+        for plates in tqdm(todo)
     )
+    for (plates, null_path), null in zip(todo.items(), results, strict=True):
+        null.to_parquet(null_path)
+        nulls[plates] = null
+
+    return nulls
+
+
+def phenotypic_activity_plates(
+    cmpd_meta: pd.DataFrame,
+    feats: np.ndarray,
+    cmpd_rows: np.ndarray,
+    dmso_rows: np.ndarray,
+    n_samples: int = 720,
+    group_size: int = 16,
+    seed: int = 0,
+):
+    """AP of every compound replicate tested on one plate set against DMSO.
+
+    The compound x DMSO block is computed once for all compounds sharing the
+    plate set, the replicate x replicate block per compound. Positives are
+    the other replicates of the same compound, negatives the sampled DMSO
+    wells.
+    """
+    indices, _ = sample_dmso(len(dmso_rows), n_samples, group_size, seed)
+    dmso_feats = l2_normalize(feats[dmso_rows[indices]])
+    cmpd_feats = l2_normalize(feats[cmpd_rows])
+
+    cmpd_dmso = cosine_block(cmpd_feats, dmso_feats)
+
+    cmpd_meta = cmpd_meta.reset_index(drop=True)
+    ap = np.full(len(cmpd_meta), np.nan)
+    for rows in cmpd_meta.groupby("Metadata_Compound").indices.values():
+        same = cosine_block(cmpd_feats[rows], cmpd_feats[rows])
+        np.fill_diagonal(same, -np.inf)
+        sims = np.hstack([same, cmpd_dmso[rows]])
+
+        pos = np.zeros(sims.shape, dtype=bool)
+        pos[:, : len(rows)] = True
+        np.fill_diagonal(pos, False)
+
+        ap[rows] = average_precision(sims, pos)
+
+    cmpd_meta["average_precision"] = ap
+
+    return cmpd_meta
+
+
+def calculate_ap(
+    prof_path: str,
+    cache_dir: str,
+    n_jobs: int = 10,
+    n_samples: int = 720,
+    group_size: int = 16,
+    seed: int = 0,
+):
+    # every sampled DMSO well needs a pseudo-replicate group
+    if n_samples % group_size:
+        raise ValueError(
+            f"ap_null_size ({n_samples}) must be a multiple of the DMSO group "
+            f"size ({group_size})"
+        )
 
-    return activity_ap
-
-
-def calculate_ap(prof_path: str):
-    lf = pl.scan_parquet(prof_path)
-    compounds = lf.select("Metadata_Compound").collect().to_series().unique().to_list()
-    compounds = [i for i in compounds if "DMSO" not in i]
-
-    # Calculate dmso AP in parallel
-    dmso_results = Parallel(n_jobs=n_cpus)(
-        delayed(phenotypic_consistency_dmso)(cmpd, prof_path)
-        for cmpd in tqdm(compounds)
-    )
-    dmso_ap = pd.concat(dmso_results)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        meta, feats, dmso_index, cmpd_index = load_profiles(
+            prof_path, os.path.join(tmp_dir, "feats.npy")
+        )
+        compounds = [i for i in cmpd_index if "DMSO" not in i]
+        plate_sets = {
+            cmpd: tuple(sorted(meta["Metadata_Plate"].iloc[cmpd_index[cmpd]].unique()))
+            for cmpd in compounds
+        }
+
+        # Group compounds by the plates they share
+        set_cmpd_rows = {}
+        for cmpd, plates in plate_sets.items():
+            set_cmpd_rows.setdefault(plates, []).append(cmpd_index[cmpd])
+        set_cmpd_rows = {
+            plates: np.sort(np.concatenate(rows))
+            for plates, rows in set_cmpd_rows.items()
+        }
+        set_dmso_rows = {
+            plates: np.sort(np.concatenate([dmso_index[plate] for plate in plates]))
+            for plates in set_cmpd_rows
+        }
+
+        # Calculate dmso AP once per distinct plate set
+        nulls = dmso_nulls(
+            meta,
+            feats,
+            set_dmso_rows,
+            cache_dir,
+            n_jobs,
+            n_samples=n_samples,
+            group_size=group_size,
+            seed=seed,
+        )
+        dmso_ap = pd.concat(
+            [
+                nulls[plate_sets[cmpd]].assign(Metadata_Compound_DMSO=cmpd)
+                for cmpd in compounds
+            ]
+        )
 
-    # Calculate cmpd AP in parallel
-    cmpd_results = Parallel(n_jobs=n_cpus)(
-        delayed(phenotypic_activity_compound)(cmpd, prof_path)
-        for cmpd in tqdm(compounds)
-    )
-    cmpd_ap = pd.concat(cmpd_results)
+        # Calculate cmpd AP in parallel across plate sets
+        cmpd_results = Parallel(n_jobs=n_jobs)(
+            delayed(phenotypic_activity_plates)(
+                meta.iloc[set_cmpd_rows[plates]],
+                feats,
+                set_cmpd_rows[plates],
+                set_dmso_rows[plates],
+                n_samples=n_samples,
+                group_size=group_size,
+                seed=seed,
+            )
+            for plates in tqdm(set_cmpd_rows)
+        )
+        cmpd_ap = pd.concat(cmpd_results)
 
-    # Combine everything together
+    # Combine everything together, keyed by the row of the well
+    key_cols = ["Metadata_WellKey", "Metadata_Compound"]
     cmpd_ap = (
         pl.DataFrame(cmpd_ap)
-        .filter(~pl.col("average_precision").is_null())
-        .drop("Metadata_reference_index")
+        .filter(~pl.col("average_precision").is_nan())
+        .select(key_cols + ["average_precision"])
     )
-    meta_cols = [i for i in cmpd_ap.columns if "Metadata" in i]
-    cmpd_ap = cmpd_ap.select(meta_cols + ["average_precision"])
 
     dmso_ap = (
         pl.DataFrame(dmso_ap)
-        .drop(["Metadata_Compound"])
         .with_columns(
             pl.concat_str(
                 [pl.lit("DMSO"), pl.col("Metadata_Compound_DMSO")], separator="_"
             ).alias("Metadata_Compound")
         )
-        .select(meta_cols + ["average_precision"])
+        .select(key_cols + ["average_precision"])
     )
 
     ap = (
@@ -146,9 +298,19 @@ def calculate_ap(prof_path: str):
     return ap
 
 
-def calculate_distances(prof_path: str, dist_path: str, method: str):
+def calculate_distances(
+    prof_path: str,
+    dist_path: str,
+    method: str,
+    cache_dir: str,
+    n_jobs: int = 10,
+    n_samples: int = 720,
+    seed: int = 0,
+):
     if method == "ap":
-        dist = calculate_ap(prof_path)
+        dist = calculate_ap(
+            prof_path, cache_dir, n_jobs, n_samples=n_samples, seed=seed
+        )
         dist.write_parquet(dist_path)
     else:
         print("METHOD NOT FOUND")
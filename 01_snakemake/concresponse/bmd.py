@@ -0,0 +1,700 @@
+"""
+Batched concentration-response fitting and BMD calculation.
+
+Every (compound, distance type) series is stacked into padded (series x wells)
+arrays and each model of the fastbmdR family (Exp2-Exp5, Hill, Pow, Poly2,
+Lin) is fitted to all series at once with a vectorized Levenberg-Marquardt
+solver (closed form for the linear models). The best model of each series is
+selected by AIC and persisted with the covariance of its parameters.
+
+BMD/BMDL/BMDU and pass flags only depend on the fitted models and the BMR, so
+they are computed in a separate step that can sweep several num_sds at once.
+
+Intended deviations from fastbmdR::scoresPOD: the BMD is interpolated on a
+grid of n_grid doses over [0, 2 x max dose] rather than solved for, and
+BMDL/BMDU are the 2.5% and 97.5% quantiles of the BMDs of n_draws parametric
+draws from the asymptotic covariance of the parameters, so they only agree
+approximately with fastbmdR's intervals (see test_fastbmdr_parity).
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import polars as pl
+from joblib import Parallel, delayed
+from scipy.stats import f as f_dist
+from tqdm import tqdm
+
+from .compile_dist import sweep_cols
+
+param_names = ["b", "c", "d", "e", "f"]
+max_params = 4
+fit_version = 1
+chunk_size = 256
+n_draws = 100
+n_grid = 400
+lof_thresh = 0.1
+ci_ratio = 40
+ld_factor = 3
+
+# columns added by threshold_chunk
+bmd_schema = {
+    **dict.fromkeys(["bmr", "bmd", "bmdl", "bmdu"], pl.Float64),
+    **dict.fromkeys(
+        ["conv.pass", "hd.pass", "CI.pass", "ld.pass", "all.pass"], pl.Boolean
+    ),
+}
+
+
+def exp2(x, b, e):
+    return e * np.exp(b * x)
+
+
+def exp3(x, b, d, e):
+    return e * np.exp(np.sign(b) * (np.abs(b) * x) ** d)
+
+
+def exp4(x, b, c, e):
+    return e * (c - (c - 1) * np.exp(-b * x))
+
+
+def exp5(x, b, c, d, e):
+    return e * (c - (c - 1) * np.exp(-((b * x) ** d)))
+
+
+def hill(x, b, c, d, e):
+    return c + (d - c) / (1 + (x / e) ** b)
+
+
+def power(x, b, c, e):
+    return e + b * x**c
+
+
+def poly2(x, b, c, d):
+    return b + c * x + d * x**2
+
+
+def linear(x, b, d):
+    return d + b * x
+
+
+# name: (function, parameters, lower bounds)
+models = {
+    "Exp2": (exp2, ["b", "e"], [-np.inf, -np.inf]),
+    "Exp3": (exp3, ["b", "d", "e"], [-np.inf, 1, -np.inf]),
+    "Exp4": (exp4, ["b", "c", "e"], [1e-8, 0, -np.inf]),
+    "Exp5": (exp5, ["b", "c", "d", "e"], [1e-8, 0, 1, -np.inf]),
+    "Hill": (hill, ["b", "c", "d", "e"], [1e-8, -np.inf, -np.inf, 1e-8]),
+    "Pow": (power, ["b", "c", "e"], [-np.inf, 1e-8, -np.inf]),
+    "Poly2": (poly2, ["b", "c", "d"], [-np.inf, -np.inf, -np.inf]),
+    "Lin": (linear, ["b", "d"], [-np.inf, -np.inf]),
+}
+
+
+def evaluate(model: str, x: np.ndarray, params: np.ndarray) -> np.ndarray:
+    """Evaluate a model for stacked series; params has one row per series.
+
+    x is (series, wells) or broadcastable to it and params is (series, k),
+    or (series, draws, k) with x of shape (series, 1, wells).
+    """
+    fn = models[model][0]
+    with np.errstate(all="ignore"):
+        return fn(x, *[params[..., [i]] for i in range(params.shape[-1])])
+
+
+def clip_params(model: str, params: np.ndarray) -> np.ndarray:
+    return np.maximum(params, models[model][2])
+
+
+def weighted_lstsq(design: np.ndarray, y: np.ndarray, w: np.ndarray) -> np.ndarray:
+    """Batched weighted least squares, design is (series, wells, k)."""
+    dw = design * w[..., None]
+    xtx = np.einsum("snk,snl->skl", dw, design)
+    xty = np.einsum("snk,sn->sk", dw, y)
+    return batched_solve(xtx, xty)
+
+
+def batched_solve(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    try:
+        return np.linalg.solve(a, b[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        return np.einsum("skl,sl->sk", np.linalg.pinv(a), b)
+
+
+def series_stats(x: np.ndarray, y: np.ndarray, w: np.ndarray) -> dict:
+    """Per-series summaries used for starting values and BMR."""
+    ctrl = (x == 0) & (w > 0)
+    n_ctrl = ctrl.sum(axis=1)
+    y0 = (y * ctrl).sum(axis=1) / np.maximum(n_ctrl, 1)
+    sd_ctrl = np.sqrt(
+        (((y - y0[:, None]) * ctrl) ** 2).sum(axis=1) / np.maximum(n_ctrl - 1, 1)
+    )
+
+    x_max = np.where(w > 0, x, -np.inf).max(axis=1)
+    top = (x == x_max[:, None]) & (w > 0)
+    y_top = (y * top).sum(axis=1) / np.maximum(top.sum(axis=1), 1)
+    x_min = np.where((w > 0) & (x > 0), x, np.inf).min(axis=1)
+
+    return {
+        "y0": y0,
+        "sd_ctrl": sd_ctrl,
+        "x_max": x_max,
+        "x_min": x_min,
+        "y_top": y_top,
+    }
+
+
+def start_values(model: str, stats: dict, lin: np.ndarray) -> np.ndarray:
+    """Starting values from the control mean, top-dose mean and linear fit."""
+    y0, y_top, x_max = stats["y0"], stats["y_top"], stats["x_max"]
+    safe_y0 = np.where(y0 == 0, 1e-8, y0)
+    ratio = y_top / safe_y0
+    with np.errstate(all="ignore"):
+        b_exp = np.where(ratio > 0, np.log(np.abs(ratio)), 0) / x_max
+    b_exp = np.where(np.isfinite(b_exp) & (b_exp != 0), b_exp, 1e-3)
+    c_exp = np.where(ratio > 0, ratio, 1)
+
+    start = {
+        "Exp2": [b_exp, y0],
+        "Exp3": [b_exp, np.ones_like(y0), y0],
+        "Exp4": [3 / x_max, c_exp, y0],
+        "Exp5": [3 / x_max, c_exp, np.full_like(y0, 2), y0],
+        "Hill": [np.full_like(y0, 2), y_top, y0, x_max / 2],
+        "Pow": [lin[:, 0], np.ones_like(y0), y0],
+    }[model]
+    return clip_params(model, np.stack(start, axis=1))
+
+
+def jacobian(model: str, x: np.ndarray, params: np.ndarray) -> np.ndarray:
+    """Forward-difference Jacobian for stacked series, (series, wells, k)."""
+    base = evaluate(model, x, params)
+    jac = np.empty(base.shape + (params.shape[1],))
+    for i in range(params.shape[1]):
+        step = 1e-7 * np.maximum(np.abs(params[:, i]), 1e-3)
+        shifted = params.copy()
+        shifted[:, i] += step
+        jac[..., i] = (evaluate(model, x, shifted) - base) / step[:, None]
+    return np.nan_to_num(jac, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+def levenberg_marquardt(
+    model: str,
+    x: np.ndarray,
+    y: np.ndarray,
+    w: np.ndarray,
+    params: np.ndarray,
+    max_iter: int = 200,
+    tol: float = 1e-10,
+):
+    """Fit one model to all series at once, with a damping factor per series."""
+    resid = (y - evaluate(model, x, params)) * w
+    rss = np.where(np.isfinite(resid).all(axis=1), (resid**2).sum(axis=1), np.inf)
+    damping = np.full(len(params), 1e-3)
+    active = np.ones(len(params), dtype=bool)
+
+    for _ in range(max_iter):
+        idx = np.flatnonzero(active)
+        if len(idx) == 0:
+            break
+
+        jac = jacobian(model, x[idx], params[idx]) * w[idx, :, None]
+        jtj = np.einsum("snk,snl->skl", jac, jac)
+        grad = np.einsum("snk,sn->sk", jac, np.nan_to_num(resid[idx]))
+        diag = np.einsum("skk->sk", jtj) + 1e-12
+        step = batched_solve(
+            jtj + damping[idx, None, None] * diag[..., None] * np.eye(jtj.shape[1]),
+            grad,
+        )
+
+        new_params = clip_params(model, params[idx] + step)
+        new_resid = (y[idx] - evaluate(model, x[idx], new_params)) * w[idx]
+        new_rss = (new_resid**2).sum(axis=1)
+        better = np.isfinite(new_rss) & (new_rss < rss[idx])
+
+        improvement = np.where(better, (rss[idx] - new_rss) / (rss[idx] + 1e-300), 0)
+        params[idx[better]] = new_params[better]
+        resid[idx[better]] = new_resid[better]
+        rss[idx[better]] = new_rss[better]
+        damping[idx] = np.clip(
+            np.where(better, damping[idx] / 10, damping[idx] * 10), 1e-12, 1e12
+        )
+
+        done = (better & (improvement < tol)) | (damping[idx] >= 1e12)
+        active[idx[done]] = False
+
+    converged = np.isfinite(rss) & np.isfinite(params).all(axis=1)
+    return params, rss, converged
+
+
+def fit_model(model: str, x: np.ndarray, y: np.ndarray, w: np.ndarray, stats: dict):
+    """Fit a model to all series; returns params, rss and convergence flags."""
+    if model == "Lin":
+        design = np.stack([x, np.ones_like(x)], axis=2)
+        params = weighted_lstsq(design, y, w)
+    elif model == "Poly2":
+        design = np.stack([np.ones_like(x), x, x**2], axis=2)
+        params = weighted_lstsq(design, y, w)
+    else:
+        lin = weighted_lstsq(np.stack([x, np.ones_like(x)], axis=2), y, w)
+        return levenberg_marquardt(model, x, y, w, start_values(model, stats, lin))
+
+    rss = (((y - evaluate(model, x, params)) * w) ** 2).sum(axis=1)
+    return params, rss, np.isfinite(rss)
+
+
+def pure_error(x: np.ndarray, y: np.ndarray, w: np.ndarray):
+    """Residual sum of squares around the dose group means, and dose counts."""
+    pe = np.zeros(len(x))
+    n_doses = np.zeros(len(x))
+    for i in range(len(x)):
+        xi, yi = x[i, w[i] > 0], y[i, w[i] > 0]
+        doses, inverse = np.unique(xi, return_inverse=True)
+        means = np.bincount(inverse, yi) / np.bincount(inverse)
+        pe[i] = ((yi - means[inverse]) ** 2).sum()
+        n_doses[i] = len(doses)
+    return pe, n_doses
+
+
+def lack_of_fit(
+    n: np.ndarray, pe: np.ndarray, n_doses: np.ndarray, rss: np.ndarray, k: int
+):
+    """Lack-of-fit F test p-value against the dose group means."""
+    df_lof = n_doses - k
+    df_pe = n - n_doses
+    with np.errstate(all="ignore"):
+        stat = ((rss - pe) / df_lof) / (pe / df_pe)
+        pval = f_dist.sf(stat, df_lof, df_pe)
+    return np.where((df_lof > 0) & (df_pe > 0), pval, np.nan)
+
+
+def bmd_from_curves(
+    grid: np.ndarray, curves: np.ndarray, bmr: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """First dose where |f(dose) - f(0)| reaches the BMR, by interpolation.
+
+    curves is (..., grid) and bmr broadcasts to curves[..., 0]. Returns the
+    BMD (NaN when never reached) and the response level at the BMD.
+    """
+    delta = np.abs(curves - curves[..., [0]]) - bmr[..., None]
+    reached = np.nan_to_num(delta, nan=-np.inf) >= 0
+    hit = reached.argmax(axis=-1)
+    found = reached.any(axis=-1) & (hit > 0)
+    hit = np.maximum(hit, 1)
+
+    lo = np.take_along_axis(delta, (hit - 1)[..., None], axis=-1)[..., 0]
+    hi = np.take_along_axis(delta, hit[..., None], axis=-1)[..., 0]
+    with np.errstate(all="ignore"):
+        frac = np.where(hi != lo, -lo / (hi - lo), 0)
+    bmd = grid[hit - 1] + frac * (grid[hit] - grid[hit - 1])
+
+    direction = np.sign(
+        np.take_along_axis(curves, hit[..., None], axis=-1)[..., 0] - curves[..., 0]
+    )
+    level = curves[..., 0] + direction * bmr
+    return np.where(found, bmd, np.nan), level
+
+
+def fit_chunk(x: np.ndarray, y: np.ndarray, w: np.ndarray) -> dict:
+    """Fit all models to a chunk of series and keep the best one by AIC.
+
+    Besides the parameters, the asymptotic covariance of the parameters of
+    the best model is kept (flattened and NaN-padded to 4 x 4) so that BMD
+    confidence intervals can be recomputed for any BMR without refitting.
+    """
+    stats = series_stats(x, y, w)
+    n = w.sum(axis=1)
+    pe, n_doses = pure_error(x, y, w)
+    n_series = len(x)
+
+    best_aic = np.full(n_series, np.inf)
+    best = {
+        "mod.name": np.full(n_series, None, dtype=object),
+        "params": np.full((n_series, len(param_names)), np.nan),
+        "SDres": np.full(n_series, np.nan),
+        "AIC.model": np.full(n_series, np.nan),
+        "lof.p": np.full(n_series, np.nan),
+        "cov": np.full((n_series, max_params**2), np.nan),
+    }
+    fits = {}
+    for model, (_, names, _) in models.items():
+        with np.errstate(all="ignore"):
+            params, rss, converged = fit_model(model, x, y, w, stats)
+            k = len(names)
+            aic = n * np.log(2 * np.pi * rss / n) + n + 2 * (k + 1)
+        lof_p = lack_of_fit(n, pe, n_doses, rss, k)
+        valid = converged & np.isfinite(aic) & ~(lof_p < lof_thresh)
+        better = valid & (aic < best_aic)
+
+        fits[model] = params
+        best_aic[better] = aic[better]
+        best["mod.name"][better] = model
+        best["params"][better] = np.nan
+        for i, name in enumerate(names):
+            best["params"][better, param_names.index(name)] = params[better, i]
+        best["SDres"][better] = np.sqrt(rss[better] / np.maximum(n[better] - k, 1))
+        best["AIC.model"][better] = aic[better]
+        best["lof.p"][better] = lof_p[better]
+
+    for model, (_, names, _) in models.items():
+        idx = np.flatnonzero(best["mod.name"] == model)
+        if len(idx) == 0:
+            continue
+        with np.errstate(all="ignore"):
+            jac = jacobian(model, x[idx], fits[model][idx]) * w[idx, :, None]
+        jtj = np.einsum("snk,snl->skl", jac, jac)
+        cov = np.linalg.pinv(jtj) * (best["SDres"][idx] ** 2)[:, None, None]
+        best["cov"][idx, : len(names) ** 2] = cov.reshape(len(idx), -1)
+
+    return {
+        "mod.name": best["mod.name"],
+        **{name: best["params"][:, i] for i, name in enumerate(param_names)},
+        "SDres": best["SDres"],
+        "SDctrl": stats["sd_ctrl"],
+        "AIC.model": best["AIC.model"],
+        "lof.p": best["lof.p"],
+        "min.dose": stats["x_min"],
+        "max.dose": stats["x_max"],
+        "cov": best["cov"],
+    }
+
+
+def threshold_chunk(
+    fits: dict,
+    grid: np.ndarray,
+    num_sds: list,
+    filt_var: str,
+    log10_dose: bool,
+    noise: np.ndarray,
+) -> list:
+    """BMD, BMDL/BMDU and pass flags of fitted models for several BMRs.
+
+    Model curves and the curves of the parameter draws are evaluated once and
+    re-thresholded for every value of num_sds.
+    """
+    mod_name = fits["mod.name"]
+    n_series = len(mod_name)
+    sd = fits["SDres"] if filt_var == "SDres" else fits["SDctrl"]
+
+    curves = {}
+    for model, (_, names, _) in models.items():
+        idx = np.flatnonzero(mod_name == model)
+        if len(idx) == 0:
+            continue
+        k = len(names)
+        params = np.stack([fits[name][idx] for name in names], axis=1)
+        cov = fits["cov"][idx, : k**2].reshape(len(idx), k, k)
+
+        # Draws from the asymptotic distribution of the parameters
+        vals, vecs = np.linalg.eigh(np.nan_to_num(cov))
+        root = vecs * np.sqrt(np.clip(vals, 0, None))[:, None, :]
+        draws = params[:, None, :] + np.einsum("skl,dl->sdk", root, noise[:, :k])
+        draws = clip_params(model, draws)
+
+        with np.errstate(all="ignore"):
+            curves[model] = (
+                idx,
+                evaluate(model, grid[None, :], params),
+                evaluate(model, grid[None, None, :], draws),
+            )
+
+    results = []
+    for sds in num_sds:
+        # BMR as a number of SDs around the fitted control response
+        bmr = sds * sd
+        bmd = np.full(n_series, np.nan)
+        bmr_level = np.full(n_series, np.nan)
+        bmdl = np.full(n_series, np.nan)
+        bmdu = np.full(n_series, np.nan)
+
+        for idx, fit_curves, draw_curves in curves.values():
+            with np.errstate(all="ignore"):
+                bmd[idx], bmr_level[idx] = bmd_from_curves(grid, fit_curves, bmr[idx])
+                draw_bmd, _ = bmd_from_curves(grid, draw_curves, bmr[idx, None])
+            # draws that never reach the BMR are placed at the end of the grid
+            draw_bmd = np.where(np.isnan(draw_bmd), grid[-1], draw_bmd)
+            bmdl[idx] = np.quantile(draw_bmd, 0.025, axis=1)
+            bmdu[idx] = np.quantile(draw_bmd, 0.975, axis=1)
+
+        # Pass flags
+        conv_pass = np.isfinite(bmd)
+        hd_pass = bmd <= fits["max.dose"]
+        with np.errstate(all="ignore"):
+            if log10_dose:
+                ci_pass = (bmdu - bmdl) < np.log10(ci_ratio)
+                ld_pass = bmd > fits["min.dose"] - np.log10(ld_factor)
+            else:
+                ci_pass = (bmdu / bmdl) < ci_ratio
+                ld_pass = bmd > fits["min.dose"] / ld_factor
+
+        results.append(
+            {
+                "bmr": bmr_level,
+                "bmd": bmd,
+                "bmdl": bmdl,
+                "bmdu": bmdu,
+                "conv.pass": conv_pass,
+                "hd.pass": hd_pass,
+                "CI.pass": ci_pass,
+                "ld.pass": ld_pass,
+                "all.pass": conv_pass & hd_pass & ci_pass & ld_pass,
+            }
+        )
+
+    return results
+
+
+def stack_series(dat: pl.DataFrame, value_cols: list, ctrl: str = "DMSO"):
+    """Stack every compound x value column into padded dose/response arrays.
+
+    Each compound is fitted with its own wells plus the control wells of the
+    plates it was tested on, or with the wells labelled {ctrl}_{compound}
+    when the controls were relabelled per compound (ap distances).
+    """
+    dat = dat.filter(pl.col("Metadata_well_type") != "JUMP_control")
+    compounds = dat.get_column("Metadata_Compound").to_numpy()
+    plates = dat.get_column("Metadata_Plate").to_numpy()
+    dose = dat.get_column("Metadata_Log10Conc").to_numpy().astype(float)
+    values = dat.select(value_cols).to_numpy().astype(float)
+
+    is_ctrl = compounds == ctrl
+    per_compound_ctrl = np.char.startswith(compounds.astype(str), f"{ctrl}_")
+    cmpd_list = np.unique(compounds[~is_ctrl & ~per_compound_ctrl])
+
+    rows = []
+    for cmpd in cmpd_list:
+        cmpd_rows = np.flatnonzero(compounds == cmpd)
+        ctrl_rows = np.flatnonzero(compounds == f"{ctrl}_{cmpd}")
+        if len(ctrl_rows) == 0:
+            ctrl_rows = np.flatnonzero(is_ctrl & np.isin(plates, plates[cmpd_rows]))
+        rows.append(np.concatenate([ctrl_rows, cmpd_rows]))
+
+    n_wells = max(len(r) for r in rows)
+    n_series = len(rows) * len(value_cols)
+    x = np.zeros((n_series, n_wells))
+    y = np.zeros((n_series, n_wells))
+    w = np.zeros((n_series, n_wells))
+    for i, r in enumerate(rows):
+        sl = slice(i * len(value_cols), (i + 1) * len(value_cols))
+        x[sl, : len(r)] = dose[r]
+        y[sl, : len(r)] = values[r].T
+        w[sl, : len(r)] = 1
+
+    # missing responses and doses (single-concentration compounds) are masked
+    # out
+    w[~np.isfinite(y) | ~np.isfinite(x)] = 0
+    y[w == 0] = 0
+    x[w == 0] = 0
+
+    series = pl.DataFrame(
+        {
+            "Metadata_Compound": np.repeat(cmpd_list, len(value_cols)),
+            "gene.id": np.tile(value_cols, len(cmpd_list)),
+        }
+    )
+    return series, x, y, w
+
+
+def stack_variants(dat: pl.DataFrame, value_cols: list):
+    """stack_series of every sweep variant of the data, padded to one width.
+
+    Series that are identical across variants have the same content key, so
+    fit_models fits them only once.
+    """
+    keys = [i for i in sweep_cols if i in dat.columns]
+    if not keys:
+        return stack_series(dat, value_cols)
+
+    parts = []
+    for part in dat.partition_by(keys, maintain_order=True):
+        series, x, y, w = stack_series(part, value_cols)
+        series = series.with_columns(
+            pl.lit(part.get_column(i)[0]).alias(i) for i in keys
+        )
+        parts.append((series, x, y, w))
+
+    n_wells = max(x.shape[1] for _, x, _, _ in parts)
+    series = pl.concat([p[0] for p in parts])
+    x, y, w = (
+        np.concatenate(
+            [np.pad(p[i], ((0, 0), (0, n_wells - p[i].shape[1]))) for p in parts]
+        )
+        for i in [1, 2, 3]
+    )
+    return series, x, y, w
+
+
+def series_keys(x: np.ndarray, y: np.ndarray, w: np.ndarray) -> list:
+    """Content hash of the doses and responses of every series."""
+    keys = []
+    for i in range(len(x)):
+        mask = w[i] > 0
+        h = hashlib.sha1(f"{fit_version}|".encode())
+        h.update(np.ascontiguousarray(x[i, mask]).tobytes())
+        h.update(np.ascontiguousarray(y[i, mask]).tobytes())
+        keys.append(h.hexdigest())
+    return keys
+
+
+def fit_models(
+    series: pl.DataFrame,
+    x: np.ndarray,
+    y: np.ndarray,
+    w: np.ndarray,
+    cache_dir: str,
+    n_jobs: int = -1,
+) -> pl.DataFrame:
+    """Fitted model table of every series, reusing fits cached in cache_dir.
+
+    Fits are keyed by the content of their series, so only series whose data
+    changed since the last run are refitted. Fits of series that are no
+    longer present are dropped from the cache.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = os.path.join(cache_dir, "fits.parquet")
+    keys = series_keys(x, y, w)
+
+    cached = pl.DataFrame()
+    n_cached = 0
+    if os.path.exists(cache_path):
+        cached = pl.read_parquet(cache_path)
+        n_cached = len(cached)
+        cached = cached.filter(pl.col("Metadata_FitKey").is_in(keys))
+    done = set(cached.get_column("Metadata_FitKey")) if len(cached) else set()
+    todo = {}
+    for i, key in enumerate(keys):
+        if key not in done:
+            todo.setdefault(key, i)
+    todo_keys = list(todo)
+    todo = np.array(list(todo.values()), dtype=int)
+
+    starts = range(0, len(todo), chunk_size)
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(fit_chunk)(
+            x[todo[i : i + chunk_size]],
+            y[todo[i : i + chunk_size]],
+            w[todo[i : i + chunk_size]],
+        )
+        for i in tqdm(starts)
+    )
+    if results:
+        res = {key: np.concatenate([r[key] for r in results]) for key in results[0]}
+        new = pl.DataFrame(
+            {
+                "Metadata_FitKey": todo_keys,
+                # None where no model was accepted
+                "mod.name": pl.Series(res.pop("mod.name").tolist(), dtype=pl.String),
+                **res,
+            }
+        )
+        cached = pl.concat([cached, new]) if len(cached) else new
+    if results or len(cached) < n_cached:
+        cached.write_parquet(cache_path)
+
+    fits = series.with_columns(pl.Series("Metadata_FitKey", keys)).join(
+        cached, on="Metadata_FitKey", how="left"
+    )
+    return fits.filter(pl.col("mod.name").is_not_null())
+
+
+def threshold_models(
+    fits: pl.DataFrame,
+    num_sds: list,
+    filt_var: str = "SDctrl",
+    log10_dose: bool = True,
+    n_jobs: int = -1,
+    seed: int = 0,
+) -> pl.DataFrame:
+    """BMDs of fitted models for one or several num_sds, without refitting.
+
+    The same standard normal draws are used for every series, so confidence
+    intervals do not depend on which other series are thresholded. Without
+    any fitted model, the table is empty.
+    """
+    num_sds = [float(i) for i in np.atleast_1d(num_sds)]
+    meta_cols = [i for i in fits.columns if i.startswith("Metadata")]
+    fit_cols = ["gene.id", "mod.name"] + param_names
+    fit_cols += ["SDres", "SDctrl", "AIC.model", "lof.p"]
+
+    def bmd_table(res: pl.DataFrame, sds: float) -> pl.DataFrame:
+        return (
+            pl.concat(
+                [fits.select(fit_cols), res, fits.select(meta_cols)], how="horizontal"
+            )
+            .with_columns(pl.lit(sds).alias("num_sds"))
+            .drop("Metadata_FitKey")
+        )
+
+    if fits.is_empty():
+        empty = pl.DataFrame(schema=bmd_schema)
+        return pl.concat([bmd_table(empty, sds) for sds in num_sds])
+
+    grid = np.linspace(0, 2 * fits.get_column("max.dose").max(), n_grid)
+    noise = np.random.default_rng(seed).standard_normal((n_draws, max_params))
+
+    arrays = {
+        col: fits.get_column(col).to_numpy()
+        for col in ["mod.name", "SDres", "SDctrl", "min.dose", "max.dose"] + param_names
+    }
+    arrays["cov"] = fits.get_column("cov").to_numpy()
+
+    starts = range(0, len(fits), chunk_size)
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(threshold_chunk)(
+            {col: arr[i : i + chunk_size] for col, arr in arrays.items()},
+            grid,
+            num_sds,
+            filt_var,
+            log10_dose,
+            noise,
+        )
+        for i in tqdm(starts)
+    )
+
+    bmds = []
+    for j, sds in enumerate(num_sds):
+        res = {key: np.concatenate([r[j][key] for r in results]) for key in bmd_schema}
+        bmds.append(bmd_table(pl.DataFrame(res, schema=bmd_schema), sds))
+
+    return pl.concat(bmds)
+
+
+def fit_curves(
+    input_path: str, output_path: str, cache_dir: str, n_jobs: int = -1
+) -> None:
+    """Fit models to every distance type of every compound."""
+    dat = pl.read_parquet(input_path)
+    dist_cols = [i for i in dat.columns if "Metadata" not in i]
+
+    series, x, y, w = stack_variants(dat, dist_cols)
+    fits = fit_models(series, x, y, w, cache_dir, n_jobs)
+    fits.write_parquet(output_path)
+
+
+def fit_curves_meta(
+    dat_path: str, output_path: str, meta_nm: str, cache_dir: str, n_jobs: int = -1
+) -> None:
+    """Fit models to a metadata column, e.g. cell counts."""
+    dat = pl.read_parquet(dat_path)
+
+    series, x, y, w = stack_series(dat, [meta_nm])
+    series = series.with_columns(pl.lit("cc").alias("gene.id"))
+    fits = fit_models(series, x, y, w, cache_dir, n_jobs)
+
+    # Merge OASIS IDs
+    meta_info = dat.select(["Metadata_Compound", "Metadata_OASIS_ID"]).unique()
+    fits = fits.join(meta_info, on="Metadata_Compound")
+    fits.write_parquet(output_path)
+
+
+def calculate_bmds(
+    fit_path: str,
+    output_path: str,
+    num_sds,
+    filt_var: str = "SDctrl",
+    n_jobs: int = -1,
+) -> None:
+    """Calculate BMDs from fitted models for one or several num_sds."""
+    fits = pl.read_parquet(fit_path)
+    bmd_res = threshold_models(fits, num_sds, filt_var=filt_var, n_jobs=n_jobs)
+    bmd_res.write_parquet(output_path)
@@ -1,11 +1,17 @@
 import polars as pl
 
+# columns of stacked parameter-sweep variants, fitted as separate series
+sweep_cols = ["Metadata_FiltThresh"]
 
-def filter_dist(thresh: int, dist: pl.DataFrame) -> pl.DataFrame:
-    meta_cols = [i for i in dist.columns if "Metadata" in i]
-    dist_meta = dist.select(meta_cols)
 
-    dist = dist.with_columns(
+def deviation_scores(dist: pl.DataFrame) -> pl.DataFrame:
+    """|log2(AD / MAD)| of every distance within its replicate group.
+
+    Wells at the group median score 0, so they are never filtered.
+    """
+    dist_cols = [i for i in dist.columns if "Metadata" not in i]
+
+    group = (
         pl.when(pl.col("Metadata_well_type") == "DMSO")
         .then(
             pl.concat_str(
@@ -18,111 +24,104 @@ def filter_dist(thresh: int, dist: pl.DataFrame) -> pl.DataFrame:
                 separator="_",
             )
         )
-        .alias("Metadata_Group")
-    )
-
-    # Get column types
-    dist_cols = [i for i in dist.columns if "Metadata" not in i]
-
-    dist_long = dist.unpivot(
-        index=["Metadata_Group", "Metadata_Plate", "Metadata_Well"],
-        on=dist_cols,
-        variable_name="Distance_type",
-        value_name="Distance",
     )
 
-    # Compute median and mad for each sample group
-    dist_median = (
-        dist.group_by("Metadata_Group")
-        .agg([pl.median(col).alias(col) for col in dist_cols])
-        .unpivot(
-            index="Metadata_Group",
-            on=dist_cols,
-            variable_name="Distance_type",
-            value_name="Median_distance",
+    # Absolute deviation from the group median
+    abs_dev = [
+        (pl.col(col) - pl.col(col).median().over("Metadata_Group"))
+        .abs()
+        .alias(f"Absolute_Deviation_{col}")
+        for col in dist_cols
+    ]
+
+    def score_col(col: str) -> pl.Expr:
+        # Compute deviation relative to MAD
+        ad = pl.col(f"Absolute_Deviation_{col}")
+        log2_ad_mad = (ad / ad.median().over("Metadata_Group")).log(base=2)
+
+        return (
+            pl.when(ad == 0)
+            .then(pl.lit(0.0))
+            .otherwise(log2_ad_mad.abs())
+            .alias(f"Deviation_Score_{col}")
         )
-    )
 
-    dist_mad = (
-        dist.group_by("Metadata_Group")
-        .agg(
-            [
-                pl.col(col)
-                .map_elements(
-                    lambda x: (x - x.median()).abs().median(), return_dtype=pl.Float64
-                )
-                .alias(col)
-                for col in dist_cols
-            ]
-        )
-        .unpivot(
-            index="Metadata_Group",
-            on=dist_cols,
-            variable_name="Distance_type",
-            value_name="MAD",
-        )
+    return (
+        dist.with_columns(group.alias("Metadata_Group"))
+        .with_columns(abs_dev)
+        .select(pl.all().exclude("^Absolute_Deviation_.*$"), *map(score_col, dist_cols))
+        .drop("Metadata_Group")
     )
 
-    # Compute deviation relative to MAD and filter
-    dist_long = (
-        dist_long.join(dist_median, on=["Metadata_Group", "Distance_type"])
-        .join(dist_mad, on=["Metadata_Group", "Distance_type"])
-        .with_columns(
-            (pl.col("Distance") - pl.col("Median_distance"))
-            .abs()
-            .alias("Absolute_Deviation")
-        )
-        .with_columns(
-            (pl.col("Absolute_Deviation") / pl.col("MAD"))
-            .log(base=2)
-            .alias("Log2_AD_MAD")
-        )
-        .with_columns(
-            pl.when(pl.col("Absolute_Deviation") == 0)
-            .then(pl.col("Distance"))
-            .when(pl.col("Log2_AD_MAD").abs() > thresh)
-            .then(pl.lit(None))
-            .otherwise(pl.col("Distance"))
-            .alias("Distance_filtered")
-        )
-    )
 
-    # Convert back to wide format
-    dist_filt = (
-        dist_long.select(
-            ["Metadata_Plate", "Metadata_Well", "Distance_type", "Distance_filtered"]
-        )
-        .pivot(
-            index=["Metadata_Plate", "Metadata_Well"],
-            on="Distance_type",
-            values="Distance_filtered",
+def apply_threshold(scored: pl.DataFrame, thresh: float) -> pl.DataFrame:
+    """Drop the wells with any distance deviating more than thresh."""
+    dist_cols = [
+        i for i in scored.columns if "Metadata" not in i and "Deviation_Score" not in i
+    ]
+    return (
+        scored.with_columns(
+            pl.when(pl.col(f"Deviation_Score_{col}") > thresh)
+            .then(pl.lit(None))
+            .otherwise(pl.col(col))
+            .alias(col)
+            for col in dist_cols
         )
-        .drop_nulls()
+        .select(pl.all().exclude("^Deviation_Score_.*$"))
+        .drop_nulls(dist_cols)
     )
 
-    # put metadata back
-    dist_filt = dist_meta.join(dist_filt, on=["Metadata_Plate", "Metadata_Well"])
 
-    return dist_filt
+def filter_dist(thresh: int, dist: pl.DataFrame) -> pl.DataFrame:
+    return apply_threshold(deviation_scores(dist), thresh)
 
 
 def compile_dist(
-    input_files: list, transform: str, thresh: int, output_path: str
+    input_files: list, prof_path: str, transform: str, thresh, output_path: str
 ) -> None:
-    dfs = []
-    for fp in input_files:
-        dat = pl.read_parquet(fp)
-        dfs.append(dat.unique())
+    """Wide table of distances, with outlier replicates filtered out.
+
+    thresh may be a list, in which case the deviations are scored once and
+    the table is filtered for every threshold, stacked with a
+    Metadata_FiltThresh column.
+    """
+    # Distance files are keyed by the row of the well in the profiles
+    meta = (
+        pl.scan_parquet(prof_path)
+        .select(pl.col("^Metadata.*$"))
+        .with_row_index("Metadata_WellKey")
+        .collect()
+    )
+    dfs = pl.concat(
+        [pl.read_parquet(fp) for fp in input_files], how="diagonal_relaxed"
+    ).with_columns(pl.col("Metadata_WellKey").cast(pl.UInt32))
+
+    # Extra metadata columns (e.g. the relabelled DMSO wells of ap) override
+    # the profile metadata and become part of the key
+    extra_cols = [
+        i
+        for i in dfs.columns
+        if "Metadata" in i and i not in ["Metadata_WellKey", "Metadata_Distance"]
+    ]
+    if extra_cols:
+        dfs = dfs.join(
+            meta.select(["Metadata_WellKey"] + extra_cols),
+            on="Metadata_WellKey",
+            suffix="_profile",
+        ).with_columns(
+            [pl.col(col).fill_null(pl.col(f"{col}_profile")) for col in extra_cols]
+        )
 
-    dfs = pl.concat(dfs, how="vertical")
-    meta_cols = [i for i in dfs.columns if "Metadata" in i and i != "Metadata_Distance"]
     df_wide = dfs.pivot(
         values="Distance",
-        index=meta_cols,
-        columns="Metadata_Distance",
+        index=["Metadata_WellKey"] + extra_cols,
+        on="Metadata_Distance",
         aggregate_function="median",
     )
 
+    # attach metadata once
+    df_wide = meta.drop(extra_cols).join(df_wide, on="Metadata_WellKey")
+
     # apply transform if specified
     if transform == "log10":
         dist_cols = [i for i in df_wide.columns if "Metadata" not in i]
@@ -142,6 +141,15 @@ def compile_dist(
         )
 
     # Filter out outlier replicates
-    df_wide_filt = filter_dist(thresh, df_wide)
+    if not isinstance(thresh, list):
+        df_wide_filt = filter_dist(thresh, df_wide)
+    else:
+        scored = deviation_scores(df_wide)
+        df_wide_filt = pl.concat(
+            apply_threshold(scored, i).with_columns(
+                pl.lit(i, dtype=pl.Float64).alias("Metadata_FiltThresh")
+            )
+            for i in thresh
+        )
 
     df_wide_filt.write_parquet(output_path)
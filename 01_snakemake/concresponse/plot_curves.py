@@ -0,0 +1,228 @@
+"""
+Concentration-response curve plots.
+
+Each compound's panel is rendered in a worker process and cached as a PNG
+keyed by a hash of everything drawn on it (fitted model, observations and
+PODs), so re-plotting only redraws compounds whose panel changed. The panels
+are then laid out 25 per page into one multi-page PDF.
+"""
+
+import hashlib
+import json
+import os
+import zlib
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+import matplotlib.pyplot as plt  # noqa: E402
+import numpy as np  # noqa: E402
+import polars as pl  # noqa: E402
+from joblib import Parallel, delayed  # noqa: E402
+from matplotlib.backends.backend_pdf import PdfPages  # noqa: E402
+from tqdm import tqdm  # noqa: E402
+
+from .bmd import evaluate, models, param_names  # noqa: E402
+
+n_cols = 5
+n_rows = 5
+pdf_w = 12
+pdf_h = 10
+panel_dpi = 150
+n_ap_dmso = 20
+plot_version = 1
+
+
+def dose_grid(dat: pl.DataFrame) -> np.ndarray:
+    highest_dose = dat.get_column("Metadata_Log10Conc").max()
+    highest_dose = round(highest_dose + 0.025 * highest_dose, 1)
+    return np.arange(0, highest_dose + 0.05, 0.1)
+
+
+def model_curve(pod: dict, dose: np.ndarray) -> np.ndarray:
+    names = models[pod["mod.name"]][1]
+    params = np.array([[pod[name] for name in names]], dtype=float)
+    return evaluate(pod["mod.name"], dose[None, :], params)[0]
+
+
+def panel_key(panel: dict) -> str:
+    """Hash of everything drawn on a panel."""
+    h = hashlib.sha1(f"{plot_version}|{n_cols}|{n_rows}|{panel_dpi}".encode())
+    h.update(
+        json.dumps(
+            {k: v for k, v in panel.items() if not isinstance(v, np.ndarray)},
+            sort_keys=True,
+            default=str,
+        ).encode()
+    )
+    for k in sorted(panel):
+        if isinstance(panel[k], np.ndarray):
+            h.update(np.ascontiguousarray(panel[k], dtype=float).tobytes())
+    return h.hexdigest()
+
+
+def render_panel(panel: dict, panel_path: str) -> None:
+    """Draw the observations, fitted curve and PODs of one compound."""
+    fig, ax = plt.subplots(figsize=(pdf_w / n_cols, pdf_h / n_rows))
+    ax.scatter(panel["obs_dose"], panel["obs"], s=4, color="black")
+    ax.plot(panel["dose"], panel["curve"], color="black", linewidth=0.8)
+
+    for key, style, color in [
+        ("bmdl", "--", "red"),
+        ("bmd", "-", "red"),
+        ("bmdu", "--", "red"),
+        ("cc_POD", "-", "blue"),
+    ]:
+        if panel.get(key) is not None and np.isfinite(panel[key]):
+            ax.axvline(panel[key], linestyle=style, color=color, linewidth=0.8)
+
+    ax.set_xlim(0, panel["dose"][-1])
+    ax.set_title(panel["title"], fontsize=6)
+    ax.tick_params(labelsize=5)
+    fig.tight_layout()
+    fig.savefig(panel_path, dpi=panel_dpi)
+    plt.close(fig)
+
+
+def plot_panels(panels: list, cache_dir: str, plot_path: str, n_jobs: int) -> None:
+    """Render the panels missing from the cache and assemble the PDF."""
+    os.makedirs(cache_dir, exist_ok=True)
+    panels = sorted(panels, key=lambda panel: panel["title"])
+    paths = [os.path.join(cache_dir, f"{panel_key(p)}.png") for p in panels]
+
+    todo = [
+        (p, path)
+        for p, path in zip(panels, paths, strict=True)
+        if not os.path.exists(path)
+    ]
+    Parallel(n_jobs=n_jobs)(
+        delayed(render_panel)(panel, path) for panel, path in tqdm(todo)
+    )
+
+    # drop panels of outdated fits
+    for fname in set(os.listdir(cache_dir)) - {os.path.basename(p) for p in paths}:
+        os.remove(os.path.join(cache_dir, fname))
+
+    n_per_page = n_cols * n_rows
+    with PdfPages(plot_path) as pdf:
+        for start in range(0, len(paths), n_per_page):
+            fig = plt.figure(figsize=(pdf_w, pdf_h))
+            for i, path in enumerate(paths[start : start + n_per_page]):
+                ax = fig.add_subplot(n_rows, n_cols, i + 1)
+                ax.imshow(plt.imread(path))
+                ax.axis("off")
+            fig.subplots_adjust(0, 0, 1, 1, 0, 0)
+            pdf.savefig(fig, dpi=panel_dpi)
+            plt.close(fig)
+
+
+def plot_cp_curves(
+    pod_path: str,
+    dist_path: str,
+    plot_path: str,
+    cache_dir: str,
+    n_jobs: int = -1,
+) -> None:
+    """Plot the curve that set the POD of each compound."""
+    dat = pl.read_parquet(dist_path).filter(
+        pl.col("Metadata_well_type") != "JUMP_control"
+    )
+    dose = dose_grid(dat)
+
+    # one curve per compound
+    pods = pl.read_parquet(pod_path).unique(
+        "Metadata_Compound", keep="first", maintain_order=True
+    )
+    compounds = dat.get_column("Metadata_Compound").to_numpy()
+    plates = dat.get_column("Metadata_Plate").to_numpy()
+    log_conc = dat.get_column("Metadata_Log10Conc").to_numpy()
+
+    panels = []
+    for pod in pods.iter_rows(named=True):
+        cmpd = pod["Metadata_Compound"]
+        cmpd_rows = np.flatnonzero(compounds == cmpd)
+        ctrl_rows = np.flatnonzero(compounds == f"DMSO_{cmpd}")
+        if len(ctrl_rows) > 0:
+            # seeded by compound so that panels do not depend on each other
+            rng = np.random.default_rng(zlib.crc32(cmpd.encode()))
+            ctrl_rows = rng.choice(
+                ctrl_rows, min(n_ap_dmso, len(ctrl_rows)), replace=False
+            )
+        else:
+            ctrl_rows = np.flatnonzero(
+                (compounds == "DMSO") & np.isin(plates, plates[cmpd_rows])
+            )
+        rows = np.concatenate([ctrl_rows, cmpd_rows])
+        cc_pod = pod["cc_POD"] if pod["cc_POD"] != 9999 else None
+
+        panels.append(
+            {
+                "title": f"{cmpd} ({pod['gene.id']})",
+                "model": pod["mod.name"],
+                "params": [pod[name] for name in param_names],
+                "bmdl": pod["bmdl"],
+                "bmd": pod["bmd"],
+                "bmdu": pod["bmdu"],
+                "cc_POD": cc_pod,
+                "dose": dose,
+                "curve": model_curve(pod, dose),
+                "obs_dose": log_conc[rows],
+                "obs": dat.get_column(pod["gene.id"]).to_numpy()[rows],
+            }
+        )
+
+    plot_panels(panels, cache_dir, plot_path, n_jobs)
+
+
+def plot_meta_curves(
+    cc_pod_path: str,
+    dat_path: str,
+    plot_path: str,
+    meta_nm: str,
+    cache_dir: str,
+    n_jobs: int = -1,
+) -> None:
+    """Plot the curves fitted to a metadata column, e.g. cell counts."""
+    dat = pl.read_parquet(dat_path).filter(
+        pl.col("Metadata_well_type") != "JUMP_control"
+    )
+    dose = dose_grid(dat)
+
+    pods = pl.read_parquet(cc_pod_path).unique(
+        "Metadata_Compound", keep="first", maintain_order=True
+    )
+    compounds = dat.get_column("Metadata_Compound").to_numpy()
+    plates = dat.get_column("Metadata_Plate").to_numpy()
+    log_conc = dat.get_column("Metadata_Log10Conc").to_numpy()
+    values = dat.get_column(meta_nm).to_numpy()
+
+    panels = []
+    for pod in pods.iter_rows(named=True):
+        cmpd = pod["Metadata_Compound"]
+        cmpd_rows = np.flatnonzero(compounds == cmpd)
+        ctrl_rows = np.flatnonzero(
+            (compounds == "DMSO") & np.isin(plates, plates[cmpd_rows])
+        )
+        rows = np.concatenate([ctrl_rows, cmpd_rows])
+
+        # PODs are only drawn for passing fits
+        lines = {
+            key: pod[key] if pod["all.pass"] else None
+            for key in ["bmdl", "bmd", "bmdu"]
+        }
+
+        panels.append(
+            {
+                "title": cmpd,
+                "model": pod["mod.name"],
+                "params": [pod[name] for name in param_names],
+                **lines,
+                "dose": dose,
+                "curve": model_curve(pod, dose),
+                "obs_dose": log_conc[rows],
+                "obs": values[rows],
+            }
+        )
+
+    plot_panels(panels, cache_dir, plot_path, n_jobs)
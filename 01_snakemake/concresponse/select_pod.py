@@ -0,0 +1,68 @@
+import polars as pl
+
+from .compile_dist import sweep_cols
+
+pod_cols = [
+    "gene.id",
+    "mod.name",
+    "bmd",
+    "b",
+    "c",
+    "d",
+    "e",
+    "f",
+    "bmdl",
+    "bmdu",
+    "bmr",
+    "lof.p",
+]
+
+
+def select_pod(
+    bmd_path: str, cc_pod_path: str, pod_path: str, keep_keys: bool = False
+) -> None:
+    """Select the POD of each compound as the minimum BMD across distances.
+
+    num_sds and sweep columns are only kept when they hold several values or
+    keep_keys is set, so that a single variant has the pods.parquet schema.
+    """
+    bmd = pl.read_parquet(bmd_path)
+
+    # BMDs calculated for several num_sds or sweep variants are selected
+    # separately
+    keys = ["Metadata_Compound"] + [
+        i for i in sweep_cols + ["num_sds"] if i in bmd.columns
+    ]
+
+    # The SD of residuals must be less than 3 times the SD of the controls
+    min_bmd = (
+        bmd.filter(pl.col("all.pass") & (pl.col("SDres") < 3 * pl.col("SDctrl")))
+        .filter(pl.col("bmd") == pl.col("bmd").min().over(keys))
+        .select(keys + pod_cols)
+    )
+
+    # Cell count PODs, set to 9999 when the fit did not pass
+    cc = pl.read_parquet(cc_pod_path)
+    cc_keys = [i for i in keys if i in cc.columns]
+    cc = cc.select(
+        cc_keys
+        + [
+            pl.when(pl.col("all.pass"))
+            .then(pl.col("bmd"))
+            .otherwise(9999)
+            .alias("cc_POD")
+        ]
+    )
+
+    pods = (
+        min_bmd.join(cc, on=cc_keys)
+        .with_columns((pl.col("bmd") < pl.col("cc_POD")).alias("PAC_below_cc_POD"))
+        .sort(keys)
+    )
+    variant_keys = [
+        i for i in keys[1:] if keep_keys or bmd.get_column(i).n_unique() > 1
+    ]
+    pods = pods.select(
+        ["Metadata_Compound"] + pod_cols + ["cc_POD", "PAC_below_cc_POD"] + variant_keys
+    )
+    pods.write_parquet(pod_path)
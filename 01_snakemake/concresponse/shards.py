@@ -0,0 +1,88 @@
+"""
+Scatter of the R distance methods into shard jobs.
+
+GMD is one shard, CMD one shard per group of feature categories, so that
+Snakemake schedules the categories as separate jobs and reruns only failed
+shards. The threads of a shard are its CMD workers (one per category) and
+its memory is estimated from the row x feature count of the profiles, read
+from the parquet metadata.
+"""
+
+import errno
+import glob
+import hashlib
+import math
+import os
+
+import polars as pl
+
+# MB of an R session with the distance packages loaded
+r_session_mb = 512
+# copies of the full feature matrix held by an R process (data frame,
+# matrix, scaled PCA input); CMD workers hold the exported data frame and
+# matrix, and their category PCA is small in comparison
+matrix_copies = {"gmd": 6, "cmd": 2}
+
+
+def distance_shards(methods: list, categories: list, group_size: int = 1) -> dict:
+    """{method: {shard: categories}} of the R distance methods."""
+    shards = {}
+    for method in methods:
+        if method == "gmd":
+            shards[method] = {"all": categories}
+        elif method == "cmd":
+            groups = [
+                categories[i : i + group_size]
+                for i in range(0, len(categories), group_size)
+            ]
+            shards[method] = {"+".join(group): group for group in groups}
+        else:
+            raise ValueError(f"Unknown R distance method: {method}")
+    return shards
+
+
+def frozen_models(store_dir: str, method: str, categories: list) -> str:
+    """Fingerprint of the stored models a frozen-model shard may reuse.
+
+    Frozen models make the distances depend on the history of the store,
+    so the fingerprint goes into the stage cache key of the shard.
+    """
+    model_dirs = ["gmd"] if method == "gmd" else categories
+    h = hashlib.sha256()
+    for category in model_dirs:
+        for path in sorted(
+            glob.glob(os.path.join(store_dir, method, category, "model_*.rds"))
+        ):
+            h.update(os.path.relpath(path, store_dir).encode())
+    return h.hexdigest()
+
+
+def shard_threads(method: str, categories: list) -> int:
+    """CMD runs one worker per category, GMD is single-threaded."""
+    return len(categories) if method == "cmd" else 1
+
+
+def profile_shape(prof_path: str) -> tuple:
+    """Rows and feature columns of a parquet, without reading its data.
+
+    Raises FileNotFoundError until the profiles exist, so that Snakemake
+    evaluates the resources once the upstream jobs have finished.
+    """
+    if not os.path.exists(prof_path):
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), prof_path)
+
+    profiles = pl.scan_parquet(prof_path)
+    cols = profiles.collect_schema().names()
+    n_rows = profiles.select(pl.len()).collect().item()
+    return n_rows, len([i for i in cols if "Metadata" not in i])
+
+
+def shard_mem_mb(prof_path: str, method: str, threads: int, attempt: int = 1) -> int:
+    """Memory estimate of a shard, scaled up on every retry."""
+    n_rows, n_feats = profile_shape(prof_path)
+    matrix_mb = n_rows * n_feats * 8 / 1e6
+
+    # the main process and one process per CMD worker
+    n_procs = 1 + threads if method == "cmd" else 1
+    mem_mb = n_procs * (r_session_mb + matrix_copies[method] * matrix_mb)
+    return math.ceil(mem_mb * attempt)
@@ -0,0 +1,93 @@
+"""
+Comparison table of parameter-sweep variants.
+
+Every (outlier_feat_thresh, cover_var) variant has its own profiles and
+distances; the filtering thresholds and num_sds values are stacked inside
+its distance and POD tables. Each variant is summarised into one row per
+(filt_thresh, num_sds) and the rows of all variants are collected into one
+table.
+"""
+
+import polars as pl
+
+from .compile_dist import sweep_cols
+
+param_cols = ["outlier_feat_thresh", "cover_var", "filt_thresh", "num_sds"]
+summary_cols = [
+    "n_features",
+    "n_wells",
+    "n_compounds",
+    "n_pods",
+    "n_pods_below_cc_POD",
+    "median_pod",
+    "top_distance",
+]
+
+
+def summarize_variant(
+    prof_path: str, dist_path: str, pod_path: str, params: dict, output_path: str
+) -> None:
+    """Features, retained wells and PODs of one variant of the sweep.
+
+    Parameters
+    ----------
+    prof_path : str
+        Filepath for the profiles of the variant.
+    dist_path : str
+        Filepath for the compiled distances, stacked over filt_thresh.
+    pod_path : str
+        Filepath for the PODs, stacked over filt_thresh and num_sds.
+    params : dict
+        Swept parameters that define the variant, added as columns.
+    output_path : str
+        Filepath for the summary.
+
+    """
+    prof_cols = pl.scan_parquet(prof_path).collect_schema().names()
+    n_features = len([i for i in prof_cols if "Metadata" not in i])
+
+    dist = pl.scan_parquet(dist_path)
+    keys = [i for i in sweep_cols if i in dist.collect_schema().names()]
+    dist_summary = (
+        dist.group_by(keys)
+        .agg(
+            pl.len().alias("n_wells"),
+            pl.col("Metadata_Compound")
+            .filter(pl.col("Metadata_well_type") != "DMSO")
+            .n_unique()
+            .alias("n_compounds"),
+        )
+        .collect()
+    )
+
+    pod_summary = (
+        pl.scan_parquet(pod_path)
+        .group_by(keys + ["num_sds"])
+        .agg(
+            pl.len().alias("n_pods"),
+            pl.col("PAC_below_cc_POD").sum().alias("n_pods_below_cc_POD"),
+            pl.col("bmd").median().alias("median_pod"),
+            pl.col("gene.id").mode().first().alias("top_distance"),
+        )
+        .collect()
+    )
+
+    summary = (
+        dist_summary.join(pod_summary, on=keys, how="left")
+        .with_columns(
+            pl.col("n_pods", "n_pods_below_cc_POD").fill_null(0),
+            pl.lit(n_features).alias("n_features"),
+            *[pl.lit(value).alias(key) for key, value in params.items()],
+        )
+        .rename({"Metadata_FiltThresh": "filt_thresh"}, strict=False)
+    )
+    summary.write_parquet(output_path)
+
+
+def collect_sweep(summary_paths: list, output_path: str) -> None:
+    """One comparison table of all variants of the sweep."""
+    summary = pl.concat(
+        [pl.read_parquet(i) for i in summary_paths], how="diagonal_relaxed"
+    )
+    params = [i for i in param_cols if i in summary.columns]
+    summary.select(params + summary_cols).sort(params).write_parquet(output_path)
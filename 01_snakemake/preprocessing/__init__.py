@@ -1,6 +1,31 @@
-from . import io as io
-from . import normalize as normalize
-from . import outliers as outliers
-from . import stats as stats
-from . import transform as transform
-from .feature_selection import select_features as select_features
+"""Profile preprocessing: normalization, outliers and feature selection."""
+
+import importlib
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from . import io as io
+    from . import normalize as normalize
+    from . import outliers as outliers
+    from . import stats as stats
+    from . import transform as transform
+    from .feature_selection import select_features as select_features
+
+submodules = ["io", "normalize", "outliers", "stats", "transform"]
+# attributes re-exported from a submodule
+submodule_attrs = {"select_features": "feature_selection"}
+
+
+# submodules are imported on first access (PEP 562), so that parsing the
+# rules does not import their dependencies
+def __getattr__(name: str):
+    if name in submodules:
+        return importlib.import_module(f".{name}", __name__)
+    if name in submodule_attrs:
+        module = importlib.import_module(f".{submodule_attrs[name]}", __name__)
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> list:
+    return sorted([*globals(), *submodules, *submodule_attrs])
@@ -1,6 +1,5 @@
 import numpy as np
 import pandas as pd
-import pycytominer
 
 from preprocessing.io import merge_parquet, split_parquet
 
@@ -35,6 +34,8 @@ def mad(variant_feats_path, neg_stats_path, normalized_path):
 
 
 def spherize(input_path, normalized_path):
+    import pycytominer
+
     dframe = pd.read_parquet(input_path)
     dframe = dframe.sample(frac=1.0)
     dframe = pycytominer.normalize(
@@ -2,7 +2,6 @@ import logging
 
 import numpy as np
 import pandas as pd
-from sklearn.impute import KNNImputer, SimpleImputer
 
 from preprocessing.io import merge_parquet, split_parquet
 
@@ -43,6 +42,8 @@ def clip_cols(normalized_path, outlier_path, clip_value, clip_outliers_path):
 
 def impute_median(normalized_path, outlier_path, impute_median_path):
     """Impute outliers using median"""
+    from sklearn.impute import SimpleImputer
+
     meta, vals, features = split_parquet(normalized_path)
     mask = pd.read_parquet(outlier_path)[features].values
     vals[mask] = np.nan
@@ -55,6 +56,8 @@ def impute_median(normalized_path, outlier_path, impute_median_path):
 
 def impute_knn(normalized_path, outlier_path, impute_knn_path):
     """Impute outliers using kNN."""
+    from sklearn.impute import KNNImputer
+
     meta, vals, features = split_parquet(normalized_path)
     mask = pd.read_parquet(outlier_path)[features].values
     vals[mask] = np.nan
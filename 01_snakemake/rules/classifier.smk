@@ -18,8 +18,11 @@ rule toxcast_cellbased_binary:
         f"inputs/annotations/toxcast_cellbased_binary.parquet",
     output:
         f"outputs/{features}/{name}/classifier_results/toxcast_cellbased_binary_predictions.parquet",
+    params:
+        parts=f"outputs/{features}/{name}/classifier_results/toxcast_cellbased_binary_parts",
+    threads: workflow.cores
     run:
-        cl.classify.predict_binary(*input, *output)
+        cl.classify.predict_binary(*input, *output, params.parts, threads)
 
 
 rule toxcast_cellfree_binary:
@@ -28,8 +31,11 @@ rule toxcast_cellfree_binary:
         f"inputs/annotations/toxcast_cellfree_binary.parquet",
     output:
         f"outputs/{features}/{name}/classifier_results/toxcast_cellfree_binary_predictions.parquet",
+    params:
+        parts=f"outputs/{features}/{name}/classifier_results/toxcast_cellfree_binary_parts",
+    threads: workflow.cores
     run:
-        cl.classify.predict_binary(*input, *output)
+        cl.classify.predict_binary(*input, *output, params.parts, threads)
 
 
 rule toxcast_cytotox_binary:
@@ -38,5 +44,52 @@ rule toxcast_cytotox_binary:
         f"inputs/annotations/toxcast_cytotox_binary.parquet",
     output:
         f"outputs/{features}/{name}/classifier_results/toxcast_cytotox_binary_predictions.parquet",
+    params:
+        parts=f"outputs/{features}/{name}/classifier_results/toxcast_cytotox_binary_parts",
+    threads: workflow.cores
     run:
-        cl.classify.predict_binary(*input, *output)
\ No newline at end of file
+        cl.classify.predict_binary(*input, *output, params.parts, threads)
+
+
+rule toxcast_binary_null:
+    input:
+        f"outputs/{features}/{name}/aggregated_profiles/agg.parquet",
+        f"inputs/annotations/toxcast_{{dataset}}_binary.parquet",
+    output:
+        f"outputs/{features}/{name}/classifier_results/toxcast_{{dataset}}_binary_null.parquet",
+    params:
+        n_perms=config["clf_n_perms"],
+        seed=config["clf_perm_seed"],
+    threads: workflow.cores
+    run:
+        cl.classify.predict_binary_null(
+            *input, *output, params.n_perms, params.seed, threads
+        )
+
+
+rule toxcast_binary_metrics:
+    input:
+        f"outputs/{features}/{name}/classifier_results/toxcast_{{dataset}}_binary_predictions.parquet",
+    output:
+        f"outputs/{features}/{name}/classifier_results/toxcast_{{dataset}}_binary_metrics.parquet",
+    params:
+        n_boot=config["clf_n_boot"],
+    threads: workflow.cores
+    run:
+        cl.metrics.compute_metrics(*input, *output, params.n_boot, n_jobs=threads)
+
+
+rule call_hits:
+    input:
+        f"outputs/{features}/{name}/distances/distances.parquet",
+    output:
+        f"outputs/{features}/{name}/hits/hit_matrix.parquet",
+        f"outputs/{features}/{name}/hits/hit_stats.parquet",
+    params:
+        method=config["hit_method"],
+        alpha=config["hit_alpha"],
+        correction=config["hit_correction"],
+    run:
+        cl.hitcalls.call_hits(
+            *input, *output, params.method, params.alpha, params.correction
+        )
@@ -1,13 +1,15 @@
 # Imports
 import os
 import preprocessing as pp
-#import classifier as cl
+import classifier as cl
 import concresponse as cr
 import visualize as vs
+import stagecache as stc
 
 features = config["features"]
 scenario = config["workflow"]
 name = config["name"]
+stage_cache = config["stage_cache"]
 
 # Rules
 rule compute_negcon_stats:
@@ -16,7 +18,9 @@ rule compute_negcon_stats:
     output:
         f"outputs/{features}/{name}/profiles/neg_stats.parquet",
     run:
-        pp.stats.compute_negcon_stats(*input, *output)
+        with stc.cache.stage(stage_cache, rule, input, output, [pp.stats]) as hit:
+            if not hit:
+                pp.stats.compute_negcon_stats(*input, *output)
 
 
 rule select_variant_feats:
@@ -26,7 +30,9 @@ rule select_variant_feats:
     output:
         f"outputs/{features}/{name}/profiles/variant_feats.parquet",
     run:
-        pp.stats.select_variant_features(*input, *output)
+        with stc.cache.stage(stage_cache, rule, input, output, [pp.stats]) as hit:
+            if not hit:
+                pp.stats.select_variant_features(*input, *output)
 
 
 rule compute_norm_stats:
@@ -35,7 +41,9 @@ rule compute_norm_stats:
     output:
         f"outputs/{features}/{name}/profiles/norm_stats.parquet",
     run:
-        pp.stats.compute_stats(*input, *output)
+        with stc.cache.stage(stage_cache, rule, input, output, [pp.stats]) as hit:
+            if not hit:
+                pp.stats.compute_stats(*input, *output)
 
 
 rule iqr_outliers:
@@ -44,5 +52,11 @@ rule iqr_outliers:
         f"outputs/{features}/{name}/profiles/norm_stats.parquet",
     output:
         f"outputs/{features}/{name}/profiles/outliers.parquet",
+    params:
+        iqr_scale=config["iqr_scale"],
     run:
-        pp.outliers.iqr(config["iqr_scale"], *input, *output)
\ No newline at end of file
+        with stc.cache.stage(
+            stage_cache, rule, input, output, [pp.outliers], iqr_scale=params.iqr_scale
+        ) as hit:
+            if not hit:
+                pp.outliers.iqr(params.iqr_scale, *input, *output)
\ No newline at end of file
@@ -1,24 +1,61 @@
 features = config["features"]
 scenario = config["workflow"]
 name = config["name"]
+r_scripts = [
+    f"concresponse/{i}.R"
+    for i in ["compute_distances", "gmd_functions", "cmd_functions", "store_functions"]
+]
 
-rule compute_distances_R:
+# One job per R distance method, and per group of categories for CMD; the
+# shards are gathered by compile_distances
+distance_shards = cr.shards.distance_shards(
+    config["distances_R"], config["categories"], config["cmd_category_group_size"]
+)
+shard_files = [
+    f"outputs/{features}/{name}/distances/shards/{method}/{shard}.parquet"
+    for method, shards in distance_shards.items()
+    for shard in shards
+]
+
+rule compute_distance_shard:
     input:
         f"outputs/{features}/{name}/profiles/{scenario}.parquet",
     output:
-        expand("outputs/{features}/{name}/distances/{method}.parquet", method=config["distances_R"], features=config["features"], scenario=config["workflow"], name=config["name"]),
+        f"outputs/{features}/{name}/distances/shards/{{method}}/{{shard}}.parquet",
+    wildcard_constraints:
+        method="|".join(config["distances_R"]),
+        shard=r"[^/]+",
     params:
         cover_var=config["cover_var"],
         treatment=config["treatment"],
-        categories=",".join(config["categories"]),
-        distances=config["distances_R"],
-    shell:
-        """
-        for method in {params.distances}; do
-            method_name=$(echo $method | tr -d '[],"')
-            Rscript concresponse/compute_distances.R {input} outputs/{features}/{name}/distances/${{method_name}}.parquet {params.cover_var} {params.treatment} {params.categories} ${{method_name}}
-        done
-        """
+        freeze=config["dist_freeze_model"],
+        categories=lambda wildcards: distance_shards[wildcards.method][wildcards.shard],
+        store=f"outputs/{features}/{name}/distances/store",
+    threads: lambda wildcards: cr.shards.shard_threads(wildcards.method, distance_shards[wildcards.method][wildcards.shard])
+    resources:
+        mem_mb=lambda wildcards, input, threads, attempt: cr.shards.shard_mem_mb(input[0], wildcards.method, threads, attempt),
+    run:
+        with stc.cache.stage(
+            stage_cache,
+            rule,
+            input,
+            output,
+            r_scripts,
+            method=wildcards.method,
+            cover_var=params.cover_var,
+            treatment=params.treatment,
+            categories=params.categories,
+            frozen_models=(
+                cr.shards.frozen_models(params.store, wildcards.method, params.categories)
+                if params.freeze
+                else None
+            ),
+        ) as hit:
+            if not hit:
+                categories = ",".join(params.categories)
+                shell(
+                    "Rscript concresponse/compute_distances.R {input} {output} {params.cover_var} {params.treatment} {categories} {wildcards.method} {params.store} {threads} {params.freeze}"
+                )
 
 rule compute_distances_python:
     input:
@@ -27,46 +64,104 @@ rule compute_distances_python:
         expand("outputs/{features}/{name}/distances/{method}.parquet", method=config["distances_python"], features=config["features"], name=config["name"]),
     params:
         distances=config["distances_python"],
+        null_cache=f"outputs/{features}/{name}/distances/ap_null_cache",
+        null_size=config["ap_null_size"],
+        seed=config["ap_seed"],
+    threads: 10
     run:
-        for method in config["distances_python"]:
-            output_file = f"outputs/{features}/{name}/distances/{method}.parquet"
-            cr.ap.calculate_distances(input[0], output_file, method)
+        with stc.cache.stage(
+            stage_cache,
+            rule,
+            input,
+            output,
+            [cr.ap],
+            distances=params.distances,
+            null_size=params.null_size,
+            seed=params.seed,
+        ) as hit:
+            if not hit:
+                for method in config["distances_python"]:
+                    output_file = f"outputs/{features}/{name}/distances/{method}.parquet"
+                    cr.ap.calculate_distances(
+                        input[0],
+                        output_file,
+                        method,
+                        params.null_cache,
+                        threads,
+                        params.null_size,
+                        params.seed,
+                    )
 
 
-distances = config["distances_R"] + config["distances_python"]
 rule compile_distances:
     input:
-        [f"outputs/{features}/{name}/distances/{method}.parquet" for method in distances],
+        dist=shard_files
+        + [f"outputs/{features}/{name}/distances/{method}.parquet" for method in config["distances_python"]],
+        prof=f"outputs/{features}/{name}/profiles/{scenario}.parquet",
     output:
         f"outputs/{features}/{name}/distances/distances.parquet",
     params:
         transform=config["dist_transform"],
         filt_thresh=config["filt_thresh"],
     run:
-        input_files = list(input)
-        cr.compile_dist.compile_dist(input_files, params.transform, params.filt_thresh, *output)
+        with stc.cache.stage(
+            stage_cache,
+            rule,
+            input,
+            output,
+            [cr.compile_dist],
+            transform=params.transform,
+            filt_thresh=params.filt_thresh,
+        ) as hit:
+            if not hit:
+                input_files = list(input.dist)
+                cr.compile_dist.compile_dist(input_files, input.prof, params.transform, params.filt_thresh, *output)
 
 
 rule fit_curves:
     input:
         f"outputs/{features}/{name}/distances/distances.parquet",
     output:
-        f"outputs/{features}/{name}/curves/bmds.parquet",
+        f"outputs/{features}/{name}/curves/models.parquet",
     params:
-        num_sds = config['num_sds']
-    shell:
-        "Rscript concresponse/fit_curves.R {input} {output} {params.num_sds}"
+        cache=f"outputs/{features}/{name}/curves/fit_cache",
+    threads: 10
+    run:
+        cr.bmd.fit_curves(input[0], output[0], params.cache, threads)
 
 rule fit_curves_cc:
     input:
         f"outputs/{features}/{name}/profiles/{scenario}.parquet",
     output:
-        f"outputs/{features}/{name}/curves/ccpods.parquet",
+        f"outputs/{features}/{name}/curves/ccmodels.parquet",
     params:
-        num_sds = config['num_sds'],
+        cache=f"outputs/{features}/{name}/curves/fit_cache_cc",
         meta_nm = "Metadata_Count_Cells"
-    shell:
-        "Rscript concresponse/fit_curves_meta.R {input} {output} {params.num_sds} {params.meta_nm}"
+    threads: 10
+    run:
+        cr.bmd.fit_curves_meta(input[0], output[0], params.meta_nm, params.cache, threads)
+
+rule calculate_bmds:
+    input:
+        f"outputs/{features}/{name}/curves/models.parquet",
+    output:
+        f"outputs/{features}/{name}/curves/bmds.parquet",
+    params:
+        num_sds = config['num_sds']
+    threads: 10
+    run:
+        cr.bmd.calculate_bmds(input[0], output[0], params.num_sds, "SDres", threads)
+
+rule calculate_bmds_cc:
+    input:
+        f"outputs/{features}/{name}/curves/ccmodels.parquet",
+    output:
+        f"outputs/{features}/{name}/curves/ccpods.parquet",
+    params:
+        num_sds = config['num_sds']
+    threads: 10
+    run:
+        cr.bmd.calculate_bmds(input[0], output[0], params.num_sds, "SDctrl", threads)
 
 rule select_pod:
     input:
@@ -74,8 +169,8 @@ rule select_pod:
         f"outputs/{features}/{name}/curves/ccpods.parquet",
     output:
         f"outputs/{features}/{name}/curves/pods.parquet",
-    shell:
-        "Rscript concresponse/select_pod.R {input} {output}"
+    run:
+        cr.select_pod.select_pod(input[0], input[1], output[0])
 
 
 rule plot_cc_curve_fits:
@@ -85,17 +180,21 @@ rule plot_cc_curve_fits:
     output:
         f"outputs/{features}/{name}/curves/plots/cc_plots.pdf",
     params:
-        meta_nm = "Metadata_Count_Cells"
-    shell:
-        "Rscript concresponse/plot_meta_curve.R {input} {output} {params.meta_nm}"
+        meta_nm = "Metadata_Count_Cells",
+        cache=f"outputs/{features}/{name}/curves/plots/cc_panels",
+    threads: 10
+    run:
+        cr.plot_curves.plot_meta_curves(input[0], input[1], output[0], params.meta_nm, params.cache, threads)
 
 
 rule plot_cp_curve_fits:
     input:
         f"outputs/{features}/{name}/curves/pods.parquet",
-        f"outputs/{features}/{name}/curves/ccpods.parquet",
         f"outputs/{features}/{name}/distances/distances.parquet",
     output:
         f"outputs/{features}/{name}/curves/plots/cp_plots.pdf",
-    shell:
-        "Rscript concresponse/plot_cp_curve.R {input} {output}"
\ No newline at end of file
+    params:
+        cache=f"outputs/{features}/{name}/curves/plots/cp_panels",
+    threads: 10
+    run:
+        cr.plot_curves.plot_cp_curves(input[0], input[1], output[0], params.cache, threads)
\ No newline at end of file
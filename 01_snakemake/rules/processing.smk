@@ -12,7 +12,9 @@ rule mad_normalize:
     output:
         f"outputs/{features}/{name}/profiles/mad.parquet",
     run:
-        pp.normalize.mad(*input, *output)
+        with stc.cache.stage(stage_cache, rule, input, output, [pp.normalize]) as hit:
+            if not hit:
+                pp.normalize.mad(*input, *output)
 
 
 rule int:
@@ -21,7 +23,9 @@ rule int:
     output:
         f"outputs/{features}/{name}/profiles/{{pipeline}}_int.parquet",
     run:
-        pp.select_features(*input, *output)
+        with stc.cache.stage(stage_cache, rule, input, output, [pp.select_features]) as hit:
+            if not hit:
+                pp.select_features(*input, *output)
 
 
 rule featselect:
@@ -32,4 +36,13 @@ rule featselect:
     params:
         outlier_thresh=config["outlier_feat_thresh"],
     run:
-        pp.select_features(*input, params.outlier_thresh, *output)
\ No newline at end of file
+        with stc.cache.stage(
+            stage_cache,
+            rule,
+            input,
+            output,
+            [pp.select_features],
+            outlier_thresh=params.outlier_thresh,
+        ) as hit:
+            if not hit:
+                pp.select_features(*input, params.outlier_thresh, *output)
\ No newline at end of file
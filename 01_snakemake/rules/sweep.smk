@@ -0,0 +1,226 @@
+import json
+
+features = config["features"]
+scenario = config["workflow"]
+name = config["name"]
+
+# Parameter sweep: every combination of outlier_feat_thresh and cover_var is
+# a directory of its own, stages upstream of a parameter are shared by all
+# its values. filt_thresh and num_sds are evaluated in a single pass.
+sweep_name = config["sweep_name"]
+sweep_keys = ["outlier_feat_thresh", "cover_var", "filt_thresh", "num_sds"]
+unsupported = sorted(set(config["sweep_grid"]) - set(sweep_keys))
+if unsupported:
+    raise ValueError(
+        f"Unsupported sweep_grid keys {unsupported}, the sweep varies {sweep_keys}"
+    )
+sweep_grid = {
+    key: config["sweep_grid"].get(key, [config[key]]) for key in sweep_keys
+}
+sweep_dir = f"outputs/{features}/sweep_{sweep_name}"
+prof_dir = sweep_dir + "/outlier_feat_thresh~{oft}"
+dist_dir = prof_dir + "/cover_var~{cv}"
+
+wildcard_constraints:
+    oft=r"[^/~]+",
+    cv=r"[^/~]+",
+
+rule sweep_featselect:
+    input:
+        f"outputs/{features}/{name}/profiles/{scenario.removesuffix('_featselect')}.parquet",
+    output:
+        f"{prof_dir}/profiles/{scenario}.parquet",
+    run:
+        outlier_thresh = json.loads(wildcards.oft)
+        with stc.cache.stage(
+            stage_cache,
+            "featselect",
+            input,
+            output,
+            [pp.select_features],
+            outlier_thresh=outlier_thresh,
+        ) as hit:
+            if not hit:
+                pp.select_features(*input, outlier_thresh, *output)
+
+
+rule sweep_distance_shard:
+    input:
+        f"{prof_dir}/profiles/{scenario}.parquet",
+    output:
+        f"{dist_dir}/distances/shards/{{method}}/{{shard}}.parquet",
+    wildcard_constraints:
+        method="|".join(config["distances_R"]),
+        shard=r"[^/]+",
+    params:
+        treatment=config["treatment"],
+        freeze=config["dist_freeze_model"],
+        categories=lambda wildcards: distance_shards[wildcards.method][wildcards.shard],
+        store=f"{dist_dir}/distances/store",
+    threads: lambda wildcards: cr.shards.shard_threads(wildcards.method, distance_shards[wildcards.method][wildcards.shard])
+    resources:
+        mem_mb=lambda wildcards, input, threads, attempt: cr.shards.shard_mem_mb(input[0], wildcards.method, threads, attempt),
+    run:
+        cover_var = json.loads(wildcards.cv)
+        with stc.cache.stage(
+            stage_cache,
+            "compute_distance_shard",
+            input,
+            output,
+            r_scripts,
+            method=wildcards.method,
+            cover_var=cover_var,
+            treatment=params.treatment,
+            categories=params.categories,
+            frozen_models=(
+                cr.shards.frozen_models(params.store, wildcards.method, params.categories)
+                if params.freeze
+                else None
+            ),
+        ) as hit:
+            if not hit:
+                categories = ",".join(params.categories)
+                shell(
+                    "Rscript concresponse/compute_distances.R {input} {output} {cover_var} {params.treatment} {categories} {wildcards.method} {params.store} {threads} {params.freeze}"
+                )
+
+
+rule sweep_distances_python:
+    input:
+        f"{prof_dir}/profiles/{scenario}.parquet",
+    output:
+        [f"{prof_dir}/distances/{method}.parquet" for method in config["distances_python"]],
+    params:
+        distances=config["distances_python"],
+        out_dir=f"{prof_dir}/distances",
+        null_cache=f"{prof_dir}/distances/ap_null_cache",
+        null_size=config["ap_null_size"],
+        seed=config["ap_seed"],
+    threads: 10
+    run:
+        with stc.cache.stage(
+            stage_cache,
+            "compute_distances_python",
+            input,
+            output,
+            [cr.ap],
+            distances=params.distances,
+            null_size=params.null_size,
+            seed=params.seed,
+        ) as hit:
+            if not hit:
+                for method in params.distances:
+                    cr.ap.calculate_distances(
+                        input[0],
+                        f"{params.out_dir}/{method}.parquet",
+                        method,
+                        params.null_cache,
+                        threads,
+                        params.null_size,
+                        params.seed,
+                    )
+
+
+rule sweep_compile_distances:
+    input:
+        dist=[
+            f"{dist_dir}/distances/shards/{method}/{shard}.parquet"
+            for method, shards in distance_shards.items()
+            for shard in shards
+        ]
+        + [f"{prof_dir}/distances/{method}.parquet" for method in config["distances_python"]],
+        prof=f"{prof_dir}/profiles/{scenario}.parquet",
+    output:
+        f"{dist_dir}/distances/distances.parquet",
+    params:
+        transform=config["dist_transform"],
+        filt_thresh=sweep_grid["filt_thresh"],
+    run:
+        cr.compile_dist.compile_dist(list(input.dist), input.prof, params.transform, params.filt_thresh, *output)
+
+
+rule sweep_fit_curves:
+    input:
+        f"{dist_dir}/distances/distances.parquet",
+    output:
+        f"{dist_dir}/curves/models.parquet",
+    params:
+        cache=f"{dist_dir}/curves/fit_cache",
+    threads: 10
+    run:
+        cr.bmd.fit_curves(input[0], output[0], params.cache, threads)
+
+
+rule sweep_fit_curves_cc:
+    input:
+        f"{prof_dir}/profiles/{scenario}.parquet",
+    output:
+        f"{prof_dir}/curves/ccmodels.parquet",
+    params:
+        cache=f"{prof_dir}/curves/fit_cache_cc",
+        meta_nm="Metadata_Count_Cells",
+    threads: 10
+    run:
+        cr.bmd.fit_curves_meta(input[0], output[0], params.meta_nm, params.cache, threads)
+
+
+rule sweep_calculate_bmds:
+    input:
+        f"{dist_dir}/curves/models.parquet",
+    output:
+        f"{dist_dir}/curves/bmds.parquet",
+    params:
+        num_sds=sweep_grid["num_sds"],
+    threads: 10
+    run:
+        cr.bmd.calculate_bmds(input[0], output[0], params.num_sds, "SDres", threads)
+
+
+rule sweep_calculate_bmds_cc:
+    input:
+        f"{prof_dir}/curves/ccmodels.parquet",
+    output:
+        f"{prof_dir}/curves/ccpods.parquet",
+    params:
+        num_sds=sweep_grid["num_sds"],
+    threads: 10
+    run:
+        cr.bmd.calculate_bmds(input[0], output[0], params.num_sds, "SDctrl", threads)
+
+
+rule sweep_select_pod:
+    input:
+        f"{dist_dir}/curves/bmds.parquet",
+        f"{prof_dir}/curves/ccpods.parquet",
+    output:
+        f"{dist_dir}/curves/pods.parquet",
+    run:
+        cr.select_pod.select_pod(input[0], input[1], output[0], keep_keys=True)
+
+
+rule sweep_summarize_variant:
+    input:
+        f"{prof_dir}/profiles/{scenario}.parquet",
+        f"{dist_dir}/distances/distances.parquet",
+        f"{dist_dir}/curves/pods.parquet",
+    output:
+        f"{dist_dir}/summary.parquet",
+    run:
+        variant = {
+            "outlier_feat_thresh": json.loads(wildcards.oft),
+            "cover_var": json.loads(wildcards.cv),
+        }
+        cr.sweep.summarize_variant(*input, variant, *output)
+
+
+rule sweep:
+    input:
+        expand(
+            f"{dist_dir}/summary.parquet",
+            oft=sweep_grid["outlier_feat_thresh"],
+            cv=sweep_grid["cover_var"],
+        ),
+    output:
+        f"{sweep_dir}/sweep_summary.parquet",
+    run:
+        cr.sweep.collect_sweep(list(input), output[0])
@@ -9,5 +9,41 @@ rule make_umaps:
         f"outputs/{features}/{name}/curves/ccpods.parquet",
     output:
         f"outputs/{features}/{name}/figures/umaps.pdf",
+    params:
+        cache=f"outputs/{features}/{name}/figures/umap_cache",
     run:
-        vs.umaps.make_umaps(*input, *output)
\ No newline at end of file
+        vs.umaps.make_umaps(*input, *output, params.cache)
+
+rule embed_reference:
+    input:
+        f"outputs/{features}/{name}/profiles/{scenario}.parquet",
+    output:
+        f"outputs/{features}/{name}/figures/reference_umap.parquet",
+        f"outputs/{features}/{name}/figures/reference_umap.pdf",
+    params:
+        model=f"outputs/{features}/{name}/figures/umap_reference/reference.joblib",
+        plates=config["umap_reference_plates"],
+        refit=config["umap_refit"],
+    run:
+        vs.reference.embed_reference(input[0], params.model, params.plates, params.refit, *output)
+
+
+rule qc_aggregates:
+    input:
+        f"inputs/profiles/{features}/raw.parquet",
+    output:
+        f"outputs/{features}/{name}/qc/plate_aggregates.parquet",
+    params:
+        qc_feats=config["qc_features"],
+    run:
+        vs.qc.compute_qc_aggregates(input[0], output[0], params.qc_feats)
+
+
+rule qc_report:
+    input:
+        f"outputs/{features}/{name}/qc/plate_aggregates.parquet",
+    output:
+        f"outputs/{features}/{name}/qc/qc_report.pdf",
+    threads: 10
+    run:
+        vs.qc.plot_qc(input[0], output[0], threads)
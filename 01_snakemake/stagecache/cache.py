@@ -0,0 +1,210 @@
+"""
+Content-addressed cache of pipeline stages.
+
+A stage's outputs are stored under a key hashed from the content of its
+inputs, the code that computes it and the config parameters it uses, never
+from the output paths. Runs that only differ in name or in parameters of
+later stages therefore share the outputs of their common stages: a cached
+stage is restored by hard-linking (or copying) its outputs into place.
+
+File hashes are memoized by path, size and mtime, so large inputs are only
+read once.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import sys
+import tempfile
+from contextlib import contextmanager
+
+cache_version = 1
+hash_chunk = 1 << 20
+
+
+def write_json(obj: dict, path: str) -> None:
+    """Write atomically, so that concurrent jobs never read partial files."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(obj, f, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def file_digest(path: str, cache_dir: str) -> str:
+    """Content hash of a file, memoized by path, size and mtime."""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    memo_dir = os.path.join(cache_dir, "hashes")
+    memo_path = os.path.join(memo_dir, hashlib.sha1(path.encode()).hexdigest())
+    memo = {"path": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    if os.path.exists(memo_path):
+        with open(memo_path) as f:
+            cached = json.load(f)
+        if {k: cached.get(k) for k in memo} == memo:
+            return cached["digest"]
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(hash_chunk):
+            h.update(chunk)
+
+    os.makedirs(memo_dir, exist_ok=True)
+    write_json({**memo, "digest": h.hexdigest()}, memo_path)
+    return h.hexdigest()
+
+
+def path_digest(path: str, cache_dir: str) -> str:
+    """Content hash of a file or of all files of a directory."""
+    if not os.path.isdir(path):
+        return file_digest(path, cache_dir)
+
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for fname in sorted(files):
+            fpath = os.path.join(root, fname)
+            h.update(os.path.relpath(fpath, path).encode())
+            h.update(file_digest(fpath, cache_dir).encode())
+    return h.hexdigest()
+
+
+def code_digest(code, cache_dir: str) -> str:
+    """Hash of the source of a module or function, or of a file path.
+
+    Modules and functions of a package hash all modules of the package, as
+    they import its helpers.
+    """
+    if isinstance(code, str):
+        return file_digest(code, cache_dir)
+
+    package = sys.modules[inspect.getmodule(code).__name__.partition(".")[0]]
+    if not hasattr(package, "__path__"):
+        return file_digest(inspect.getsourcefile(code), cache_dir)
+
+    h = hashlib.sha256()
+    for pkg_dir in package.__path__:
+        for root, dirs, files in os.walk(pkg_dir):
+            dirs[:] = sorted(i for i in dirs if i != "__pycache__")
+            for fname in sorted(i for i in files if i.endswith(".py")):
+                fpath = os.path.join(root, fname)
+                h.update(os.path.relpath(fpath, pkg_dir).encode())
+                h.update(file_digest(fpath, cache_dir).encode())
+    return h.hexdigest()
+
+
+def stage_key(
+    stage: str, inputs: list, outputs: list, code: list, params: dict, cache_dir: str
+) -> str:
+    """Cache key of a stage, independent of where its files are."""
+    manifest = {
+        "version": cache_version,
+        "stage": stage,
+        "inputs": [path_digest(i, cache_dir) for i in inputs],
+        "outputs": [os.path.basename(i) for i in outputs],
+        "code": [code_digest(i, cache_dir) for i in code],
+        "params": params,
+    }
+    return hashlib.sha256(
+        json.dumps(manifest, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def link_or_copy(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def place(src: str, dst: str) -> None:
+    """Link a cached file or directory to dst, replacing what is there."""
+    if os.path.isdir(dst):
+        shutil.rmtree(dst)
+    elif os.path.lexists(dst):
+        os.remove(dst)
+    os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+
+    if os.path.isdir(src):
+        shutil.copytree(src, dst, copy_function=link_or_copy)
+    else:
+        link_or_copy(src, dst)
+
+
+def touch(path: str) -> None:
+    """Mark restored outputs as new, so that they are not older than inputs."""
+    paths = [path]
+    if os.path.isdir(path):
+        paths += [
+            os.path.join(root, i) for root, _, files in os.walk(path) for i in files
+        ]
+    for i in paths:
+        os.utime(i)
+
+
+@contextmanager
+def stage(
+    cache_dir: str,
+    name: str,
+    inputs: list,
+    outputs: list,
+    code: list = (),
+    **params,
+):
+    """Restore a stage from the cache, or store its outputs once computed.
+
+    Yields True when the outputs were restored and the stage can be
+    skipped, e.g.
+
+        with stc.cache.stage(stage_cache, rule, input, output, [pp.stats]) as hit:
+            if not hit:
+                pp.stats.compute_negcon_stats(*input, *output)
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the cache, shared by all runs.
+    name : str
+        Name of the stage.
+    inputs : list
+        Input files or directories of the stage.
+    outputs : list
+        Output files or directories of the stage.
+    code : list, optional
+        Modules, functions or source files whose changes invalidate the stage;
+        a module or function stands for all modules of its package.
+    **params
+        Config parameters the stage uses.
+
+    """
+    inputs, outputs = list(inputs), list(outputs)
+    key = stage_key(name, inputs, outputs, list(code), params, cache_dir)
+    objects = os.path.join(cache_dir, "objects")
+    entry = os.path.join(objects, key)
+
+    if os.path.exists(os.path.join(entry, "manifest.json")):
+        for i, output in enumerate(outputs):
+            place(os.path.join(entry, str(i)), output)
+            touch(output)
+        print(f"Restored {name} from stage cache {key[:12]}")
+        yield True
+        return
+
+    yield False
+
+    # link the new outputs into a temporary entry and publish it at once
+    os.makedirs(objects, exist_ok=True)
+    tmp_entry = tempfile.mkdtemp(dir=objects, prefix=".tmp_")
+    for i, output in enumerate(outputs):
+        place(output, os.path.join(tmp_entry, str(i)))
+    write_json(
+        {"stage": name, "params": params, "outputs": outputs},
+        os.path.join(tmp_entry, "manifest.json"),
+    )
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # stored by a concurrent job
+        shutil.rmtree(tmp_entry)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the pipeline packages are imported from the Snakemake directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
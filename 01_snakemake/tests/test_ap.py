@@ -0,0 +1,8 @@
+import pytest
+
+from concresponse import ap
+
+
+def test_calculate_ap_null_size_multiple_of_group_size(tmp_path):
+    with pytest.raises(ValueError, match="multiple of the DMSO group size"):
+        ap.calculate_ap(str(tmp_path / "missing.parquet"), str(tmp_path), n_samples=700)
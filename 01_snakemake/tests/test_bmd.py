@@ -0,0 +1,110 @@
+import os
+
+import numpy as np
+import polars as pl
+import pytest
+
+from concresponse import bmd
+
+parity_dir = os.path.join(os.path.dirname(__file__), "data", "bmd_parity")
+
+# controls at 0 and log10 doses shifted above 0, as in the formatted metadata
+doses = np.r_[np.zeros(6), np.repeat(np.linspace(0.5, 2.5, 5), 3)]
+
+
+def linear_response(rng: np.random.Generator) -> np.ndarray:
+    return doses + rng.normal(0, 0.3, len(doses))
+
+
+def test_fit_models_first_series_without_fit(tmp_path):
+    rng = np.random.default_rng(1)
+    x = np.tile(doses, (2, 1))
+    y = np.vstack([np.zeros(len(doses)), linear_response(rng)])
+    w = np.ones_like(x)
+    series = pl.DataFrame({"Metadata_Compound": ["flat", "linear"], "gene.id": "d"})
+
+    fits = bmd.fit_models(series, x, y, w, str(tmp_path), n_jobs=1)
+
+    assert fits.get_column("Metadata_Compound").to_list() == ["linear"]
+    cached = pl.read_parquet(tmp_path / "fits.parquet")
+    assert cached.schema["mod.name"] == pl.String
+    assert cached.get_column("mod.name").null_count() == 1
+
+
+def test_stack_series_masks_missing_doses():
+    rng = np.random.default_rng(1)
+    n_ctrl = 6
+    dat = pl.DataFrame(
+        {
+            "Metadata_Compound": ["DMSO"] * n_ctrl
+            + ["linear"] * len(doses)
+            + ["single"] * 3,
+            "Metadata_Plate": "p1",
+            "Metadata_well_type": ["DMSO"] * n_ctrl + ["trt"] * (len(doses) + 3),
+            "Metadata_Log10Conc": [0.0] * n_ctrl + list(doses) + [None] * 3,
+            "d": np.r_[rng.normal(0, 0.05, n_ctrl), linear_response(rng), [1.0] * 3],
+        }
+    )
+
+    series, x, y, w = bmd.stack_series(dat, ["d"])
+
+    single = series.get_column("Metadata_Compound").to_list().index("single")
+    assert np.isfinite(x).all()
+    assert w[single].sum() == n_ctrl
+
+
+def test_fit_models_prunes_cache(tmp_path):
+    rng = np.random.default_rng(1)
+    x = np.tile(doses, (2, 1))
+    y = np.vstack([linear_response(rng), linear_response(rng)])
+    w = np.ones_like(x)
+    series = pl.DataFrame({"Metadata_Compound": ["a", "b"], "gene.id": "d"})
+    bmd.fit_models(series, x, y, w, str(tmp_path), n_jobs=1)
+
+    y[1] = linear_response(rng)
+    bmd.fit_models(series, x, y, w, str(tmp_path), n_jobs=1)
+
+    cached = pl.read_parquet(tmp_path / "fits.parquet")
+    assert cached.get_column("Metadata_FitKey").to_list() == bmd.series_keys(x, y, w)
+
+
+def test_threshold_models_without_fits(tmp_path):
+    rng = np.random.default_rng(1)
+    x = np.tile(doses, (2, 1))
+    y = np.vstack([np.zeros(len(doses)), linear_response(rng)])
+    w = np.ones_like(x)
+    series = pl.DataFrame({"Metadata_Compound": ["flat", "linear"], "gene.id": "d"})
+    fits = bmd.fit_models(series, x, y, w, str(tmp_path), n_jobs=1)
+
+    bmds = bmd.threshold_models(fits, [1, 2], n_jobs=1)
+    empty = bmd.threshold_models(fits.clear(), [1, 2], n_jobs=1)
+
+    assert len(bmds) == 2
+    assert (bmds.get_column("SDctrl") > 0).all()
+    assert empty.is_empty()
+    assert empty.schema == bmds.schema
+
+
+def test_fastbmdr_parity(tmp_path):
+    ref_path = os.path.join(parity_dir, "fastbmdr_reference.csv")
+    if not os.path.exists(ref_path):
+        pytest.skip("fastbmdR reference missing, run make_reference.R")
+    ref = pl.read_csv(ref_path, null_values="NA").drop_nulls("mod.name")
+
+    dat = pl.read_csv(os.path.join(parity_dir, "profiles.csv"))
+    series, x, y, w = bmd.stack_series(dat, ["gmd", "Cells_DNA"])
+    fits = bmd.fit_models(series, x, y, w, str(tmp_path), n_jobs=1)
+    bmds = bmd.threshold_models(fits, 1, filt_var="SDres", n_jobs=1)
+
+    key = ["Metadata_Compound", "gene.id"]
+    ref = ref.sort(key)
+    bmds = bmds.sort(key)
+    assert bmds.select(key + ["mod.name"]).equals(ref.select(key + ["mod.name"]))
+    assert bmds.get_column("all.pass").to_list() == ref.get_column("all.pass").to_list()
+
+    # BMDs are read off a dose grid, BMDL/BMDU come from parametric draws
+    # instead of fastbmdR's intervals (see concresponse.bmd)
+    for col, rtol in [("bmd", 0.05), ("bmdl", 0.25), ("bmdu", 0.25)]:
+        np.testing.assert_allclose(
+            bmds.get_column(col).to_numpy(), ref.get_column(col).to_numpy(), rtol=rtol
+        )
@@ -0,0 +1,93 @@
+import os
+import shutil
+import subprocess
+
+import numpy as np
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from concresponse import compile_dist, shards
+
+snakemake_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+categories = ["Cells_DNA", "Cells_AGP", "Nuclei_DNA", "Nuclei_AGP"]
+cover_var = "0.95"
+treatment = "Metadata_Perturbation"
+
+
+def write_profiles(path: str) -> None:
+    rng = np.random.default_rng(0)
+    compounds = ["DMSO"] * 8 + [f"C{i}" for i in range(4) for _ in range(4)]
+    concs = [0.0] * 8 + [0.1, 0.1, 1.0, 1.0] * 4
+    meta = pl.DataFrame(
+        {
+            "Metadata_Compound": compounds,
+            "Metadata_Concentration": concs,
+            "Metadata_well_type": ["DMSO" if i == "DMSO" else "trt" for i in compounds],
+        }
+    )
+    profiles = pl.concat(
+        meta.with_columns(pl.lit(plate).alias("Metadata_Plate"))
+        for plate in ["P1", "P2"]
+    ).with_columns(
+        pl.concat_str(
+            ["Metadata_Compound", "Metadata_Concentration"], separator="_"
+        ).alias(treatment)
+    )
+    feats = {
+        f"{compartment}_Intensity_{channel}_{i}": rng.normal(size=len(profiles))
+        for compartment, channel in (i.split("_") for i in categories)
+        for i in range(3)
+    }
+    profiles.with_columns(**feats).write_parquet(path)
+
+
+def compute_distances(prof_path, out_path, cats, method, store, *args) -> None:
+    subprocess.run(
+        ["Rscript", "concresponse/compute_distances.R", prof_path, out_path]
+        + [cover_var, treatment, ",".join(cats), method, store]
+        + [str(i) for i in args],
+        cwd=snakemake_dir,
+        check=True,
+    )
+
+
+@pytest.mark.skipif(shutil.which("Rscript") is None, reason="requires R")
+def test_shards_match_single_job(tmp_path):
+    prof_path = str(tmp_path / "profiles.parquet")
+    write_profiles(prof_path)
+
+    # one job per method with all categories, as before the scatter
+    single = []
+    for method in ["gmd", "cmd"]:
+        out_path = str(tmp_path / f"{method}.parquet")
+        compute_distances(
+            prof_path, out_path, categories, method, str(tmp_path / "single")
+        )
+        single.append(out_path)
+
+    scattered = []
+    for method, method_shards in shards.distance_shards(
+        ["gmd", "cmd"], categories
+    ).items():
+        for shard, cats in method_shards.items():
+            out_path = str(tmp_path / "shards" / method / f"{shard}.parquet")
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            threads = shards.shard_threads(method, cats)
+            compute_distances(
+                prof_path, out_path, cats, method, str(tmp_path / "store"), threads
+            )
+            scattered.append(out_path)
+
+    for files, name in [(single, "single"), (scattered, "scattered")]:
+        compile_dist.compile_dist(
+            files, prof_path, "none", 1e7, str(tmp_path / f"{name}.parquet")
+        )
+    expected = pl.read_parquet(tmp_path / "single.parquet")
+    gathered = pl.read_parquet(tmp_path / "scattered.parquet")
+
+    assert_frame_equal(
+        gathered.sort("Metadata_WellKey"),
+        expected.sort("Metadata_WellKey"),
+        check_column_order=False,
+    )
@@ -0,0 +1,24 @@
+import polars as pl
+import pytest
+
+from classifier import hitcalls
+
+
+def test_robust_z_tied_dmso_distances():
+    n_ctrl = 4
+    dist = pl.DataFrame(
+        {
+            "Metadata_Compound": ["DMSO"] * n_ctrl + ["A", "A"],
+            "Metadata_OASIS_ID": ["DMSO"] * n_ctrl + ["A", "A"],
+            "Metadata_Concentration": [0.0] * n_ctrl + [1.0, 1.0],
+            "Metadata_Log10Conc": [None] * n_ctrl + [0.0, 0.0],
+            "Metadata_Plate": "P1",
+            "Metadata_well_type": ["DMSO"] * n_ctrl + ["trt", "trt"],
+            "gmd": [2.0] * n_ctrl + [3.0, 2.0],
+        }
+    )
+
+    scores = hitcalls.well_scores(dist, "robust_z")
+
+    z = scores.get_column("z").to_list()
+    assert z == pytest.approx([1 / (hitcalls.mad_scale * hitcalls.mad_floor * 2), 0])
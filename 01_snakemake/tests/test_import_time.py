@@ -0,0 +1,30 @@
+import os
+import subprocess
+import sys
+
+packages = ["preprocessing", "concresponse", "classifier", "visualize"]
+heavy = ["sklearn", "scanpy", "matplotlib", "pycytominer"]
+
+
+def test_packages_import_lazily():
+    code = (
+        f"import {', '.join(packages)}, sys; "
+        f"print(','.join(i for i in {heavy!r} if i in sys.modules))"
+    )
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    # import time: self [us] | cumulative | imported package
+    cumulative = {}
+    for line in proc.stderr.splitlines():
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            cumulative[fields[2].strip()] = int(fields[1])
+    assert sum(cumulative[i] for i in packages) < 1_000_000
+
+    assert proc.stdout.strip() == ""
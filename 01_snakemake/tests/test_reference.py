@@ -0,0 +1,24 @@
+import numpy as np
+import polars as pl
+
+from visualize import reference
+
+
+def test_load_reference_refits_changed_plates(tmp_path):
+    rng = np.random.default_rng(0)
+    profiles = pl.DataFrame(
+        {
+            "Metadata_Plate": np.repeat(["P1", "P2", "P3"], 40),
+            **{f"f{i}": rng.normal(size=120) for i in range(5)},
+        }
+    )
+    model_path = str(tmp_path / "reference.joblib")
+
+    fitted = reference.load_reference(profiles, model_path, ["P1", "P2"], False)
+    reused = reference.load_reference(profiles, model_path, ["P2", "P1"], False)
+    refitted = reference.load_reference(profiles, model_path, ["P3"], False)
+    default = reference.load_reference(profiles, model_path, [], False)
+
+    assert reused["plates"] == fitted["plates"]
+    assert refitted["plates"] == ["P3"]
+    assert default["plates"] == ["P3"]
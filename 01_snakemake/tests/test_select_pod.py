@@ -0,0 +1,50 @@
+import polars as pl
+
+from concresponse import select_pod
+
+pods_schema = (
+    ["Metadata_Compound"] + select_pod.pod_cols + ["cc_POD", "PAC_below_cc_POD"]
+)
+
+
+def write_bmds(path, num_sds: list, dists: list) -> None:
+    rows = [
+        {"Metadata_Compound": cmpd, "gene.id": dist, "num_sds": sds}
+        for cmpd in ["A", "B"]
+        for dist in dists
+        for sds in num_sds
+    ]
+    bmds = pl.DataFrame(rows).with_columns(
+        pl.lit("Lin").alias("mod.name"),
+        pl.int_range(pl.len()).cast(pl.Float64).alias("bmd"),
+        *[pl.lit(0.0).alias(i) for i in ["b", "c", "d", "e", "f", "bmdl", "bmdu"]],
+        *[pl.lit(1.0).alias(i) for i in ["bmr", "lof.p", "SDres", "SDctrl"]],
+        pl.lit(True).alias("all.pass"),
+    )
+    bmds.write_parquet(path)
+
+
+def test_select_pod_keeps_pods_schema(tmp_path):
+    write_bmds(tmp_path / "bmds.parquet", [2.0], ["gmd", "Cells_DNA"])
+    write_bmds(tmp_path / "cc.parquet", [2.0], ["cc"])
+
+    select_pod.select_pod(
+        tmp_path / "bmds.parquet", tmp_path / "cc.parquet", tmp_path / "pods.parquet"
+    )
+
+    pods = pl.read_parquet(tmp_path / "pods.parquet")
+    assert pods.columns == pods_schema
+    assert pods.get_column("Metadata_Compound").to_list() == ["A", "B"]
+
+
+def test_select_pod_keeps_varying_keys(tmp_path):
+    write_bmds(tmp_path / "bmds.parquet", [1.0, 2.0], ["gmd", "Cells_DNA"])
+    write_bmds(tmp_path / "cc.parquet", [1.0, 2.0], ["cc"])
+
+    select_pod.select_pod(
+        tmp_path / "bmds.parquet", tmp_path / "cc.parquet", tmp_path / "pods.parquet"
+    )
+
+    pods = pl.read_parquet(tmp_path / "pods.parquet")
+    assert pods.columns == pods_schema + ["num_sds"]
+    assert len(pods) == 4
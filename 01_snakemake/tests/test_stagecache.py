@@ -0,0 +1,21 @@
+import importlib
+import os
+
+from stagecache import cache
+
+
+def test_code_digest_covers_package_helpers(tmp_path, monkeypatch):
+    pkg = tmp_path / "pkg"
+    pkg.mkdir()
+    (pkg / "__init__.py").write_text("")
+    (pkg / "helpers.py").write_text("scale = 1\n")
+    (pkg / "stage.py").write_text("from pkg.helpers import scale\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    stage = importlib.import_module("pkg.stage")
+    cache_dir = str(tmp_path / "cache")
+
+    before = cache.code_digest(stage, cache_dir)
+    (pkg / "helpers.py").write_text("scale = 2\n")
+    os.utime(pkg / "helpers.py", ns=(0, 0))
+
+    assert cache.code_digest(stage, cache_dir) != before
@@ -1 +1,23 @@
-from . import umaps as umaps
+"""QC reports and UMAP figures."""
+
+import importlib
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from . import qc as qc
+    from . import reference as reference
+    from . import umaps as umaps
+
+submodules = ["qc", "reference", "umaps"]
+
+
+# submodules are imported on first access (PEP 562), so that parsing the
+# rules does not import their dependencies
+def __getattr__(name: str):
+    if name in submodules:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> list:
+    return sorted([*globals(), *submodules])
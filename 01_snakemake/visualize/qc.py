@@ -0,0 +1,153 @@
+"""
+Plate QC report.
+
+Cell counts and a few summary features are aggregated per source, plate and
+well in one lazy, projected scan of the profiles and stored as a small
+parquet. The report pages are rendered from that summary in parallel.
+"""
+
+import os
+import tempfile
+
+import matplotlib
+import matplotlib.pyplot as plt
+import polars as pl
+import seaborn as sns
+from joblib import Parallel, delayed
+from matplotlib.backends.backend_pdf import PdfPages
+
+matplotlib.use("Agg")
+
+key_cols = ["Metadata_Source", "Metadata_Plate", "Metadata_Well", "Metadata_well_type"]
+row_order = list("ABCDEFGHIJKLMNOP")
+page_dpi = 100
+
+
+def compute_qc_aggregates(prof_path: str, agg_path: str, qc_feats: list) -> None:
+    """Per-well cell counts and summary features of every plate."""
+    profiles = pl.scan_parquet(prof_path)
+    cols = profiles.collect_schema().names()
+    value_cols = ["Metadata_Count_Cells"] + [i for i in qc_feats if i in cols]
+
+    aggs = (
+        profiles.select(key_cols + value_cols)
+        .group_by(key_cols)
+        .agg(pl.col(value_cols).mean())
+        .with_columns(
+            pl.col("Metadata_Well").str.extract(r"([A-P])").alias("Metadata_Well_Row"),
+            pl.col("Metadata_Well").str.extract(r"(\d{2})").alias("Metadata_Well_Col"),
+        )
+        .sort(key_cols)
+        .collect()
+    )
+    aggs.write_parquet(agg_path)
+
+
+def source_boxplot(aggs: pl.DataFrame, col: str) -> None:
+    plt.figure(figsize=(10, 6))
+    sns.boxplot(
+        data=aggs.filter(pl.col("Metadata_well_type") == "DMSO").to_pandas(),
+        x="Metadata_Source",
+        y=col,
+        hue="Metadata_Source",
+        palette="pastel",
+        legend=False,
+    )
+    plt.xlabel("Metadata Source")
+    plt.ylabel(col)
+    plt.title(f"DMSO {col} by Source")
+    plt.tight_layout()
+
+
+def plate_boxplot(aggs: pl.DataFrame, col: str) -> None:
+    sns.set_theme(style="whitegrid")
+    g = sns.catplot(
+        data=aggs.filter(pl.col("Metadata_well_type") == "DMSO").to_pandas(),
+        x="Metadata_Plate",
+        y=col,
+        col="Metadata_Source",
+        kind="box",
+        col_wrap=2,
+        height=4,
+        aspect=1.5,
+        hue="Metadata_Plate",
+        palette="pastel",
+        legend=False,
+        sharex=False,
+        sharey=True,
+    )
+
+    for ax in g.axes.flatten():
+        ax.tick_params(axis="x", labelrotation=90)
+    g.set_axis_labels("Plate", col)
+    g.fig.subplots_adjust(top=0.9)
+    g.fig.suptitle(f"{col} per Plate by Batch")
+    plt.tight_layout()
+
+
+def well_heatmap(aggs: pl.DataFrame, col: str) -> None:
+    source = aggs.get_column("Metadata_Source").first()
+    heatmap_data = (
+        aggs.group_by(["Metadata_Well_Row", "Metadata_Well_Col"])
+        .agg(pl.col(col).mean())
+        .to_pandas()
+        .pivot(index="Metadata_Well_Row", columns="Metadata_Well_Col", values=col)
+        .reindex(index=row_order)
+        .sort_index(axis=1)
+    )
+
+    plt.figure(figsize=(14, 8))
+    sns.heatmap(
+        heatmap_data,
+        cmap="viridis",
+        linewidths=0.5,
+        linecolor="white",
+        cbar_kws={"label": f"Mean {col}"},
+    )
+    plt.title(f"{col} by Well Position — {source}")
+    plt.xlabel("Well Column")
+    plt.ylabel("Well Row")
+    plt.tight_layout()
+
+
+def render_page(plot_fn, aggs: pl.DataFrame, col: str, page_path: str) -> None:
+    plot_fn(aggs, col)
+    plt.savefig(page_path, dpi=page_dpi)
+    plt.close("all")
+
+
+def plot_qc(agg_path: str, plot_path: str, n_jobs: int = -1) -> None:
+    aggs = pl.read_parquet(agg_path)
+    value_cols = [
+        i
+        for i in aggs.columns
+        if i not in key_cols and not i.startswith("Metadata_Well")
+    ]
+
+    pages = []
+    for col in value_cols:
+        pages.append((source_boxplot, aggs, col))
+        pages.append((plate_boxplot, aggs, col))
+        for source in aggs.get_column("Metadata_Source").unique().sort():
+            pages.append(
+                (well_heatmap, aggs.filter(pl.col("Metadata_Source") == source), col)
+            )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        page_paths = [os.path.join(tmp_dir, f"{i}.png") for i in range(len(pages))]
+        Parallel(n_jobs=n_jobs)(
+            delayed(render_page)(*page, page_path)
+            for page, page_path in zip(pages, page_paths, strict=True)
+        )
+
+        with PdfPages(plot_path) as pdf:
+            for page_path in page_paths:
+                img = plt.imread(page_path)
+                fig = plt.figure(
+                    figsize=(img.shape[1] / page_dpi, img.shape[0] / page_dpi)
+                )
+                ax = fig.add_axes((0, 0, 1, 1))
+                ax.imshow(img)
+                ax.axis("off")
+                pdf.savefig(fig, dpi=page_dpi)
+                plt.close(fig)
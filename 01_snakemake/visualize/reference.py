@@ -0,0 +1,142 @@
+"""
+Reference UMAP embedding.
+
+A PCA and a UMAP model (which holds its own nearest-neighbour index) are
+fitted once on a reference set of plates and persisted. Later runs project
+all wells into that space with transform only, so embeddings of new batches
+are cheap and comparable across runs. The models are only refitted on
+request or when the features or the reference plates no longer match.
+"""
+
+import os
+
+import joblib
+import matplotlib
+import matplotlib.pyplot as plt
+import numpy as np
+import polars as pl
+import umap
+from matplotlib.backends.backend_pdf import PdfPages
+from sklearn.decomposition import PCA
+
+matplotlib.use("Agg")
+
+n_comps = 50
+seed = 0
+
+
+def fit_reference(feats: np.ndarray, feat_cols: list, plates: list) -> dict:
+    pca = PCA(n_components=min(n_comps, *feats.shape), random_state=seed)
+    reducer = umap.UMAP(random_state=seed)
+    reducer.fit(pca.fit_transform(feats))
+
+    return {
+        "pca": pca,
+        "umap": reducer,
+        "feat_cols": feat_cols,
+        "plates": plates,
+    }
+
+
+def load_reference(
+    profiles: pl.DataFrame, model_path: str, ref_plates: list, refit: bool
+) -> dict:
+    """Load the persisted reference models, fitting them if needed.
+
+    ref_plates selects the reference wells of a (re)fit, all plates if empty.
+    A persisted reference fitted on other plates than a non-empty ref_plates
+    is refitted.
+    """
+    feat_cols = [i for i in profiles.columns if not i.startswith("Metadata")]
+    if os.path.exists(model_path) and not refit:
+        reference = joblib.load(model_path)
+        if not set(reference["feat_cols"]) <= set(feat_cols):
+            print("Features changed since the reference was fitted, refitting")
+        elif len(ref_plates) > 0 and set(reference["plates"]) != set(ref_plates):
+            print("Reference plates changed since the reference was fitted, refitting")
+        else:
+            return reference
+
+    if len(ref_plates) == 0:
+        ref_plates = profiles.get_column("Metadata_Plate").unique().sort().to_list()
+    feats = (
+        profiles.filter(pl.col("Metadata_Plate").is_in(ref_plates))
+        .select(feat_cols)
+        .to_numpy()
+        .astype(np.float32)
+    )
+    reference = fit_reference(feats, feat_cols, ref_plates)
+
+    os.makedirs(os.path.dirname(model_path), exist_ok=True)
+    joblib.dump(reference, model_path)
+    return reference
+
+
+def project(reference: dict, profiles: pl.DataFrame) -> np.ndarray:
+    """Transform-only projection of wells into the reference embedding."""
+    feats = profiles.select(reference["feat_cols"]).to_numpy().astype(np.float32)
+    return reference["umap"].transform(reference["pca"].transform(feats))
+
+
+def embed_reference(
+    prof_path: str,
+    model_path: str,
+    ref_plates: list,
+    refit: bool,
+    embed_path: str,
+    plot_path: str,
+) -> None:
+    profiles = pl.read_parquet(prof_path)
+    reference = load_reference(profiles, model_path, ref_plates, refit)
+
+    meta_cols = [i for i in profiles.columns if i.startswith("Metadata")]
+    embedding = project(reference, profiles)
+    embed = profiles.select(meta_cols).with_columns(
+        pl.Series("UMAP_1", embedding[:, 0]),
+        pl.Series("UMAP_2", embedding[:, 1]),
+        pl.col("Metadata_Plate").is_in(reference["plates"]).alias("Metadata_Reference"),
+    )
+    embed.write_parquet(embed_path)
+
+    plot_reference(embed, plot_path)
+
+
+def plot_reference(embed: pl.DataFrame, plot_path: str) -> None:
+    """Wells of every source on top of the reference embedding (grey)."""
+    ref = embed.filter(pl.col("Metadata_Reference"))
+    limits = (
+        (embed.get_column("UMAP_1").min(), embed.get_column("UMAP_1").max()),
+        (embed.get_column("UMAP_2").min(), embed.get_column("UMAP_2").max()),
+    )
+
+    with PdfPages(plot_path) as pdf:
+        for source in embed.get_column("Metadata_Source").unique().sort():
+            source_dat = embed.filter(pl.col("Metadata_Source") == source)
+
+            fig, axes = plt.subplots(1, 2, figsize=(14, 6))
+            for ax, col in zip(
+                axes, ["Metadata_well_type", "Metadata_Count_Cells"], strict=True
+            ):
+                ax.scatter(ref["UMAP_1"], ref["UMAP_2"], s=2, color="lightgrey")
+                if col == "Metadata_Count_Cells":
+                    points = ax.scatter(
+                        source_dat["UMAP_1"],
+                        source_dat["UMAP_2"],
+                        s=4,
+                        c=source_dat[col],
+                        cmap="viridis",
+                    )
+                    fig.colorbar(points, ax=ax, label="Cell Count")
+                else:
+                    for well_type in source_dat[col].unique().sort():
+                        sub = source_dat.filter(pl.col(col) == well_type)
+                        ax.scatter(sub["UMAP_1"], sub["UMAP_2"], s=4, label=well_type)
+                    ax.legend(markerscale=3)
+                ax.set_xlim(*limits[0])
+                ax.set_ylim(*limits[1])
+                ax.set_xlabel("UMAP_1")
+                ax.set_ylabel("UMAP_2")
+            fig.suptitle(f"{source} on the reference embedding")
+            fig.tight_layout()
+            pdf.savefig(fig)
+            plt.close(fig)
@@ -1,15 +1,83 @@
+import glob
+import hashlib
+import os
+
 import anndata
 import matplotlib
 import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
 import polars as pl
 import scanpy as sc
-import seaborn as sns
 from matplotlib.backends.backend_pdf import PdfPages
 
 matplotlib.use("Agg")
 
 
-def make_umaps(prof_path: str, morph_pod: str, cc_pod: str, plot_path: str) -> None:
+def matrix_key(index: np.ndarray, feats: np.ndarray) -> str:
+    """Content hash of the wells and features the neighbour graph is built on."""
+    h = hashlib.sha1("|".join(index).encode())
+    h.update(np.ascontiguousarray(feats).tobytes())
+    return h.hexdigest()
+
+
+def reference_graph(
+    obs: pd.DataFrame, feats: np.ndarray, cache_dir: str
+) -> anndata.AnnData:
+    """PCA, approximate kNN graph and UMAP of all wells, cached by content."""
+    os.makedirs(cache_dir, exist_ok=True)
+    key = matrix_key(obs.index.to_numpy(), feats)
+    graph_path = os.path.join(cache_dir, f"graph_{key}.h5ad")
+
+    if os.path.exists(graph_path):
+        adata = anndata.read_h5ad(graph_path)
+    else:
+        adata = anndata.AnnData(X=feats, obs=pd.DataFrame(index=obs.index))
+        sc.pp.pca(adata)
+        sc.pp.neighbors(adata, use_rep="X_pca", transformer="pynndescent")
+        sc.tl.umap(adata)
+
+        # only the latest graph and its embeddings are kept
+        for path in glob.glob(os.path.join(cache_dir, "*_*.*")):
+            os.remove(path)
+        adata.X = None
+        adata.write_h5ad(graph_path)
+
+    adata.obs = obs
+    adata.uns["graph_key"] = key
+    return adata
+
+
+def subset_umap(adata: anndata.AnnData, mask: np.ndarray, cache_dir: str):
+    """UMAP of a subset of wells on the full kNN graph restricted to it.
+
+    The layout starts from the full embedding and is cached by the subset.
+    """
+    subset = adata[mask].copy()
+    h = hashlib.sha1(adata.uns["graph_key"].encode())
+    h.update(np.packbits(mask).tobytes())
+    umap_path = os.path.join(cache_dir, f"umap_{h.hexdigest()}.npy")
+
+    if os.path.exists(umap_path):
+        subset.obsm["X_umap"] = np.load(umap_path)
+    else:
+        sc.tl.umap(subset, init_pos=subset.obsm["X_umap"].copy())
+        np.save(umap_path, subset.obsm["X_umap"])
+
+    subset.uns["umap_path"] = umap_path
+    return subset
+
+
+def prune_subset_umaps(cache_dir: str, keep: list) -> None:
+    """Remove the cached subset embeddings that are not in keep."""
+    for path in glob.glob(os.path.join(cache_dir, "umap_*.npy")):
+        if path not in keep:
+            os.remove(path)
+
+
+def make_umaps(
+    prof_path: str, morph_pod: str, cc_pod: str, plot_path: str, cache_dir: str
+) -> None:
     data = pl.read_parquet(prof_path)
 
     cc = (
@@ -30,59 +98,42 @@ def make_umaps(prof_path: str, morph_pod: str, cc_pod: str, plot_path: str) -> N
 
     # Add columns to label different sample subsets based on their bioactivity
     data = data.with_columns(
-        (pl.col("Metadata_Log10Conc") > pl.col("Metadata_morph_POD")).alias(
-            "Metadata_Bioactive"
-        ),
-        (pl.col("Metadata_Log10Conc") < pl.col("Metadata_cc_POD")).alias(
-            "Metadata_No_Cytotox"
-        ),
-    )
-
-    data = data.with_columns(
-        pl.when(pl.col("Metadata_Bioactive") == False)
-        .then(False)
-        .when(pl.col("Metadata_Bioactive") == True)
-        .then(True)
-        .otherwise(False)
+        (pl.col("Metadata_Log10Conc") > pl.col("Metadata_morph_POD"))
+        .fill_null(False)
         .alias("Metadata_Bioactive"),
-    )
-    data = data.with_columns(
-        pl.when(pl.col("Metadata_No_Cytotox") == False)
-        .then(False)
-        .when(pl.col("Metadata_No_Cytotox") == True)
-        .then(True)
-        .otherwise(True)
+        (pl.col("Metadata_Log10Conc") < pl.col("Metadata_cc_POD"))
+        .fill_null(True)
         .alias("Metadata_No_Cytotox"),
     ).sample(fraction=1.0, seed=42, shuffle=True)
 
-    metadata_cols = [col for col in data.columns if "Metadata" in col]
-
-    data = data.to_pandas()
-    data.index = [
-        f"{row['Metadata_Plate']}__{row['Metadata_Well']}" for _, row in data.iterrows()
-    ]
-    data = data.loc[~data.index.duplicated(keep="first")]
+    data = data.with_columns(
+        pl.concat_str(["Metadata_Plate", "Metadata_Well"], separator="__").alias(
+            "Metadata_Index"
+        )
+    ).unique("Metadata_Index", keep="first", maintain_order=True)
 
-    metadata = data[metadata_cols]
-    adata = anndata.AnnData(X=data.drop(metadata_cols, axis=1))
-    adata.obs = adata.obs.merge(metadata, left_index=True, right_index=True)
+    metadata_cols = [col for col in data.columns if "Metadata" in col]
+    obs = data.select(metadata_cols).to_pandas().set_index("Metadata_Index")
+    obs.index.name = None
+    feats = data.drop(metadata_cols).to_numpy().astype(np.float32)
+    del data
 
-    sc.pp.neighbors(adata)
-    sc.tl.umap(adata)
+    # One graph on all wells, restricted to the subsets
+    adata = reference_graph(obs, feats, cache_dir)
 
     # Plot UMAPs (only bioactive samples)
-    bioactive_mask = adata.obs["Metadata_Bioactive"]
-    adata_bioactive = adata[bioactive_mask].copy()
-
-    sc.pp.neighbors(adata_bioactive)
-    sc.tl.umap(adata_bioactive)
+    bioactive_mask = adata.obs["Metadata_Bioactive"].to_numpy()
+    adata_bioactive = subset_umap(adata, bioactive_mask, cache_dir)
 
     # Plot UMAPs (only bioactive & non-cytotoxic samples)
-    nocytotox_mask = adata_bioactive.obs["Metadata_No_Cytotox"]
-    adata_nocytotox = adata_bioactive[nocytotox_mask].copy()
+    nocytotox_mask = bioactive_mask & adata.obs["Metadata_No_Cytotox"].to_numpy()
+    adata_nocytotox = subset_umap(adata, nocytotox_mask, cache_dir)
 
-    sc.pp.neighbors(adata_nocytotox)
-    sc.tl.umap(adata_nocytotox)
+    # subsets change with the PODs, only the current ones are kept
+    prune_subset_umaps(
+        cache_dir,
+        [adata_bioactive.uns["umap_path"], adata_nocytotox.uns["umap_path"]],
+    )
 
     with PdfPages(plot_path) as pdf:
         sc.pl.embedding(
@@ -128,85 +179,3 @@ def make_umaps(prof_path: str, morph_pod: str, cc_pod: str, plot_path: str) -> N
         )
         pdf.savefig()
         plt.close()
-
-        # Add cell count boxplot
-        plt.figure(figsize=(10, 6))
-        sns.boxplot(
-            data=data[data["Metadata_well_type"] == "DMSO"],
-            x="Metadata_Source",
-            y="Metadata_Count_Cells",
-            palette="pastel"
-        )
-        plt.xlabel("Metadata Source")
-        plt.ylabel("Cell Count")
-        plt.title("DMSO Cell Count by Source")
-        plt.tight_layout()
-
-        pdf.savefig()
-        plt.close()
-
-        # Add cell count boxplot by plate
-        sns.set(style="whitegrid")
-        g = sns.catplot(
-            data=data[data["Metadata_well_type"] == "DMSO"],
-            x="Metadata_Plate",
-            y="Metadata_Count_Cells",
-            col="Metadata_Source",
-            kind="box",
-            col_wrap=2,
-            height=4,
-            aspect=1.5,
-            palette="pastel",
-            sharex=False,
-            sharey=True 
-        )
-
-        for ax in g.axes.flatten():
-            ax.set_xticklabels(ax.get_xticklabels(), rotation=90)
-        g.set_axis_labels("Plate", "Cell Count")
-        g.fig.subplots_adjust(top=0.9)
-        g.fig.suptitle("Cell Count per Plate by Batch")
-        plt.tight_layout()
-
-        pdf.savefig()
-        plt.close()
-
-        # Plot mean cell count by well position
-        df = pl.read_parquet(prof_path).select(
-            ["Metadata_Source", "Metadata_Plate", "Metadata_Well", "Metadata_well_type", "Metadata_Count_Cells"]
-        ).group_by(["Metadata_Source", "Metadata_Well"]).agg([
-            pl.col("Metadata_Count_Cells").mean()
-        ]).to_pandas()
-
-        df["Well_Row"] = df["Metadata_Well"].str.extract(r"([A-P])")
-        df["Well_Col"] = df["Metadata_Well"].str.extract(r"(\d{2})")
-
-        row_order = list("ABCDEFGHIJKLMNOP")
-
-
-        sources = df["Metadata_Source"].unique()
-        for source in sources:
-            sub_df = df[df["Metadata_Source"] == source]
-            
-            heatmap_data = (
-                sub_df.groupby(["Well_Row", "Well_Col"])["Metadata_Count_Cells"]
-                .mean()
-                .unstack()
-                .reindex(index=row_order)
-            )
-
-            plt.figure(figsize=(14, 8))
-            sns.heatmap(
-                heatmap_data,
-                cmap="viridis",
-                linewidths=0.5,
-                linecolor="white",
-                cbar_kws={"label": "Mean Cell Count"},
-            )
-            plt.title(f"Cell Count by Well Position — {source}")
-            plt.xlabel("Well Column")
-            plt.ylabel("Well Row")
-            plt.tight_layout()
-            pdf.savefig()
-            plt.close()
-